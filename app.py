@@ -5,8 +5,11 @@ from flask_socketio import SocketIO
 from blueprints.posts_bp import posts_bp
 from blueprints.boards_bp import boards_bp
 from blueprints.auth_bp import auth_bp
+from database_modules import media_module, media_gc_module, upload_module, live_module, captcha_module
 #app configuration.
 app = Flask(__name__)
+#uploads are sniffed, size-checked and hashed while the request body streams in.
+app.request_class = upload_module.IngestRequest
 app.config['MAX_CONTENT_LENGTH'] = 21 * 1000 * 1000
 socketio = SocketIO(app)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
@@ -15,6 +18,14 @@ app.secret_key = 'chavesuperultrasecreta'
 app.register_blueprint(posts_bp,socketio=socketio)
 app.register_blueprint(boards_bp)
 app.register_blueprint(auth_bp)
+#sockets join their board or thread room on connect; new posts are emitted to those rooms only.
+live_module.live_rooms.init_app(app, socketio)
+#thumbnails are generated by a process pool; clients get 'thumbnail_ready' over socketIO.
+media_module.media_queue.init_app(app, socketio)
+#files of deleted posts are removed in batches by a background collector.
+media_gc_module.media_gc.init_app(app)
+#captchas are pre-generated in the background, starting now rather than on the first page view.
+captcha_module.captcha_pool.init_app(app)
 
 if __name__ == '__main__':
     #run with socketIO for real-time features.
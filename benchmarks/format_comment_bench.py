@@ -0,0 +1,158 @@
+"""
+Golden corpus and micro-benchmark for formatting.format_comment.
+
+    python benchmarks/format_comment_bench.py            # check the corpus, fuzz, benchmark
+    python benchmarks/format_comment_bench.py --update   # rewrite the corpus from the legacy formatter
+
+The corpus (format_comment_corpus.json) stores the HTML produced by the old
+multi-pass formatter (legacy_formatting.py); the single-pass formatter
+(formatting._render(formatting._tokenize())) must reproduce it byte for byte,
+for the corpus and for every fuzz input.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database_modules import formatting
+import legacy_formatting
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'format_comment_corpus.json')
+
+CORPUS_INPUTS = [
+    '',
+    'plain text without markup',
+    '>greentext\nnormal line',
+    '>>123 reply\n>>456\n>>>789 triple\n>>>>10 quad',
+    '>> not a quote\n>>12abc\n>>٣٤ unicode digits',
+    '<redtext\n<<double\n>green <red\nsecond line\n',
+    'inline > and < in the middle\n>a<b\nc\nd',
+    '[b]bold[/b] [i]italic[/i] [s]strike[/s] [r]rainbow[/r] [spoiler]hidden[/spoiler]',
+    '==red== ||spoiler|| ==open red\n||open spoiler',
+    '===triple=== ||||empty spoiler||||',
+    '(((echo))) ((( not closed ((((nested))) ))) (a)))',
+    'see http://example.com/path?a=1&b=2 and https://example.org',
+    '"http://quoted.example" (http://paren.example) >http://after.gt',
+    '[label](https://example.com/page) and [x [y](http://a.b/c)',
+    '[link with ==red== text](http://example.com)',
+    '[wikinet]Article[/wikinet] [wikinet][/wikinet] [wikinet]no close',
+    '[wikinet]Page[/wikinet](http://example.com)',
+    'http://example.com/a==b',
+    '>greentext ending in a link http://example.com',
+    '[b]http://example.com[/b] [t](http://e.f)http://g.h',
+    '&gt;&gt;123 typed entity',
+    '>check https://example.com',
+    '>>123\n>quote https://a.b',
+    'https://en.wikipedia.org/wiki/Foo_(bar) and (see https://a.b/(c)) [x](http://a.b/(c)d)',
+    '>quote &gt;&gt;45 and >&gt;67\n&gt;>89',
+    '[wikinet][b]Page[/b][/wikinet] [wikinet]a ==b== c[/wikinet]',
+    '[see http://a.b](http://c.d) http://e.f/(((g ok)))',
+    '>>1\n>>2\n>>3\n' * 3,
+    'a\r\nb\r\n>c\r\nd',
+]
+
+PIECES = ['>', '>>', '<', '\n', ' ', '(((', ')))', '(', ')', '[b]', '[/b]', '[i]', '[/i]', '[s]', '[/s]',
+          '[spoiler]', '[/spoiler]', '[r]', '[/r]', '==', '=', '||', '|', '[', ']', '](', 'http://a.b',
+          'https://x.y/z?q=1&r=2', '[wikinet]', '[/wikinet]', 'abc', '123', '"', "'", '&', '&gt;', '/',
+          '[t](http://e.f)']
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua').split()
+
+
+def realistic_comment(rng, lines=40):
+    """Imageboard-like post: quotes, greentext, some inline markup and links."""
+    out = []
+    for _ in range(lines):
+        words = rng.choices(WORDS, k=rng.randint(3, 14))
+        roll = rng.random()
+        if roll < 0.15:
+            line = f'>>{rng.randint(1, 99999)} ' + ' '.join(words)
+        elif roll < 0.30:
+            line = '>' + ' '.join(words)
+        elif roll < 0.35:
+            line = '[b]' + ' '.join(words) + '[/b]'
+        elif roll < 0.40:
+            line = ' '.join(words) + f' https://example.com/{rng.randint(1, 999)}?p=1'
+        elif roll < 0.43:
+            line = '||' + ' '.join(words) + '||'
+        elif roll < 0.45:
+            line = f'[{words[0]}](https://example.org/{words[-1]})'
+        else:
+            line = ' '.join(words)
+        out.append(line)
+    return '\n'.join(out)
+
+
+def random_markup(rng):
+    return ''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+
+
+def single_pass(text):
+    return formatting._render(formatting._tokenize(text))
+
+
+def check_corpus():
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        corpus = json.load(f)
+    failures = [case for case in corpus if single_pass(case['input']) != case['output']]
+    for case in failures:
+        print(f"corpus mismatch: {case['input']!r}")
+    print(f'corpus: {len(corpus) - len(failures)}/{len(corpus)} identical')
+    return not failures
+
+
+def fuzz(cases, seed=0):
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(cases):
+        text = random_markup(rng) if rng.random() < 0.8 else realistic_comment(rng, rng.randint(1, 5))
+        if single_pass(text) != legacy_formatting.format_comment(text):
+            mismatches += 1
+            print(f'fuzz mismatch: {text!r}')
+    print(f'fuzz: {cases} inputs, {mismatches} mismatches')
+    return not mismatches
+
+
+def benchmark(number):
+    rng = random.Random(1)
+    samples = {
+        'short reply': '>>12345\nlorem ipsum ==dolor== sit amet',
+        'realistic 4 KB': realistic_comment(rng, 40),
+        'realistic 20 KB': realistic_comment(rng, 200)[:20000],
+        'greentext 20 KB': ('>' + 'lorem ipsum dolor sit amet ' * 5 + '\n') * 140,
+    }
+    print(f"{'input':<18}{'legacy µs':>12}{'single-pass µs':>16}{'speedup':>9}")
+    for name, text in samples.items():
+        assert formatting.format_comment(text) == legacy_formatting.format_comment(text)
+        old = min(timeit.repeat(lambda: legacy_formatting.format_comment(text), number=number, repeat=5)) / number
+        new = min(timeit.repeat(lambda: formatting.format_comment(text), number=number, repeat=5)) / number
+        print(f'{name:<18}{old * 1e6:>12.1f}{new * 1e6:>16.1f}{old / new:>8.1f}x')
+
+
+def update_corpus():
+    rng = random.Random(2024)
+    inputs = CORPUS_INPUTS + [random_markup(rng) for _ in range(150)] + [realistic_comment(rng, 6) for _ in range(10)]
+    corpus = [{'input': text, 'output': legacy_formatting.format_comment(text)} for text in inputs]
+    with open(CORPUS_PATH, 'w', encoding='utf-8') as f:
+        json.dump(corpus, f, ensure_ascii=False, indent=1)
+    print(f'wrote {len(corpus)} cases to {CORPUS_PATH}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--update', action='store_true', help='regenerate the golden corpus from the legacy formatter')
+    parser.add_argument('--fuzz', type=int, default=20000, help='random inputs compared against the legacy formatter')
+    parser.add_argument('--number', type=int, default=200, help='iterations per timing run')
+    args = parser.parse_args()
+    if args.update:
+        update_corpus()
+        sys.exit(0)
+    ok = check_corpus() and fuzz(args.fuzz)
+    benchmark(args.number)
+    sys.exit(0 if ok else 1)
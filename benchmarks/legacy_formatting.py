@@ -0,0 +1,127 @@
+"""
+The previous multi-pass formatting.format_comment, kept only as the reference for
+format_comment_bench.py: the golden corpus is generated from it, and the fuzz test compares
+the current formatter against it.
+"""
+
+import re
+
+
+def format_comment(comment):
+    # Manipulação de '>' e '<'
+    formatted_comment = []
+    inside_verde = False
+    inside_vermelho = False
+    buffer = []
+
+    for char in comment:
+        if char == '>':
+            if not inside_verde:
+                if buffer:
+                    formatted_comment.append(''.join(buffer))
+                    buffer = []
+                formatted_comment.append('<span class="verde">&gt;')
+                inside_verde = True
+            else:
+                buffer.append('&gt;')
+        elif char == '<':
+            if not inside_vermelho:
+                if buffer:
+                    formatted_comment.append(''.join(buffer))
+                    buffer = []
+                formatted_comment.append('<span class="vermelho">&lt;')
+                inside_vermelho = True
+            else:
+                buffer.append('&lt;')
+        elif char == '\n':
+            buffer.append(char)
+            if inside_verde:
+                formatted_comment.append(''.join(buffer))
+                formatted_comment.append('</span>')
+                buffer = []
+                inside_verde = False
+            elif inside_vermelho:
+                formatted_comment.append(''.join(buffer))
+                formatted_comment.append('</span>')
+                buffer = []
+                inside_vermelho = False
+        else:
+            buffer.append(char)
+
+    if buffer:
+        formatted_comment.append(''.join(buffer))
+
+    if inside_verde:
+        formatted_comment.append('</span>')
+    if inside_vermelho:
+        formatted_comment.append('</span>')
+
+    comment = ''.join(formatted_comment)
+
+    # Manipulação de citações (>>)
+    parts = comment.split('&gt;&gt;')
+    formatted_comment = [parts[0]]
+    for part in parts[1:]:
+        number = re.match(r'^\d+', part)
+        if number:
+            quoted_id = number.group(0)
+            quote_span = f'<span class="quote-reply" data-id="{quoted_id}">&gt;&gt;{quoted_id}</span>'
+            formatted_comment.append(f'{quote_span}{part[len(quoted_id):]}')
+        else:
+            formatted_comment.append(f'&gt;&gt;{part}')
+    comment = ''.join(formatted_comment)
+
+    # Substituir links
+    comment = re.sub(
+        r'\[([^\]]+)\]\((https?://[^\s]+)\)',
+        r'<a class="hyper-link" href="\2" target="_blank" rel="noopener noreferrer">\1</a>',
+        comment
+    )
+    comment = re.sub(
+        r'(?<![("\'>])(https?://[^\s]+)(?![^<]*>)',
+        r'<a class="hyper-link" href="\1" target="_blank" rel="noopener noreferrer">\1</a>',
+        comment
+    )
+
+
+    # Manipulação de '((('
+    parts = comment.split('(((')
+    for index in range(1, len(parts)):
+        match = re.match(r'^[^()]*\)\)\)', parts[index])
+        if match:
+            parts[index] = f'<span class="detected">((({match.group(0)}</span>{parts[index][len(match.group(0)):]}'
+        else:
+            parts[index] = f'((({parts[index]}'
+    comment = ''.join(parts)
+
+    comment = comment.replace('[b]', '<span class="strong">').replace('[/b]', '</span>')  
+
+    comment = comment.replace('[i]', '<span class="italic">').replace('[/i]', '</span>') 
+
+    comment = comment.replace('[s]', '<span class="s">').replace('[/s]', '</span>') 
+
+    # Manipulação de '=='
+    parts = comment.split('==')
+    for index in range(1, len(parts), 2):
+        parts[index] = f'<span class="red-text">{parts[index]}</span>'
+    comment = ''.join(parts)
+
+    # Manipulação de '||'
+    parts = comment.split('||')
+    for index in range(1, len(parts), 2):
+        parts[index] = f'<span class="spoiler">{parts[index]}</span>'
+    comment = ''.join(parts)
+
+    # Manipulação de [spoiler]
+    comment = comment.replace('[spoiler]', '<span class="spoiler">').replace('[/spoiler]', '</span>')
+
+    # Manipulação de [r]
+    comment = comment.replace('[r]', '<span class="rainbowtext">').replace('[/r]', '</span>')
+
+    comment = re.sub(
+        r'\[wikinet\]([^\[]+)\[/wikinet\]',
+        r'<a class="wikinet-hyper-link" href="https://wikinet.pro/wiki/\1" target="_blank"><span>\1</span></a>',
+        comment
+    )
+
+    return comment
@@ -0,0 +1,143 @@
+"""
+Benchmark for the page read path: SELECT * with sqlite3.Row and dict copies vs per-view projections.
+
+    python benchmarks/page_rows_bench.py                     # 2000 threads, 40 replies each
+    python benchmarks/page_rows_bench.py --threads 500 --replies 300
+
+"legacy" is the previous path: SELECT * (p.* / r.*), sqlite3.Row rows, and a dict copy of every
+row in boards_bp before the render fields are added. "views" reads only the columns of the
+page's view (database_module.*_VIEW) straight into __slots__ rows (row_module) and fills them in place.
+Memory is what the rows of one page hold after preparation (tracemalloc), rows/s is read + prepare.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database_modules import database_module, row_module
+
+SCHEMA = """
+    CREATE TABLE posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_ip TEXT, post_id INTEGER UNIQUE NOT NULL, post_user TEXT,
+        post_date TEXT NOT NULL, board_uri TEXT NOT NULL, original_content TEXT, post_content TEXT,
+        post_images TEXT, imagesthb TEXT, locked INTEGER DEFAULT 0, visible INTEGER DEFAULT 1,
+        last_bumped TEXT NOT NULL, pinned INTEGER NOT NULL DEFAULT 0, thumb_variants TEXT
+    );
+    CREATE TABLE replies (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_ip TEXT, reply_id INTEGER UNIQUE NOT NULL, post_id INTEGER NOT NULL,
+        post_user TEXT, post_date TEXT NOT NULL, content TEXT, images TEXT, imagesthb TEXT, thumb_variants TEXT
+    );
+    CREATE INDEX idx_post_board_page ON posts (board_uri, pinned, last_bumped DESC, post_id DESC);
+    CREATE INDEX idx_reply_post_id ON replies (post_id);
+"""
+
+RENDER_VALUES = {'post_images_list': [], 'imagesthb_list': [], 'thumb_sources': {}, 'answered_by': [],
+                 'date_display': '01/01/2026 00:00:00', 'files_html': '<div class="files"></div>'}
+
+
+def comment(rng):
+    """Comment length: mostly short, some long, a few near the 20 000 character limit."""
+    length = rng.choice([80, 200, 400, 900, 2500, 19000]) + rng.randint(0, 60)
+    text = ''.join(rng.choice('abcdefghij klmnop\n') for _ in range(length))
+    return text, f"<p>{text}</p>".replace('\n', '<br>')
+
+
+def build_database(path, threads, replies):
+    rng = random.Random(1)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    item_id = 0
+    for thread in range(threads):
+        item_id += 1
+        post_id = item_id
+        original, html = comment(rng)
+        stamp = f"2026-01-01T00:00:{thread:06d}"
+        conn.execute("INSERT INTO posts (user_ip, post_id, post_user, post_date, board_uri, original_content, post_content,"
+                     " post_images, imagesthb, last_bumped, thumb_variants) VALUES (?, ?, ?, ?, 'b', ?, ?, ?, ?, ?, ?)",
+                     ('10.0.0.1', post_id, 'Anonymous', stamp, original, html, f'["{post_id}.png"]',
+                      f'["post_images/thumbs/{post_id}.jpg"]', stamp, '{"post_images/thumbs/x.jpg": [["webp", 250]]}'))
+        rows = []
+        for _ in range(replies):
+            item_id += 1
+            _, html = comment(rng)
+            rows.append(('10.0.0.2', item_id, post_id, 'Anonymous', stamp, html, '[]', '[]', None))
+        conn.executemany("INSERT INTO replies (user_ip, reply_id, post_id, post_user, post_date, content, images, imagesthb,"
+                         " thumb_variants) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+# --- Pages: the (SQL, params, view) reads of each page for one read path ---
+def page_queries(view_path, threads, replies_per_thread):
+    thread_view = database_module.BOARD_THREAD_VIEW
+    if view_path:
+        board = f"SELECT {thread_view.select('p.')} FROM posts p WHERE p.board_uri = 'b' AND p.pinned = 0 ORDER BY p.last_bumped DESC, p.post_id DESC LIMIT ?"
+        op = f"SELECT {database_module.THREAD_OP_VIEW.select()} FROM posts WHERE post_id = ?"
+        thread_replies = f"SELECT {database_module.REPLY_VIEW.select()} FROM replies WHERE post_id = ? ORDER BY post_date ASC"
+    else:
+        board = "SELECT p.* FROM posts p WHERE p.board_uri = 'b' AND p.pinned = 0 ORDER BY p.last_bumped DESC, p.post_id DESC LIMIT ?"
+        op = "SELECT * FROM posts WHERE post_id = ?"
+        thread_replies = "SELECT * FROM replies WHERE post_id = ? ORDER BY post_date ASC"
+    middle = 1 + (threads // 2) * (replies_per_thread + 1) # Threads and replies share one number sequence
+    return {
+        'board page (6)': [(board, (6,), thread_view)],
+        'catalog (200)': [(board, (200,), thread_view)],
+        f'thread ({replies_per_thread} replies)': [(op, (middle,), database_module.THREAD_OP_VIEW),
+                                                   (thread_replies, (middle,), database_module.REPLY_VIEW)],
+    }
+
+
+def read_page(conn, queries, view_path):
+    items = []
+    for sql, params, view in queries:
+        cursor = conn.cursor()
+        if view_path: cursor.row_factory = view.row_factory
+        for row in cursor.execute(sql, params).fetchall():
+            item = row_module.as_item(row) # legacy: dict copy of sqlite3.Row, as boards_bp did
+            for key, value in RENDER_VALUES.items(): item[key] = value
+            items.append(item)
+    return items
+
+
+def measure(conn, queries, view_path, seconds):
+    read_page(conn, queries, view_path) # Warm the page cache
+    tracemalloc.start()
+    items = read_page(conn, queries, view_path)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rows = len(items)
+    del items
+    pages, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        read_page(conn, queries, view_path)
+        pages += 1
+    elapsed = time.perf_counter() - start
+    return rows, held, rows * pages / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=2000)
+    parser.add_argument('--replies', type=int, default=40, help='replies per thread')
+    parser.add_argument('--seconds', type=float, default=1.0, help='timing window per page and path')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'bench.db')
+        build_database(path, args.threads, args.replies)
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row # As in connection_module
+        legacy_pages = page_queries(False, args.threads, args.replies)
+        view_pages = page_queries(True, args.threads, args.replies)
+        print(f"{'page':<22}{'rows':>6}{'legacy KB':>11}{'views KB':>10}{'legacy rows/s':>15}{'views rows/s':>14}")
+        for name in legacy_pages:
+            rows, old_held, old_rate = measure(conn, legacy_pages[name], False, args.seconds)
+            _, new_held, new_rate = measure(conn, view_pages[name], True, args.seconds)
+            print(f"{name:<22}{rows:>6}{old_held / 1024:>11.0f}{new_held / 1024:>10.0f}{old_rate:>15,.0f}{new_rate:>14,.0f}")
+        conn.close()
@@ -0,0 +1,162 @@
+"""
+Benchmark for the thumbnail engine (media_module.generate_thumbnail).
+
+    python benchmarks/thumbnail_bench.py                  # synthetic sample corpus
+    python benchmarks/thumbnail_bench.py --corpus DIR     # your own images (jpg/png/webp/gif)
+
+Each path runs in a fresh process so that peak RSS (VmHWM) is comparable.
+"legacy" is the previous implementation: full decode, EXIF rotate of the full-size
+image, thumbnail(LANCZOS), and a copy of every GIF frame. The engine's WebP/AVIF
+variants (media_module.write_variants) are not written, so both columns time the same
+output: one JPEG/PNG thumbnail.
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image, ImageChops, ImageSequence, ImageStat
+
+THUMB_SIZE = (250, 250)
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+
+def legacy_thumbnail(original_path, thumb_path, file_ext):
+    if file_ext == '.gif':
+        with Image.open(original_path) as img:
+            frames = [frame.copy() for frame in ImageSequence.Iterator(img)]
+            first_frame = frames[0]
+            first_frame.thumbnail(THUMB_SIZE, Image.Resampling.LANCZOS)
+            if first_frame.mode != 'RGBA': first_frame = first_frame.convert('RGBA')
+            first_frame.save(thumb_path, format='PNG', optimize=True)
+        return True
+    with Image.open(original_path) as img:
+        try:
+            for orientation_tag in Image.ExifTags.TAGS.keys():
+                if Image.ExifTags.TAGS[orientation_tag] == 'Orientation': break
+            else: orientation_tag = None
+            if orientation_tag:
+                exif_data = img._getexif()
+                if exif_data is not None:
+                    orientation = exif_data.get(orientation_tag)
+                    if orientation == 3: img = img.rotate(180, expand=True)
+                    elif orientation == 6: img = img.rotate(270, expand=True)
+                    elif orientation == 8: img = img.rotate(90, expand=True)
+        except Exception: pass
+        img.thumbnail(THUMB_SIZE, Image.Resampling.LANCZOS)
+        img_mode = img.mode
+        if img_mode == 'RGBA' or (img_mode == 'P' and 'transparency' in img.info) or img_mode == 'LA':
+            if img_mode != 'RGBA': img = img.convert('RGBA')
+            img.save(thumb_path, format='PNG', optimize=True)
+        else:
+            if img_mode != 'RGB': img = img.convert('RGB')
+            img.save(thumb_path, format='JPEG', quality=85, optimize=True, progressive=True)
+    return True
+
+
+def engine_thumbnail(original_path, thumb_path, file_ext):
+    from database_modules import media_module
+    return media_module.generate_thumbnail(original_path, thumb_path, file_ext)
+
+
+PATHS = {'legacy': legacy_thumbnail, 'engine': engine_thumbnail}
+
+
+def photo(size, seed):
+    """Photo-like content: smooth gradients plus noise (compresses like a real photo)."""
+    base = Image.radial_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 12 + seed)
+    return Image.merge('RGB', (base, noise, ImageChops.invert(base)))
+
+
+def build_corpus(directory):
+    samples = []
+    def add(name, img, **save_kwargs):
+        path = os.path.join(directory, name)
+        img.save(path, **save_kwargs)
+        samples.append(path)
+    add('photo_24mp.jpg', photo((6000, 4000), 1), quality=90)
+    exif = Image.Exif(); exif[0x0112] = 6
+    add('portrait_exif6_12mp.jpg', photo((4000, 3000), 2), quality=90, exif=exif)
+    add('phone_800.jpg', photo((800, 600), 3), quality=85)
+    rgba = photo((2000, 2000), 4).convert('RGBA'); rgba.putalpha(Image.linear_gradient('L').resize((2000, 2000)))
+    add('alpha_4mp.png', rgba, optimize=False)
+    add('photo_6mp.webp', photo((3000, 2000), 5), quality=85)
+    frames = [photo((800, 600), i).convert('P') for i in range(30)]
+    add('animated_30f.gif', frames[0], save_all=True, append_images=frames[1:], duration=40)
+    return samples
+
+
+def peak_rss_kb():
+    """Peak RSS of this process. ru_maxrss survives exec on Linux, VmHWM does not."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_path(name, samples, repeat, out_dir, queue):
+    func = PATHS[name]
+    if name == 'engine':
+        from database_modules import media_module # Import cost is not part of the measurement
+        media_module.write_variants = lambda *args, **kwargs: [] # The legacy path has no variants
+    baseline = peak_rss_kb()
+    results = {}
+    for path in samples:
+        ext = os.path.splitext(path)[1].lower()
+        thumb = os.path.join(out_dir, f'{name}_{os.path.basename(path)}.thumb')
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(path, thumb, ext)
+            timings.append(time.perf_counter() - start)
+        results[path] = (min(timings) * 1000, thumb)
+    queue.put((results, baseline, peak_rss_kb()))
+
+
+def measure(name, samples, repeat, out_dir):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_path, args=(name, samples, repeat, out_dir, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def difference(a_path, b_path):
+    with Image.open(a_path) as a, Image.open(b_path) as b:
+        if a.size != b.size:
+            return f'size {a.size} vs {b.size}'
+        diff = ImageChops.difference(a.convert('RGB'), b.convert('RGB'))
+        return f'{sum(ImageStat.Stat(diff).mean) / 3:.2f}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--corpus', help='directory with sample images (default: generate a synthetic corpus)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per image (the fastest is reported)')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.corpus:
+            samples = sorted(os.path.join(args.corpus, f) for f in os.listdir(args.corpus) if f.lower().endswith(EXTENSIONS))
+        else:
+            samples = build_corpus(work_dir)
+        measured = {name: measure(name, samples, args.repeat, work_dir) for name in PATHS}
+        print(f"{'image':<26}{'legacy ms':>11}{'engine ms':>11}{'speedup':>9}{'mean |diff|':>13}")
+        for path in samples:
+            old_ms, old_thumb = measured['legacy'][0][path]
+            new_ms, new_thumb = measured['engine'][0][path]
+            print(f'{os.path.basename(path):<26}{old_ms:>11.1f}{new_ms:>11.1f}{old_ms / new_ms:>8.1f}x{difference(old_thumb, new_thumb):>13}')
+        for name, (_, baseline, peak) in measured.items():
+            print(f'{name}: peak RSS {peak / 1024:.0f} MB (after imports {baseline / 1024:.0f} MB, +{(peak - baseline) / 1024:.0f} MB for thumbnailing)')
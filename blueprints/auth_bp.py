@@ -5,7 +5,7 @@ from flask import (
     request, redirect, send_from_directory, flash, url_for
 )
 # Используем обновленные модули
-from database_modules import database_module, language_module, moderation_module
+from database_modules import database_module, language_module, moderation_module, upload_module, ratelimit_module, captcha_module
 import os
 import logging # Добавляем логирование
 
@@ -102,17 +102,12 @@ def register():
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
         captcha_input = request.form.get('captcha', '').strip()
-        session_captcha = session.get('captcha_text') # Получаем правильный ответ из сессии
+        # Правильный ответ формы из сессии; он одноразовый, новую капчу форма загрузит после редиректа
+        session_captcha = captcha_module.take_answer(session, request.form.get('captcha_id', ''))
 
         # Валидация капчи ДО запроса к БД
         if not database_module.validate_captcha(captcha_input, session_captcha):
             flash('Invalid captcha code.', 'error')
-            # Генерируем новую капчу для следующей попытки
-            captcha_text_new, captcha_image_new = database_module.generate_captcha()
-            session['captcha_text'] = captcha_text_new
-            # Передаем НОВУЮ капчу в шаблон регистрационной страницы при редиректе?
-            # Или просто редирект и пусть GET-маршрут /registrar генерирует новую?
-            # Проще просто редирект назад:
             return redirect(request.referrer or url_for('boards.register'))
 
         # Пытаемся зарегистрировать пользователя
@@ -197,7 +192,7 @@ def create_board():
         name = request.form.get('name', '').strip()
         description = request.form.get('description', '').strip()
         captcha_input = request.form.get('captcha', '').strip()
-        session_captcha = session.get('captcha_text')
+        session_captcha = captcha_module.take_answer(session, request.form.get('captcha_id', ''))
         current_user = session['username']
 
         # Валидация капчи
@@ -249,6 +244,71 @@ def apply_general_captcha():
     return redirect(request.referrer or url_for('boards.main_page'))
 
 
+@auth_bp.route('/set_board_preview_replies/<board_uri>', methods=['POST'])
+def set_board_preview_replies(board_uri):
+    """Меняет количество последних ответов под тредом на странице доски (владелец доски/владелец сайта/модератор)."""
+    if 'username' not in session:
+        flash('You must be logged in.', 'warning')
+        return redirect(request.referrer or url_for('boards.main_page'))
+
+    current_user = session["username"]
+    user_role = database_module.get_user_role(current_user)
+    board_info = database_module.get_board_info(board_uri)
+    if not board_info:
+        flash(f'Board /{board_uri}/ does not exist.', 'error')
+        return redirect(request.referrer or url_for('boards.main_page'))
+
+    # Проверка прав
+    is_admin = user_role and ('owner' in user_role.lower() or 'mod' in user_role.lower())
+    if board_info['board_owner'] != current_user and not is_admin:
+        flash('You do not have permission to change this board.', 'error')
+        return redirect(request.referrer or url_for('boards.main_page'))
+
+    count = request.form.get('preview_replies', type=int)
+    if count is not None and database_module.set_board_preview_replies(board_uri, count):
+        flash(f'Board /{board_uri}/ now shows the last {count} replies per thread.', 'success')
+        logger.info(f"User '{current_user}' set preview replies of '/{board_uri}/' to {count}.")
+    else:
+        flash(f'Invalid value. Use a number from 0 to {database_module.MAX_PREVIEW_REPLIES}.', 'warning')
+    return redirect(request.referrer or url_for('boards.main_page'))
+
+
+@auth_bp.route('/set_board_rate_limits/<board_uri>', methods=['POST'])
+def set_board_rate_limits(board_uri):
+    """Меняет лимиты частоты постинга доски (владелец доски/владелец сайта/модератор)."""
+    if 'username' not in session:
+        flash('You must be logged in.', 'warning')
+        return redirect(request.referrer or url_for('boards.main_page'))
+
+    current_user = session["username"]
+    user_role = database_module.get_user_role(current_user)
+    board_info = database_module.get_board_info(board_uri)
+    if not board_info:
+        flash(f'Board /{board_uri}/ does not exist.', 'error')
+        return redirect(request.referrer or url_for('boards.main_page'))
+
+    # Проверка прав
+    is_admin = user_role and ('owner' in user_role.lower() or 'mod' in user_role.lower())
+    if board_info['board_owner'] != current_user and not is_admin:
+        flash('You do not have permission to change this board.', 'error')
+        return redirect(request.referrer or url_for('boards.main_page'))
+
+    # "N per S seconds" для каждого действия; объем загрузок задается в мегабайтах
+    limits = {}
+    for action, scale in (('thread', 1), ('reply', 1), ('upload_bytes', ratelimit_module.MB)):
+        capacity = request.form.get(f'{action}_capacity', type=float)
+        per_seconds = request.form.get(f'{action}_per_seconds', type=float)
+        if capacity is None or per_seconds is None:
+            continue
+        limits[action] = (capacity * scale, per_seconds)
+    if limits and ratelimit_module.rate_limiter.set_board_limits(board_uri, limits):
+        flash(f'Posting limits of /{board_uri}/ updated.', 'success')
+        logger.info(f"User '{current_user}' set posting limits of '/{board_uri}/' to {limits}.")
+    else:
+        flash('Invalid limits. Use positive numbers.', 'warning')
+    return redirect(request.referrer or url_for('boards.main_page'))
+
+
 @auth_bp.route('/lock_thread/<post_id>', methods=['POST'])
 def lock_thread(post_id):
     """Блокирует/разблокирует тред."""
@@ -361,7 +421,9 @@ def upload_banner():
         flash('No file selected for upload.', 'warning')
         return redirect(request.referrer or url_for('boards.board_banners', board_uri=board_uri))
 
-    if file and allowed_file(file.filename):
+    if upload_module.rejection(file):
+        flash(f'{upload_module.rejection(file)} ({file.filename})', 'warning')
+    elif file and allowed_file(file.filename):
         # Формируем путь для сохранения
         # Используем относительный путь от корня проекта
         directory = os.path.join('.', 'static', 'imgs', 'banners', board_uri)
@@ -563,6 +625,7 @@ def ban_user_generic():
     content_id_str = request.form.get('content_id')
     ban_duration_str = request.form.get('ban_duration') # Например, "86400" или "0" (для Perm)
     ban_reason = request.form.get('ban_reason', 'No reason provided.').strip()
+    ban_range = request.form.get('ban_range', 'exact') # 'exact', 'subnet' (/24, /64) or 'wide' (/16, /48)
     # ban_scope_board_uri = request.form.get('ban_scope_board_uri', 'all_boards') # Пока не используем
 
     # Валидация content_id
@@ -593,6 +656,8 @@ def ban_user_generic():
         flash('Could not find the user IP associated with this content to ban.', 'error')
         logger.warning(f"Could not find IP for content_id {content_id} to ban.")
         return redirect(request.referrer or url_for('boards.main_page'))
+    # Range ban around the poster's address (stored as CIDR in the bans table)
+    user_ip_to_ban = moderation_module.ban_range_for(user_ip_to_ban, ban_range)
 
     # --- Определение длительности бана ---
     duration_seconds = None # По умолчанию - перманентный
@@ -1,14 +1,22 @@
 # --- START OF FILE boards_bp.py ---
 
 # imports
-from flask import current_app, Blueprint, render_template, session, redirect, request, url_for, flash
+from flask import current_app, Blueprint, render_template, session, redirect, request, url_for, flash, jsonify, make_response
 from database_modules import database_module
 from database_modules import language_module
 from database_modules import moderation_module
 from database_modules import formatting # <--- Прямой импорт formatting
+from database_modules import cache_module
+from database_modules import captcha_module
+from database_modules import fragment_module
+from database_modules import media_module
+from database_modules import media_gc_module
+from database_modules import live_module
+from database_modules import ratelimit_module
+from database_modules import recent_module
+from database_modules import row_module
 import logging
 import json
-import re # Для Regex
 from datetime import datetime, timezone
 
 # Configure logging
@@ -28,7 +36,7 @@ def inject_lang():
 @boards_bp.context_processor
 def globalboards():
     try:
-        boards_list = database_module.get_all_boards(include_stats=True)
+        boards_list = cache_module.cached_context('boards', lambda: database_module.get_all_boards(include_stats=True))
         return {"boards": boards_list or []}
     except Exception as e:
         logger.error(f"Error loading global boards: {e}", exc_info=True)
@@ -38,7 +46,8 @@ def globalboards():
 @boards_bp.context_processor
 def customthemes():
     try:
-        custom_themes_list = database_module.get_custom_themes()
+        custom_themes_list = cache_module.cached_context('themes', database_module.get_custom_themes,
+                                                        version=database_module.get_custom_themes_version())
         return {"custom_themes": custom_themes_list or []}
     except Exception as e:
         logger.error(f"Error loading custom themes: {e}", exc_info=True)
@@ -47,22 +56,64 @@ def customthemes():
 # Context processor for reply counts
 @boards_bp.context_processor
 def inject_reply_counts():
-    reply_counts = {}
     try:
-        sql = """
-            SELECT p.board_uri, COUNT(r.id) as reply_count
-            FROM replies r
-            JOIN posts p ON r.post_id = p.post_id
-            GROUP BY p.board_uri
-        """
-        results = database_module.execute_query(sql)
-        if results:
-            reply_counts = {row['board_uri']: row['reply_count'] for row in results}
+        reply_counts = cache_module.cached_context('reply_counts', database_module.get_board_reply_counts)
         return {"reply_counts": reply_counts}
     except Exception as e:
         logger.error(f"Failed to calculate reply counts: {e}", exc_info=True)
         return {"reply_counts": {}}
 
+# Every rendered captcha form gets its own challenge id (hidden captcha_id field + ?id= on the image)
+@boards_bp.app_template_global()
+def new_captcha_id():
+    return captcha_module.new_challenge_id()
+
+# captcha image, loaded lazily by forms that need it; the answer is kept under the form's challenge id
+@boards_bp.route('/captcha.png')
+def captcha_image():
+    challenge_id = request.args.get('id', '')
+    if not captcha_module.valid_challenge_id(challenge_id):
+        return make_response('Invalid captcha id', 400)
+    captcha_text, captcha_png = captcha_module.take_captcha()
+    captcha_module.remember_answer(session, challenge_id, captcha_text)
+    response = make_response(captcha_png)
+    response.headers['Content-Type'] = 'image/png'
+    response.headers['Cache-Control'] = 'no-store, max-age=0'
+    return response
+
+# context cache statistics (moderators only)
+@boards_bp.route('/api/cache_stats')
+def cache_stats():
+    roles = database_module.get_user_role(session['username']) if 'username' in session else None
+    if not roles or not ('owner' in roles.lower() or 'mod' in roles.lower()):
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(cache_module.get_stats())
+
+@boards_bp.route('/api/media_stats')
+def media_stats():
+    roles = database_module.get_user_role(session['username']) if 'username' in session else None
+    if not roles or not ('owner' in roles.lower() or 'mod' in roles.lower()):
+        return jsonify({"error": "forbidden"}), 403
+    stats = {'thumbnails': media_module.media_queue.stats(), 'gc': media_gc_module.media_gc.stats()}
+    if request.args.get('scan') == '1':
+        #report-only pass over the upload folders; nothing is queued.
+        stats['scan'] = media_gc_module.scan_orphans(current_app.static_folder)
+    return jsonify(stats)
+
+@boards_bp.route('/api/live_stats')
+def live_stats():
+    roles = database_module.get_user_role(session['username']) if 'username' in session else None
+    if not roles or not ('owner' in roles.lower() or 'mod' in roles.lower()):
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(live_module.live_rooms.stats())
+
+@boards_bp.route('/api/ratelimit_stats')
+def ratelimit_stats():
+    roles = database_module.get_user_role(session['username']) if 'username' in session else None
+    if not roles or not ('owner' in roles.lower() or 'mod' in roles.lower()):
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(ratelimit_module.rate_limiter.stats())
+
 # error handling.
 @boards_bp.errorhandler(404)
 def page_not_found(e):
@@ -87,7 +138,7 @@ def internal_server_error(e):
 # --- так как HTML уже приходит из БД. Она только добавляет списки файлов, даты и backlinks ---
 def format_content_for_template_pass_through_html(content_list, backlinks_map=None):
     """
-    Deserializes files, formats dates, and adds backlink info.
+    Deserializes files, adds backlink info and fills the cached date/files fragments.
     Assumes content (post_content/content) from DB is already HTML formatted.
     """
     formatted_list = []
@@ -95,29 +146,23 @@ def format_content_for_template_pass_through_html(content_list, backlinks_map=No
 
     # print(f"[DEBUG_BOARDS_BP format_content_pass_through] Processing {len(content_list)} items. Backlinks_map provided: {backlinks_map is not None}")
     for item_row in content_list:
-        item_dict = dict(item_row)
+        item_dict = row_module.as_item(item_row) # View rows (row_module) are filled in place, other rows are copied
         # item_id_for_debug = item_dict.get('post_id') or item_dict.get('reply_id') # Для отладки
 
         image_key = 'post_images' if 'post_images' in item_dict else 'images'
         thumb_key = 'imagesthb'
-        date_key = 'post_date'
 
         item_dict[f'{image_key}_list'] = database_module._deserialize_files(item_dict.get(image_key))
         item_dict[f'{thumb_key}_list'] = database_module._deserialize_files(item_dict.get(thumb_key))
-
-        dt_obj = database_module.parse_datetime(item_dict.get(date_key))
-        item_dict['date_display'] = database_module.format_datetime_for_display(dt_obj)
+        item_dict['thumb_sources'] = media_module.thumb_sources(item_dict.get('thumb_variants'))
+        # date_display и files_html заполняются ниже из кеша фрагментов (fragment_module)
 
         # HTML контент (post_content для OP, content для ответов) уже должен быть в item_dict из БД
         # и он уже отформатирован. Ничего дополнительно с ним делать не нужно.
 
         if backlinks_map:
-            item_id_for_backlink_lookup = None
-            is_op_post = 'original_content' in item_dict # Признак OP (или post_id есть, а reply_id нет)
-            if is_op_post:
-                 item_id_for_backlink_lookup = item_dict.get('post_id')
-            else: # Это ответ
-                 item_id_for_backlink_lookup = item_dict.get('reply_id')
+            # OP or reply is told by reply_id: projected views may leave out original_content
+            item_id_for_backlink_lookup = fragment_module.item_kind_and_id(item_dict)[1]
             
             if item_id_for_backlink_lookup is not None:
                 item_dict['answered_by'] = backlinks_map.get(item_id_for_backlink_lookup, [])
@@ -129,85 +174,29 @@ def format_content_for_template_pass_through_html(content_list, backlinks_map=No
             item_dict['answered_by'] = []
         
         formatted_list.append(item_dict)
-    return formatted_list
+    return fragment_module.apply_fragments(formatted_list)
 # --- КОНЕЦ НОВОЙ ФУНКЦИИ ФОРМАТИРОВАНИЯ ---
 
 
+# Lists that show the first thumbnail directly (catalog, last posts) need the job states
+# of every item, not only of items whose files fragment was just rendered.
+def _with_thumb_states(items):
+    states = media_module.get_thumb_states([fragment_module.item_kind_and_id(item)[1] for item in items])
+    for item in items:
+        item['thumb_states'] = states.get(fragment_module.item_kind_and_id(item)[1])
+    return items
+
+
 # --- Вспомогательная функция для подготовки контента с backlinks ---
 def _prepare_page_content(posts_raw, pinneds_raw, replies_raw):
-    # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Entered. Posts: {len(posts_raw)}, Pinneds: {len(pinneds_raw)}, Replies: {len(replies_raw)}")
-    backlinks = {}
-    
-    all_items_for_backlinks_raw = []
-    if posts_raw: all_items_for_backlinks_raw.extend(posts_raw)
-    if pinneds_raw: all_items_for_backlinks_raw.extend(pinneds_raw)
-    if replies_raw: all_items_for_backlinks_raw.extend(replies_raw)
-    # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Total items for backlink scan: {len(all_items_for_backlinks_raw)}")
-
-    for item_row in all_items_for_backlinks_raw:
-        item = dict(item_row)
-        
-        is_op_post = 'original_content' in item
-        current_item_id = item.get('post_id') if is_op_post else item.get('reply_id')
-        
-        # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Processing item: keys={list(item.keys())}, IsOPPost: {is_op_post}, CurrentItemID: {current_item_id}")
-
-        if not current_item_id:
-            # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Item skipped, no valid ID found")
-            continue
-
-        # --- ПОЛУЧАЕМ ТЕКСТ ДЛЯ ПАРСИНГА ---
-        # Для OP-постов: если есть 'post_content' (HTML), используем его. Иначе 'original_content' (сырой).
-        # Для Ответов: используем 'content' (который уже HTML).
-        text_to_scan_for_refs = ""
-        use_html_parser = False # Флаг, какой regex использовать
-
-        if is_op_post:
-            if item.get('post_content'): # Предполагаем, что это HTML
-                text_to_scan_for_refs = item.get('post_content', '')
-                use_html_parser = True
-                # print(f"[DEBUG_BOARDS_BP _prepare_page_content] OP Post {current_item_id} using 'post_content' (HTML) for ref scan.")
-            else: 
-                text_to_scan_for_refs = item.get('original_content', '')
-                # print(f"[DEBUG_BOARDS_BP _prepare_page_content] OP Post {current_item_id} using 'original_content' (RAW) for ref scan.")
-        else: # Это ответ
-            text_to_scan_for_refs = item.get('content', '') # Это уже HTML
-            use_html_parser = True
-            # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Reply {current_item_id} using 'content' (HTML) for ref scan.")
-        
-        # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Scanning item ID {current_item_id}. Text for refs: '{str(text_to_scan_for_refs)[:150]}...' UseHTMLParser: {use_html_parser}")
+    # Backlinks come from the quote index (post_quotes), filled when a post is created.
+    # Only quoting items shown on this page are listed, in page order.
+    op_rows = list(posts_raw or []) + list(pinneds_raw or [])
+    reply_rows = list(replies_raw or [])
+    item_ids = [row['post_id'] for row in op_rows] + [row['reply_id'] for row in reply_rows]
+    thread_ids = [row['post_id'] for row in op_rows] + [row['post_id'] for row in reply_rows]
+    backlinks = database_module.get_backlinks(thread_ids, item_ids)
 
-        if not text_to_scan_for_refs:
-            # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Item ID {current_item_id} has no suitable text for refs.")
-            continue
-            
-        quoted_ids_matches = []
-        if use_html_parser:
-            # Ищем data-id в HTML
-            quoted_ids_matches = re.findall(r'data-id="(\d+)"', text_to_scan_for_refs)
-        else:
-            # Ищем >>ID в сыром тексте (для original_content у OP-постов, если post_content нет)
-            quoted_ids_matches = re.findall(r'>>(\d+)', text_to_scan_for_refs)
-        
-        if quoted_ids_matches:
-            # print(f"[DEBUG_BOARDS_BP _prepare_page_content] For item ID {current_item_id}, found quote ID strings: {quoted_ids_matches}")
-            
-            for quoted_id_str in quoted_ids_matches:
-                try:
-                    quoted_id = int(quoted_id_str)
-                    if quoted_id not in backlinks:
-                        backlinks[quoted_id] = []
-                    if current_item_id not in backlinks[quoted_id]:
-                        backlinks[quoted_id].append(current_item_id)
-                        # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Added backlink: item {current_item_id} replies to item {quoted_id}")
-                except ValueError:
-                    # print(f"[DEBUG_BOARDS_BP _prepare_page_content] ValueError: Could not convert quote ID '{quoted_id_str}' to int for item {current_item_id}")
-                    continue
-        # else:
-            # print(f"[DEBUG_BOARDS_BP _prepare_page_content] No quote matches found for item ID {current_item_id}.")
-            
-    # print(f"[DEBUG_BOARDS_BP _prepare_page_content] Final backlinks map: {backlinks}")
-    
     # Используем новую функцию форматирования, которая НЕ вызывает formatting.format_comment
     formatted_posts = format_content_for_template_pass_through_html(posts_raw, backlinks)
     formatted_pinneds = format_content_for_template_pass_through_html(pinneds_raw, backlinks)
@@ -221,10 +210,9 @@ def _prepare_page_content(posts_raw, pinneds_raw, replies_raw):
 def main_page():
     try:
         recent_posts_count = 6
-        all_ops_raw = database_module.get_all_posts_simple(sort_by_date=True)
-        recent_ops_raw = all_ops_raw[:recent_posts_count] if all_ops_raw else []
+        recent_ops_raw = recent_module.recent_threads.get(recent_posts_count)
         # Для главной страницы backlinks не нужны, и HTML уже должен быть в post_content
-        recent_posts = format_content_for_template_pass_through_html(recent_ops_raw, None)
+        recent_posts = _with_thumb_states(format_content_for_template_pass_through_html(recent_ops_raw, None))
         return render_template('index.html', posts=recent_posts)
     except Exception as e:
         logger.error(f"Error on main page: {e}", exc_info=True)
@@ -253,10 +241,11 @@ def login():
 
             user_boards_raw = database_module.get_user_boards(username)
             user_boards = [dict(board) for board in user_boards_raw] if user_boards_raw else []
+            for board in user_boards:
+                board['rate_limits'] = ratelimit_module.rate_limiter.limits_for(board['board_uri'])
 
-            all_posts_list_raw = database_module.get_all_posts_simple(sort_by_date=True)
-            total_posts_count = len(all_posts_list_raw) if all_posts_list_raw else 0
-            recent_dashboard_posts_raw = all_posts_list_raw[:10]
+            total_posts_count = database_module.get_total_thread_count()
+            recent_dashboard_posts_raw = recent_module.recent_threads.get(10)
             
             # Для дашборда backlinks не нужны, HTML уже должен быть в post_content
             recent_dashboard_posts_formatted = format_content_for_template_pass_through_html(recent_dashboard_posts_raw, None)
@@ -297,9 +286,7 @@ def login():
 def register():
     if 'username' in session: return redirect(url_for('boards.login'))
     try:
-        captcha_text, captcha_image = database_module.generate_captcha()
-        session['captcha_text'] = captcha_text
-        return render_template('register.html', captcha_image=captcha_image)
+        return render_template('register.html')
     except Exception as e: logger.error(f"Error generating CAPTCHA for registration: {e}", exc_info=True); return render_template('errors/500.html', error_message="Could not load registration page."), 500
 
 @boards_bp.route('/create')
@@ -308,9 +295,7 @@ def create():
     user_role = database_module.get_user_role(session["username"])
     if not user_role or 'owner' not in user_role.lower(): flash("Only the site owner can create new boards.", "error"); return redirect(url_for('boards.login'))
     try:
-        captcha_text, captcha_image = database_module.generate_captcha()
-        session['captcha_text'] = captcha_text
-        return render_template('board-create.html', captcha_image=captcha_image)
+        return render_template('board-create.html')
     except Exception as e: logger.error(f"Error generating CAPTCHA for board creation: {e}", exc_info=True); return render_template('errors/500.html', error_message="Could not load board creation page."), 500
 
 @boards_bp.route('/pages/globalrules.html')
@@ -331,16 +316,28 @@ def board_page(board_uri):
         posts_per_page = 6
         offset = (page - 1) * posts_per_page
 
+        # total_pages comes from the maintained board counters, not a COUNT query
         total_non_pinned_posts = database_module.get_board_thread_count(board_uri, include_pinned=False)
         total_pages = max(1, (total_non_pinned_posts + posts_per_page - 1) // posts_per_page if posts_per_page > 0 else 1)
         if page > total_pages : page = total_pages; offset = (page - 1) * posts_per_page
 
-        posts_raw = database_module.get_posts_for_board(board_uri, offset=offset, limit=posts_per_page)
+        # Prev/next links carry a keyset cursor; numbered links fall back to OFFSET
+        after = database_module.decode_page_cursor(request.args.get('after'))
+        before = database_module.decode_page_cursor(request.args.get('before')) if not after else None
+        posts_raw = []
+        if after or before:
+            posts_raw = database_module.get_posts_for_board(board_uri, limit=posts_per_page, after=after, before=before)
+        if not posts_raw: # No cursor, or it points past the edge of the board
+            posts_raw = database_module.get_posts_for_board(board_uri, offset=offset, limit=posts_per_page)
+        next_cursor = database_module.encode_page_cursor(posts_raw[-1]) if posts_raw and page < total_pages else None
+        prev_cursor = database_module.encode_page_cursor(posts_raw[0]) if posts_raw and page > 1 else None
         pinneds_raw = database_module.get_pinned_posts(board_uri)
         board_banner = database_module.get_board_banner(board_uri)
 
+        # Only the last N replies per thread are loaded; reply_totals gives the omitted count
+        preview_replies = database_module.get_board_preview_replies(board_info)
         all_visible_op_ids = [p['post_id'] for p in posts_raw] + [p['post_id'] for p in pinneds_raw]
-        replies_for_ops_raw = database_module.get_replies_for_posts(all_visible_op_ids) if all_visible_op_ids else []
+        replies_for_ops_raw, reply_totals = database_module.get_reply_previews(all_visible_op_ids, preview_replies)
         
         formatted_posts, formatted_pinneds, formatted_replies_for_template = _prepare_page_content(
             posts_raw, pinneds_raw, replies_for_ops_raw
@@ -348,13 +345,12 @@ def board_page(board_uri):
 
         roles = session.get('role', 'none')
         if roles == 'none' and 'username' in session: roles = database_module.get_user_role(session["username"]) or 'none'
-        captcha_text, captcha_image = database_module.generate_captcha()
-        session['captcha_text'] = captcha_text
 
         return render_template(
-            'board.html', board_info=board_info, captcha_image=captcha_image, roles=roles, page=page,
-            posts_per_page=posts_per_page, total_pages=total_pages,
+            'board.html', board_info=board_info, roles=roles, page=page,
+            posts_per_page=posts_per_page, total_pages=total_pages, next_cursor=next_cursor, prev_cursor=prev_cursor,
             pinneds=formatted_pinneds, posts=formatted_posts, replies=formatted_replies_for_template,
+            reply_totals=reply_totals, preview_replies=preview_replies,
             board_banner=board_banner, board_id=board_uri,
         )
     except Exception as e:
@@ -374,22 +370,22 @@ def board_catalog(board_uri):
         pinneds_raw = database_module.get_pinned_posts(board_uri)
         board_banner = database_module.get_board_banner(board_uri)
         
+        # The catalog shows only reply counts, so reply rows are not loaded
         all_catalog_op_ids = [p['post_id'] for p in posts_raw] + [p['post_id'] for p in pinneds_raw]
-        replies_for_catalog_ops_raw = database_module.get_replies_for_posts(all_catalog_op_ids) if all_catalog_op_ids else []
+        reply_totals = database_module.get_reply_counts(all_catalog_op_ids)
         
         formatted_posts, formatted_pinneds, formatted_replies_for_catalog = _prepare_page_content(
-            posts_raw, pinneds_raw, replies_for_catalog_ops_raw
+            posts_raw, pinneds_raw, []
         )
+        _with_thumb_states(formatted_posts + formatted_pinneds)
         
         roles = session.get('role', 'none')
         if roles == 'none' and 'username' in session: roles = database_module.get_user_role(session["username"]) or 'none'
-        captcha_text, captcha_image = database_module.generate_captcha()
-        session['captcha_text'] = captcha_text
 
         return render_template(
-            'catalog.html', board_info=board_info, captcha_image=captcha_image, roles=roles,
+            'catalog.html', board_info=board_info, roles=roles,
             pinneds=formatted_pinneds, posts=formatted_posts, replies=formatted_replies_for_catalog,
-            board_banner=board_banner, board_id=board_uri
+            reply_totals=reply_totals, board_banner=board_banner, board_id=board_uri
         )
     except Exception as e:
         logger.error(f"Error loading catalog for board /{board_uri}/: {e}", exc_info=True)
@@ -440,12 +436,10 @@ def replies(board_name, thread_id):
 
         roles = session.get('role', 'none')
         if roles == 'none' and 'username' in session: roles = database_module.get_user_role(session["username"]) or 'none'
-        captcha_text, captcha_image = database_module.generate_captcha()
-        session['captcha_text'] = captcha_text
 
         return render_template(
             'thread_reply.html',
-            captcha_image=captcha_image, board_info=board_info,
+            board_info=board_info,
             posts=[formatted_op_dict],
             replies=formatted_thread_replies,
             board_id=board_name, thread_id=thread_id_int,
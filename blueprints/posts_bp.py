@@ -1,19 +1,17 @@
 from flask import current_app, Blueprint, render_template, redirect, request, flash, session, url_for
 # Use the updated database and moderation modules
-from database_modules import database_module, moderation_module, formatting
+from database_modules import database_module, moderation_module, captcha_module, formatting, fragment_module, media_module, media_store_module, upload_module, live_module, ratelimit_module
 from flask_socketio import SocketIO, emit
 # Import datetime and timezone
 from datetime import datetime, timezone
-from PIL import Image, ImageSequence, UnidentifiedImageError # Убедимся, что Image импортирован
+from PIL import Image, UnidentifiedImageError # Убедимся, что Image импортирован
 import cv2
 import re
 import os
-import time
+import math
 import shutil
 import logging # Use logging
 from werkzeug.utils import secure_filename # Useful for sanitizing original filenames
-import random
-import string
 
 # Configure logging
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s') # Usually configured in main app
@@ -24,9 +22,6 @@ posts_bp = Blueprint('posts', __name__, template_folder='../templates', static_f
 # SocketIO instance will be retrieved from current_app later
 
 # --- Constants ---
-THUMB_SIZE = (250, 250)
-# Relative path to placeholder MP3 thumbnail within the static folder
-MP3_THUMB_REL_PATH = 'play.jpg'
 # Allowed file extensions (lowercase)
 ALLOWED_EXTENSIONS = {'.jpeg', '.jpg', '.mov', '.gif', '.png', '.webp', '.webm', '.mp4', '.mp3'}
 # Define upload folders relative to the static directory base
@@ -36,6 +31,7 @@ MAX_COMMENT_LENGTH = 20000 # Example limit
 WEBP_CONVERT_FILENAME = "image.png" # Имя файла для конвертации в WebP
 WEBP_QUALITY = 90
 WEBP_METHOD = 4
+PASSCODE = "passcode" # Replies with this embed value skip the reply rate limit
 
 
 # --- Helper Functions ---
@@ -49,8 +45,16 @@ def get_static_file_abs_path(relative_path):
         logger.warning("Cannot get current_app context for static folder. Assuming 'static' directory.")
         return os.path.join('static', relative_path)
 
-# Get absolute path for MP3 placeholder
-MP3_THUMB_ABS_PATH = get_static_file_abs_path(MP3_THUMB_REL_PATH)
+def uploaded_bytes():
+    """Size of the files received with this request (counted by UploadSpool while the body streamed in)."""
+    total = 0
+    for file_storage in request.files.getlist('fileInput'):
+        spool = upload_module.spool_of(file_storage)
+        if spool is not None:
+            if spool.rejected is None: total += spool.size
+        elif file_storage.filename:
+            return request.content_length or 0 # Parsed by the standard Request: the body size is the best estimate
+    return total
 
 # --- Post Handler Class ---
 class PostHandler:
@@ -101,6 +105,17 @@ class PostHandler:
             flash("An error occurred while checking posting timeout. Please try again later.", "error")
             return False
 
+    def check_rate_limit(self, action, upload_bytes=0):
+        """Takes tokens from the (IP, board, action) and upload-bytes buckets; flashes the wait time when empty."""
+        limiter = ratelimit_module.rate_limiter
+        allowed, retry_after = limiter.acquire(self.user_ip, self.board_id, action)
+        if allowed and upload_bytes:
+            allowed, retry_after = limiter.acquire(self.user_ip, self.board_id, 'upload_bytes', upload_bytes)
+            if not allowed: limiter.release(self.user_ip, self.board_id, action)
+        if not allowed:
+            flash(f"Please wait {max(1, math.ceil(retry_after))} seconds before posting again.", "warning")
+        return allowed
+
     def validate_comment(self):
         if len(self.original_content) > MAX_COMMENT_LENGTH:
             flash(f"Your comment is too long (max {MAX_COMMENT_LENGTH} characters).", "error")
@@ -109,87 +124,41 @@ class PostHandler:
 
 
     def generate_thumbnail(self, original_path, thumb_path, file_ext):
-        # ... (код generate_thumbnail без изменений) ...
+        """Generates a thumbnail inside the request (MP3 placeholder, or fallback when the media queue is unavailable)."""
         try:
             logger.info(f"Generating thumbnail for {original_path} -> {thumb_path}")
-            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
-
-            if file_ext in ['.jpeg', '.jpg', '.png', '.webp']:
-                with Image.open(original_path) as img:
-                    try:
-                        for orientation_tag in Image.ExifTags.TAGS.keys():
-                            if Image.ExifTags.TAGS[orientation_tag] == 'Orientation': break
-                        else: orientation_tag = None
-                        if orientation_tag:
-                            exif_data = img._getexif()
-                            if exif_data is not None:
-                                orientation = exif_data.get(orientation_tag)
-                                if orientation == 3: img = img.rotate(180, expand=True)
-                                elif orientation == 6: img = img.rotate(270, expand=True)
-                                elif orientation == 8: img = img.rotate(90, expand=True)
-                    except: pass
-                    img.thumbnail(THUMB_SIZE, Image.Resampling.LANCZOS)
-                    save_format = 'JPEG'; quality = 85; img_mode = img.mode
-                    has_transparency = (img_mode == 'RGBA' or (img_mode == 'P' and 'transparency' in img.info) or (img_mode == 'LA'))
-                    if has_transparency:
-                        save_format = 'PNG'; quality = None
-                        if img_mode != 'RGBA': img = img.convert('RGBA')
-                    else:
-                        if img_mode != 'RGB': img = img.convert('RGB')
-                    save_kwargs = {'format': save_format}
-                    if quality: save_kwargs['quality'] = quality
-                    if save_format == 'PNG': save_kwargs['optimize'] = True
-                    if save_format == 'JPEG': save_kwargs['optimize'] = True; save_kwargs['progressive'] = True
-                    img.save(thumb_path, **save_kwargs)
-                return True
-            elif file_ext == '.gif':
-                 try:
-                     with Image.open(original_path) as img:
-                        frames = [frame.copy() for frame in ImageSequence.Iterator(img)]
-                        if not frames: raise ValueError("No frames found in GIF")
-                        first_frame = frames[0]
-                        first_frame.thumbnail(THUMB_SIZE, Image.Resampling.LANCZOS)
-                        if first_frame.mode != 'RGBA': first_frame = first_frame.convert('RGBA')
-                        first_frame.save(thumb_path, format='PNG', optimize=True)
-                        return True
-                 except Exception as gif_err: logger.error(f"Error processing GIF {original_path}: {gif_err}", exc_info=True); return False
-            elif file_ext in ['.mp4', '.mov', '.webm']:
-                 return self.capture_frame_from_video(original_path, thumb_path)
-            elif file_ext == '.mp3':
-                if not os.path.exists(MP3_THUMB_ABS_PATH): return False
-                shutil.copy2(MP3_THUMB_ABS_PATH, thumb_path)
-                return True
+            return media_module.generate_thumbnail(original_path, thumb_path, file_ext)
         except UnidentifiedImageError: flash(f"Could not process image file '{os.path.basename(original_path)}'.", "error"); return False
         except cv2.error as e: flash(f"Could not process video file '{os.path.basename(original_path)}'.", "error"); return False
-        except Exception as e: flash(f"An unexpected error occurred while processing file '{os.path.basename(original_path)}'.", "error"); return False
-        logger.warning(f"Thumbnail generation not implemented for extension: {file_ext}"); return False
+        except Exception as e:
+            logger.error(f"Error generating thumbnail for {original_path}: {e}", exc_info=True)
+            flash(f"An unexpected error occurred while processing file '{os.path.basename(original_path)}'.", "error"); return False
 
 
-    def capture_frame_from_video(self, video_path, thumb_path):
-        # ... (код capture_frame_from_video без изменений) ...
-        cap = None
-        try:
-            cap = cv2.VideoCapture(video_path)
-            if not cap.isOpened(): return False
-            fps = cap.get(cv2.CAP_PROP_FPS); total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            target_frame_idx = int(fps) if fps and fps > 0 and total_frames > fps else 0
-            cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame_idx); ret, frame = cap.read()
-            if not ret:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, 0); ret, frame = cap.read()
-                if not ret: return False
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB); pil_image = Image.fromarray(frame_rgb)
-            pil_image.thumbnail(THUMB_SIZE, Image.Resampling.LANCZOS)
-            pil_image.save(thumb_path, format='JPEG', quality=85, optimize=True, progressive=True)
-            return True
-        except Exception as e: logger.error(f"Error capturing video frame for {video_path}: {e}", exc_info=True); return False
-        finally:
-            if cap: cap.release()
+    def queue_thumbnails(self, item_kind, item_id, thread_id, processed_files):
+        """Queues thumbnail jobs for a saved post/reply. Returns True if any thumbnail is still pending."""
+        pending_files = [f for f in processed_files if f.get('pending')]
+        if not pending_files: return False
+        jobs = list(dict.fromkeys((f['original_rel'], f['thumbnail'], f['ext']) for f in pending_files)) # Same content twice -> one job
+        if media_module.media_queue.enqueue(item_kind, item_id, self.board_id, thread_id, jobs): return True
+        # Queue is unavailable: fall back to generating thumbnails in the request
+        static_folder_abs = get_static_file_abs_path('')
+        for f_info in pending_files:
+            f_info['pending'] = False
+            self.generate_thumbnail(os.path.join(static_folder_abs, f_info['original_rel']), os.path.join(static_folder_abs, f_info['thumbnail']), f_info['ext'])
+        return False
 
 
     def process_uploaded_files(self, upload_folder_rel, is_thread=False):
         files = request.files.getlist('fileInput')
         processed_files_info = []
 
+        # Bounded media queue: reject uploads instead of letting thumbnail work pile up
+        upload_count = sum(1 for file_storage in files if file_storage.filename != '')
+        if upload_count and not media_module.media_queue.has_capacity(upload_count):
+            flash("Media processing is busy right now, please try again in a moment.", "warning")
+            return None
+
         static_folder_abs = get_static_file_abs_path('')
         original_folder_abs = os.path.join(static_folder_abs, upload_folder_rel)
         thumb_folder_abs = os.path.join(original_folder_abs, 'thumbs')
@@ -210,6 +179,14 @@ class PostHandler:
             filename_base, file_ext_original = os.path.splitext(original_filename_unsafe)
             file_ext_original_lower = file_ext_original.lower()
 
+            # Streamed uploads were already sniffed, size/resolution-checked and hashed while the body was parsed
+            spool = upload_module.spool_of(file_storage)
+            if spool is not None:
+                if spool.rejected:
+                    flash(f"{spool.rejected} ('{original_filename_unsafe}')", "warning")
+                    continue
+                file_ext_original_lower = spool.ext # The type comes from the content, not the name
+
             should_convert_to_webp = False
             if original_filename_unsafe.lower() == WEBP_CONVERT_FILENAME.lower() and file_ext_original_lower == '.png':
                 should_convert_to_webp = True
@@ -222,12 +199,6 @@ class PostHandler:
                 flash(f"File type '{file_ext_original_lower}' is not allowed for file '{original_filename_unsafe}'.", "warning")
                 continue
 
-            timestamp_ms = int(time.time() * 1000)
-            unique_filename_base = str(timestamp_ms) + ''.join(random.choices(string.ascii_lowercase + string.digits, k=2))
-            
-            new_filename = f"{unique_filename_base}{current_file_ext}"
-            original_save_path = os.path.join(original_folder_abs, new_filename)
-
             thumb_ext_for_gen = '.jpg'
             # Если оригинал WebP (или конвертирован в WebP) и мы хотим WebP миниатюру с прозрачностью:
             if current_file_ext == '.webp': 
@@ -235,58 +206,80 @@ class PostHandler:
             elif current_file_ext == '.mp3': thumb_ext_for_gen = '.jpg'
             elif current_file_ext == '.gif': thumb_ext_for_gen = '.png' # Статичная PNG миниатюра для GIF
             elif current_file_ext == '.png': thumb_ext_for_gen = '.png' # PNG миниатюра для PNG
-            
-
-            thumb_filename = f"thumb_{unique_filename_base}{thumb_ext_for_gen}"
-            thumb_save_path = os.path.join(thumb_folder_abs, thumb_filename)
 
+            new_filename = None; tmp_path = None; original_rel = None; is_new_object = False
             try:
-                if should_convert_to_webp:
-                    img = Image.open(file_storage.stream)
-                    
-                    # --- ИЗМЕНЕНИЕ ДЛЯ СОХРАНЕНИЯ ПРОЗРАЧНОСТИ ---
-                    # Убедимся, что изображение в режиме с поддержкой альфа-канала, если он есть
-                    if img.mode not in ('RGBA', 'LA') and 'transparency' in img.info:
-                        img = img.convert('RGBA') # Конвертируем в RGBA для сохранения альфа
-                    
-                    # Сохраняем в WebP с параметром lossless=True для сохранения прозрачности
-                    # Это создаст WebP без потерь, который хорошо сжимает графику с прозрачностью.
-                    # Файл может быть больше, чем WebP с потерями.
-                    img.save(original_save_path, 'WEBP', quality=WEBP_QUALITY, method=WEBP_METHOD)
-                    # Параметр quality для lossless=True обычно интерпретируется как усилие сжатия (0-100, где 100 - макс. сжатие/мин. размер).
-                    # Method также влияет на баланс размер/скорость.
-                    
-                    # Альтернатива: WebP с потерями И альфа-каналом (если нужно меньший размер ценой некоторого качества)
-                    # Для этого Pillow должен быть собран с libwebp, поддерживающей alpha_quality.
-                    # if img.mode != 'RGBA':
-                    #    img = img.convert('RGBA') # Убедимся, что есть альфа-канал для сохранения
-                    # img.save(original_save_path, 'WEBP', quality=WEBP_QUALITY, method=WEBP_METHOD, alpha_quality=90)
-                    # alpha_quality (0-100) - качество сжатия альфа-канала.
-                    # --- КОНЕЦ ИЗМЕНЕНИЯ ДЛЯ СОХРАНЕНИЯ ПРОЗРАЧНОСТИ ---
-                    
-                    logger.info(f"Converted '{original_filename_unsafe}' and saved as WebP (lossless): {original_save_path}")
+                # The content hash names the original and its thumbnail
+                if spool is not None:
+                    sha256, file_size, tmp_path = spool.sha256, spool.size, spool.detach_file()
                 else:
-                    file_storage.save(original_save_path)
+                    sha256, file_size, tmp_path = media_store_module.store_stream(file_storage.stream, original_folder_abs)
+                content_name = media_store_module.content_name(sha256)
+                new_filename = f"{content_name}{current_file_ext}"
+                original_save_path = os.path.join(original_folder_abs, new_filename)
+                thumb_filename = f"thumb_{content_name}{thumb_ext_for_gen}"
+                thumb_save_path = os.path.join(thumb_folder_abs, thumb_filename)
+                original_rel = os.path.join(upload_folder_rel, new_filename).replace('\\', '/')
+                thumb_relative_path = os.path.join(upload_folder_rel, 'thumbs', thumb_filename).replace('\\', '/')
+                known = media_store_module.register_object(original_rel, sha256, thumb_relative_path, file_size)
+                is_new_object = not known
+
+                if known and os.path.isfile(original_save_path):
+                    os.remove(tmp_path)
+                    logger.info(f"Reusing stored file {original_rel} for '{original_filename_unsafe}'.")
+                elif should_convert_to_webp:
+                    with Image.open(tmp_path) as img:
+                        # --- ИЗМЕНЕНИЕ ДЛЯ СОХРАНЕНИЯ ПРОЗРАЧНОСТИ ---
+                        # Убедимся, что изображение в режиме с поддержкой альфа-канала, если он есть
+                        if img.mode not in ('RGBA', 'LA') and 'transparency' in img.info:
+                            img = img.convert('RGBA') # Конвертируем в RGBA для сохранения альфа
+                        # Сохраняем в WebP; quality и method задают баланс размер/скорость.
+                        # Пишем во временный файл: готовый оригинал может уже отдаваться другим постам.
+                        img.save(tmp_path + '.webp', 'WEBP', quality=WEBP_QUALITY, method=WEBP_METHOD)
+                    shutil.move(tmp_path + '.webp', original_save_path)
+                    os.remove(tmp_path)
+                    logger.info(f"Converted '{original_filename_unsafe}' and saved as WebP: {original_save_path}")
+                else:
+                    shutil.move(tmp_path, original_save_path) # A rename unless staging is on another filesystem
                     logger.info(f"Saved original file: {original_save_path}")
-
-                # Генерация миниатюры
-                # file_ext для generate_thumbnail теперь current_file_ext (может быть .webp)
-                if self.generate_thumbnail(original_save_path, thumb_save_path, current_file_ext):
-                    thumb_relative_path = os.path.join(upload_folder_rel, 'thumbs', thumb_filename).replace('\\', '/')
-                    processed_files_info.append({
-                        'original': new_filename,
-                        'thumbnail': thumb_relative_path
-                    })
+                tmp_path = None
+
+                # Генерация миниатюры: изображения и видео - в очереди media_module после сохранения поста
+                variants = []
+                if known and os.path.isfile(thumb_save_path):
+                    pending = False # Same content was uploaded before: reuse its thumbnail
+                    variants = media_module.existing_variants(thumb_save_path)
+                elif current_file_ext in media_module.WORKER_EXTENSIONS:
+                    if spool is None and not media_module.probe_upload(original_save_path, current_file_ext):
+                        flash(f"Could not process image file '{original_filename_unsafe}'.", "error")
+                        if is_new_object: media_store_module.discard_object(original_rel, static_folder_abs)
+                        continue
+                    pending = True
+                elif self.generate_thumbnail(original_save_path, thumb_save_path, current_file_ext):
+                    pending = False
                 else:
                     logger.warning(f"Thumbnail generation failed for {new_filename}. Removing original file.")
-                    if os.path.exists(original_save_path): os.remove(original_save_path)
+                    if is_new_object: media_store_module.discard_object(original_rel, static_folder_abs)
+                    continue
+                processed_files_info.append({
+                    'original': new_filename,
+                    'thumbnail': thumb_relative_path,
+                    'original_rel': original_rel,
+                    'ext': current_file_ext,
+                    'pending': pending,
+                    'variants': variants
+                })
 
             except Exception as e:
                 logger.error(f"Error saving or processing file {original_filename_unsafe} as {new_filename}: {e}", exc_info=True)
                 flash(f"Error processing file: {original_filename_unsafe}", "error")
-                if os.path.exists(original_save_path):
-                    try: os.remove(original_save_path)
-                    except OSError as rm_err: logger.error(f"Failed to cleanup partially saved file {original_save_path}: {rm_err}")
+                for leftover_path in (tmp_path, tmp_path and tmp_path + '.webp'):
+                    if leftover_path and os.path.exists(leftover_path):
+                        try: os.remove(leftover_path)
+                        except OSError as rm_err: logger.error(f"Failed to cleanup partially saved file {leftover_path}: {rm_err}")
+                if is_new_object:
+                    try: media_store_module.discard_object(original_rel, static_folder_abs)
+                    except Exception as discard_err: logger.error(f"Failed to discard stored file {original_rel}: {discard_err}")
 
         if not self.comment and not processed_files_info:
              logger.warning("Post attempt with no comment and no successfully processed files.")
@@ -301,34 +294,35 @@ class PostHandler:
         if not database_module.check_replyto_exist(tid): flash("This thread doesn't exist!", "error"); return None
         if database_module.verify_locked_thread(tid): flash("This thread is locked.", "error"); return None
         if database_module.verify_board_captcha(self.board_id):
-            session_captcha = session.get('captcha_text')
+            session_captcha = captcha_module.take_answer(session, request.form.get('captcha_id', ''))
             if not session_captcha: flash("CAPTCHA session expired. Please refresh.", "warning"); return None
             if not database_module.validate_captcha(self.captcha_input, session_captcha): flash("Invalid captcha.", "error"); return None
         processed_files = self.process_uploaded_files(REPLY_IMAGE_FOLDER_REL, is_thread=False)
         if processed_files is None: return None
         if not self.comment and not processed_files: flash("You need to type something or successfully upload a file for a reply.", "error"); return None
         original_filenames = [f['original'] for f in processed_files]; thumbnail_rel_paths = [f['thumbnail'] for f in processed_files]
-        new_reply_id = database_module.add_new_reply(self.user_ip, tid, self.post_name, self.comment, self.embed, original_filenames, thumbnail_rel_paths)
+        thumb_variants = {f['thumbnail']: f['variants'] for f in processed_files if f['variants']} # Reused thumbnails; new ones are recorded by the media queue
+        new_reply_id = database_module.add_new_reply(self.user_ip, tid, self.post_name, self.comment, self.embed, original_filenames, thumbnail_rel_paths, thumb_variants)
         if new_reply_id:
+            if not self.queue_thumbnails('reply', new_reply_id, tid, processed_files):
+                fragment_module.prerender('reply', new_reply_id) # Render the immutable files/date fragment at write time
             try:
                 socket_files_data = []
                 for f_info in processed_files:
                     orig_url = url_for('static', filename=os.path.join(REPLY_IMAGE_FOLDER_REL, f_info['original'])).replace('\\', '/')
                     thumb_url = url_for('static', filename=f_info['thumbnail']).replace('\\', '/')
-                    socket_files_data.append({'original': orig_url, 'thumbnail': thumb_url})
+                    socket_files_data.append({'original': orig_url, 'thumbnail': thumb_url, 'pending': f_info['pending']})
                 now_utc = datetime.now(timezone.utc); now_display = database_module.format_datetime_for_display(now_utc)
                 display_name = database_module.generate_tripcode(self.post_name)
-                self.socketio.emit('nova_postagem', {'type': 'New Reply','post': {'id': new_reply_id, 'reply_id': new_reply_id, 'thread_id': tid,'name': display_name, 'content': self.comment, 'files_data': socket_files_data, 'date': now_display,'board': self.board_id}})
+                # Only sockets on this board's pages and in this thread receive the event
+                live_module.live_rooms.emit('nova_postagem', {'type': 'New Reply','post': {'id': new_reply_id, 'reply_id': new_reply_id, 'thread_id': tid,'name': display_name, 'content': self.comment, 'files_data': socket_files_data, 'date': now_display,'board': self.board_id}}, self.board_id, tid)
             except Exception as socket_err: logger.error(f"Failed to emit SocketIO event for reply {new_reply_id}: {socket_err}", exc_info=True)
-            PASSCODE = "passcode"
-            if self.embed != PASSCODE: self.timeout_manager.apply_timeout(self.user_ip, duration_seconds=35, reason="Automatic timeout after reply.")
-            else: logger.info(f"Timeout skipped for IP {self.user_ip} due to passcode in reply {new_reply_id}.")
             return new_reply_id
         else: flash("Failed to save reply to the database.", "error"); return None
 
     def handle_post(self):
         if database_module.verify_board_captcha(self.board_id):
-            session_captcha = session.get('captcha_text')
+            session_captcha = captcha_module.take_answer(session, request.form.get('captcha_id', ''))
             if not session_captcha: flash("CAPTCHA session expired. Please refresh.", "warning"); return None
             if not database_module.validate_captcha(self.captcha_input, session_captcha): flash("Invalid captcha.", "error"); return None
         processed_files = self.process_uploaded_files(POST_IMAGE_FOLDER_REL, is_thread=True)
@@ -336,19 +330,21 @@ class PostHandler:
         if not processed_files: flash("You need to successfully upload at least one file to start a thread.", "error"); return None
         if not self.comment and not processed_files: flash("You need to type something or upload a file.", "error"); return None
         original_filenames = [f['original'] for f in processed_files]; thumbnail_rel_paths = [f['thumbnail'] for f in processed_files]
-        new_post_id = database_module.add_new_post(self.user_ip, self.board_id, self.post_name, self.original_content, self.comment, self.embed, original_filenames, thumbnail_rel_paths)
+        thumb_variants = {f['thumbnail']: f['variants'] for f in processed_files if f['variants']} # Reused thumbnails; new ones are recorded by the media queue
+        new_post_id = database_module.add_new_post(self.user_ip, self.board_id, self.post_name, self.original_content, self.comment, self.embed, original_filenames, thumbnail_rel_paths, thumb_variants)
         if new_post_id:
+            if not self.queue_thumbnails('post', new_post_id, new_post_id, processed_files):
+                fragment_module.prerender('post', new_post_id) # Render the immutable files/date fragment at write time
             try:
                 socket_files_data = []
                 for f_info in processed_files:
                     orig_url = url_for('static', filename=os.path.join(POST_IMAGE_FOLDER_REL, f_info['original'])).replace('\\', '/')
                     thumb_url = url_for('static', filename=f_info['thumbnail']).replace('\\', '/')
-                    socket_files_data.append({'original': orig_url, 'thumbnail': thumb_url})
+                    socket_files_data.append({'original': orig_url, 'thumbnail': thumb_url, 'pending': f_info['pending']})
                 now_utc = datetime.now(timezone.utc); now_display = database_module.format_datetime_for_display(now_utc)
                 display_name = database_module.generate_tripcode(self.post_name)
-                self.socketio.emit('nova_postagem', {'type': 'New Thread', 'post': {'id': new_post_id, 'post_id': new_post_id, 'name': display_name, 'content': self.comment, 'files_data': socket_files_data, 'date': now_display, 'board': self.board_id}})
+                live_module.live_rooms.emit('nova_postagem', {'type': 'New Thread', 'post': {'id': new_post_id, 'post_id': new_post_id, 'name': display_name, 'content': self.comment, 'files_data': socket_files_data, 'date': now_display, 'board': self.board_id}}, self.board_id)
             except Exception as socket_err: logger.error(f"Failed to emit SocketIO event for post {new_post_id}: {socket_err}", exc_info=True)
-            self.timeout_manager.apply_timeout(self.user_ip, duration_seconds=35, reason="Automatic timeout after post.")
             return new_post_id
         else: flash("Failed to save post to the database.", "error"); return None
 
@@ -388,11 +384,24 @@ def new_post():
             handler = PostHandler(socketio, user_ip, post_mode_form, post_name_raw, board_id, cleaned_comment, embed, captcha_input)
             if not handler.validate_comment(): return redirect(request.referrer or url_for('boards.board_page', board_uri=board_id))
         else: flash(f"Cannot reply to post '{reply_match.group(0)}'.", "warning")
+    if is_reply_mode and reply_to_thread_id:
+        # The reply buckets are keyed by board, so the thread must be on the board the form names
+        thread_board = database_module.get_thread_board(reply_to_thread_id)
+        if not thread_board: flash("This thread doesn't exist!", "error"); return redirect(request.referrer or url_for('boards.board_page', board_uri=board_id))
+        if thread_board != board_id: flash(f"This thread is not on /{board_id}/.", "error"); return redirect(request.referrer or url_for('boards.board_page', board_uri=board_id))
+    rate_action = 'reply' if is_reply_mode else 'thread'
+    rate_limited = not (is_reply_mode and embed == PASSCODE)
+    upload_size = uploaded_bytes()
+    if rate_limited and not handler.check_rate_limit(rate_action, upload_size):
+        return redirect(request.referrer or url_for('boards.board_page', board_uri=board_id))
     posted_id = None
     if is_reply_mode:
         if reply_to_thread_id: posted_id = handler.handle_reply(reply_to_thread_id)
         else: flash("Internal error: Could not determine thread ID for reply.", "error")
     else: posted_id = handler.handle_post()
+    if not posted_id and rate_limited: # Only saved posts count against the limits
+        ratelimit_module.rate_limiter.release(user_ip, board_id, rate_action)
+        if upload_size: ratelimit_module.rate_limiter.release(user_ip, board_id, 'upload_bytes', upload_size)
     if posted_id:
         flash(f"Post successful! ID: {posted_id}", "success")
         if is_reply_mode and reply_to_thread_id:
@@ -0,0 +1,151 @@
+"""
+Кеш данных для контекстных процессоров шаблонов (список досок, счетчики ответов, темы).
+Два уровня: память запроса (flask.g) - контекстные процессоры вызываются при каждом
+render_template - и общий TTL-кеш процесса с отдельным временем жизни для каждого ключа.
+Записи сбрасываются при изменении постов, досок и тем (см. invalidate_*).
+"""
+
+import os
+import time
+import threading
+import logging
+
+try: # Модуль используется и вне Flask (database_setup.py, скрипты)
+    from flask import g, has_app_context
+except ImportError:
+    g = None
+    def has_app_context(): return False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 30.0 # секунды
+
+# Время жизни ключей; переменная окружения PEJCHAN_CACHE_TTL_<KEY> переопределяет значение
+CONTEXT_TTLS = {
+    'boards': 30.0,
+    'reply_counts': 30.0,
+    'themes': 300.0,
+}
+for _key in CONTEXT_TTLS:
+    _env_value = os.environ.get(f'PEJCHAN_CACHE_TTL_{_key.upper()}')
+    if _env_value:
+        try: CONTEXT_TTLS[_key] = float(_env_value)
+        except ValueError: logger.warning(f"Неверное значение TTL для '{_key}': {_env_value}")
+
+BOARD_DATA_KEYS = ('boards', 'reply_counts')
+
+_MISSING = object()
+
+
+class _Entry:
+    __slots__ = ('value', 'expires_at', 'version')
+
+    def __init__(self, value, expires_at, version):
+        self.value = value
+        self.expires_at = expires_at
+        self.version = version
+
+
+class TTLCache:
+    """Потокобезопасный кеш с временем жизни на ключ и статистикой попаданий."""
+
+    def __init__(self, ttls=None, default_ttl=DEFAULT_TTL):
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generations = {} # Счетчик сбросов ключа: результат загрузки, начатой до сброса, не сохраняется
+        self._stats = {}
+
+    def _key_stats(self, key):
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        return stats
+
+    def get_or_load(self, key, loader, ttl=None, version=None):
+        """
+        Возвращает значение ключа или вызывает loader().
+        version - признак актуальности (например, mtime папки): при несовпадении запись считается устаревшей.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now and entry.version == version:
+                self._key_stats(key)['hits'] += 1
+                return entry.value
+            self._key_stats(key)['misses'] += 1
+            generation = self._generations.get(key, 0)
+        value = loader()
+        ttl = self.ttls.get(key, self.default_ttl) if ttl is None else ttl
+        with self._lock:
+            if ttl > 0 and self._generations.get(key, 0) == generation:
+                self._entries[key] = _Entry(value, time.monotonic() + ttl, version)
+        return value
+
+    def invalidate(self, *keys):
+        """Сбрасывает указанные ключи (без аргументов - весь кеш)."""
+        with self._lock:
+            for key in keys or list(self._entries):
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self._key_stats(key)['invalidations'] += 1
+
+    def stats(self):
+        """Статистика по ключам с долей попаданий."""
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for key, stats in self._stats.items():
+                total = stats['hits'] + stats['misses']
+                entry = self._entries.get(key)
+                result[key] = dict(stats,
+                                   hit_rate=round(stats['hits'] / total, 4) if total else 0.0,
+                                   ttl=self.ttls.get(key, self.default_ttl),
+                                   cached=entry is not None and entry.expires_at > now,
+                                   expires_in=round(entry.expires_at - now, 2) if entry is not None else None)
+            return result
+
+
+context_cache = TTLCache(CONTEXT_TTLS)
+_request_stats = {'hits': 0, 'misses': 0}
+_request_stats_lock = threading.Lock()
+
+
+def cached_context(key, loader, version=None):
+    """Значение для контекстного процессора: сначала память запроса, затем TTL-кеш."""
+    if not has_app_context():
+        return context_cache.get_or_load(key, loader, version=version)
+    memo = g.setdefault('_context_cache', {})
+    value = memo.get(key, _MISSING)
+    with _request_stats_lock:
+        _request_stats['hits' if value is not _MISSING else 'misses'] += 1
+    if value is _MISSING:
+        value = memo[key] = context_cache.get_or_load(key, loader, version=version)
+    return value
+
+def invalidate_board_data():
+    """Вызывается после записи постов, ответов и изменений досок."""
+    context_cache.invalidate(*BOARD_DATA_KEYS)
+    if has_app_context():
+        memo = g.get('_context_cache')
+        if memo:
+            for key in BOARD_DATA_KEYS: memo.pop(key, None)
+
+def invalidate_themes():
+    context_cache.invalidate('themes')
+    if has_app_context():
+        memo = g.get('_context_cache')
+        if memo: memo.pop('themes', None)
+
+def get_stats():
+    """Статистика для эндпоинта /api/cache_stats."""
+    with _request_stats_lock:
+        request_stats = dict(_request_stats)
+    total = request_stats['hits'] + request_stats['misses']
+    request_stats['hit_rate'] = round(request_stats['hits'] / total, 4) if total else 0.0
+    return {'request': request_stats, 'keys': context_cache.stats(), 'pid': os.getpid()}
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
@@ -0,0 +1,153 @@
+"""
+Пул заранее сгенерированных CAPTCHA.
+Фоновый поток держит в очереди готовые пары (текст, PNG); страница получает картинку
+отдельным запросом (/captcha.png) и только если на доске включена капча.
+Каждая пара выдается один раз.
+
+Одна страница может содержать несколько форм с капчей (например, форма ответа в треде
+сверху и снизу). Каждая отрисованная форма получает свой идентификатор вызова
+(new_challenge_id); картинка запрашивается как /captcha.png?id=<идентификатор>, а ответ
+хранится в сессии под этим идентификатором (remember_answer). Последние MAX_OUTSTANDING
+ответов действительны одновременно, поэтому загрузка второй картинки не портит первую.
+"""
+
+import os
+import random
+import secrets
+import string
+import threading
+import logging
+from collections import deque
+
+from captcha.image import ImageCaptcha
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.environ.get('PEJCHAN_CAPTCHA_POOL_SIZE', 64)) # Готовых капч в очереди
+REFILL_THRESHOLD = max(1, POOL_SIZE // 2) # Будим фоновый поток, когда очередь опустела наполовину
+CAPTCHA_LENGTH = 6
+CAPTCHA_ALPHABET = string.ascii_uppercase + string.digits
+MAX_OUTSTANDING = 8 # Ответов в сессии одновременно (формы открытых страниц и вкладок)
+SESSION_KEY = 'captcha_answers' # Список [идентификатор, ответ], старые первыми
+MAX_CHALLENGE_ID_LENGTH = 32
+
+
+class CaptchaPool:
+    """Очередь готовых капч с фоновым пополнением."""
+
+    def __init__(self, size=POOL_SIZE, refill_threshold=REFILL_THRESHOLD):
+        self.size = max(1, size)
+        self.refill_threshold = min(refill_threshold, self.size)
+        self._lock = threading.Lock()
+        self._generate_lock = threading.Lock() # ImageCaptcha кеширует шрифты, не делим его между потоками без блокировки
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._image = None
+        self._stats = {'served': 0, 'generated': 0, 'sync_generated': 0}
+
+    def _check_fork(self):
+        """После fork поток-пополнитель родителя в дочернем процессе не работает."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset_state()
+
+    def _generate(self):
+        text = ''.join(random.choices(CAPTCHA_ALPHABET, k=CAPTCHA_LENGTH))
+        with self._generate_lock:
+            if self._image is None:
+                self._image = ImageCaptcha()
+            png = self._image.generate(text).getvalue()
+        return text, png
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='captcha-pool', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while len(self._queue) < self.size:
+                try:
+                    challenge = self._generate()
+                except Exception as e:
+                    logger.error(f"Ошибка фоновой генерации CAPTCHA: {e}", exc_info=True)
+                    break
+                with self._lock:
+                    self._queue.append(challenge)
+                    self._stats['generated'] += 1
+
+    def take(self):
+        """Возвращает (текст, PNG bytes). При пустой очереди генерирует синхронно."""
+        self._check_fork()
+        self._ensure_worker()
+        with self._lock:
+            challenge = self._queue.popleft() if self._queue else None
+            remaining = len(self._queue)
+            self._stats['served'] += 1
+        if remaining < self.refill_threshold:
+            self._wakeup.set()
+        if challenge is None:
+            challenge = self._generate()
+            with self._lock:
+                self._stats['sync_generated'] += 1
+        return challenge
+
+    def init_app(self, app):
+        """Регистрирует пул и сразу начинает его заполнять: первой странице с капчей не придется ждать."""
+        app.extensions['captcha_pool'] = self
+        self.warm_up()
+
+    def warm_up(self):
+        """Запускает заполнение очереди заранее (init_app при старте приложения)."""
+        self._check_fork()
+        self._ensure_worker()
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, queued=len(self._queue), size=self.size)
+
+
+captcha_pool = CaptchaPool()
+
+def take_captcha():
+    return captcha_pool.take()
+
+
+# --- Ответы в сессии ---
+def new_challenge_id():
+    """Идентификатор вызова для одной отрисованной формы."""
+    return secrets.token_urlsafe(9)
+
+def valid_challenge_id(challenge_id):
+    return isinstance(challenge_id, str) and 0 < len(challenge_id) <= MAX_CHALLENGE_ID_LENGTH
+
+def remember_answer(session, challenge_id, text):
+    """Сохраняет ответ картинки формы challenge_id (повторная загрузка картинки заменяет его)."""
+    answers = [pair for pair in session.get(SESSION_KEY, []) if pair[0] != challenge_id]
+    answers.append([challenge_id, text])
+    session[SESSION_KEY] = answers[-MAX_OUTSTANDING:]
+
+def take_answer(session, challenge_id):
+    """Извлекает ответ формы challenge_id; ответ одноразовый. None - вызов неизвестен или устарел."""
+    answers = session.get(SESSION_KEY, [])
+    for index, (stored_id, text) in enumerate(answers):
+        if stored_id == challenge_id:
+            session[SESSION_KEY] = answers[:index] + answers[index + 1:]
+            return text
+    return None
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
@@ -0,0 +1,229 @@
+"""
+Менеджер соединений SQLite для имиджборда.
+Держит пул готовых соединений, привязывает соединение к текущему потоку/гринлету
+на время работы с ним и один раз настраивает PRAGMA для каждого нового соединения.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+try: # При запуске под gevent у каждого гринлета свое соединение
+    from greenlet import getcurrent as _get_current_greenlet
+except ImportError:
+    _get_current_greenlet = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 16 # Максимум одновременно открытых соединений
+DEFAULT_MAX_IDLE = 8 # Сколько свободных соединений держим в пуле
+DEFAULT_ACQUIRE_TIMEOUT = 10.0 # Секунды ожидания свободного соединения
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0 # Проверяем простаивающее соединение не чаще этого интервала
+
+
+def _current_owner():
+    """Ключ владельца соединения: гринлет (если есть) или поток."""
+    if _get_current_greenlet is not None:
+        return id(_get_current_greenlet())
+    return threading.get_ident()
+
+
+class _PooledConnection:
+    """Соединение из пула и служебные данные о нем."""
+    __slots__ = ('conn', 'created_at', 'last_used', 'depth')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.depth = 0 # Глубина вложенных блоков connection()
+
+
+class ConnectionManager:
+    """
+    Пул соединений SQLite.
+
+    Использование:
+        with manager.connection() as conn:
+            conn.execute(...)
+
+    Вложенные блоки connection() в одном потоке/гринлете получают одно и то же
+    соединение, поэтому многошаговые операции (remove_post, remove_board)
+    выполняются на одном соединении.
+    """
+
+    def __init__(self, database_path, init_pragmas=None, on_connect=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_idle=DEFAULT_MAX_IDLE,
+                 acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+        self.database_path = database_path
+        self.init_pragmas = list(init_pragmas or [])
+        self.on_connect = on_connect # Дополнительная настройка нового соединения (callable(conn))
+        self.max_connections = max(1, int(max_connections))
+        self.max_idle = max(0, min(int(max_idle), self.max_connections))
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._in_use = {} # owner -> _PooledConnection
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._stats = {'created': 0, 'reused': 0, 'closed': 0, 'health_check_failures': 0, 'timeouts': 0}
+
+    def _check_fork(self):
+        """После fork (gunicorn) соединения родителя использовать нельзя."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    logger.info("Обнаружен fork процесса, пул соединений SQLite сброшен.")
+                    self._reset_state() # Соединения родителя просто забываем, не закрывая
+
+    def _connect(self):
+        """Открывает новое соединение и применяет стартовые PRAGMA."""
+        db_dir = os.path.dirname(self.database_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        conn = sqlite3.connect(
+            self.database_path,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False # Соединение переходит между потоками через пул, но используется одним владельцем
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in self.init_pragmas:
+            conn.execute(pragma)
+        if self.on_connect:
+            self.on_connect(conn)
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+    def _is_healthy(self, pooled):
+        """Проверяет простаивающее соединение перед повторной выдачей."""
+        if time.monotonic() - pooled.last_used < self.health_check_interval:
+            return True
+        try:
+            pooled.conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error as e:
+            logger.warning(f"Соединение из пула не прошло проверку и будет закрыто: {e}")
+            with self._lock:
+                self._stats['health_check_failures'] += 1
+            return False
+
+    def _close(self, pooled):
+        try:
+            pooled.conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка при закрытии соединения: {e}")
+        with self._lock:
+            self._stats['closed'] += 1
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise sqlite3.OperationalError("Не удалось получить соединение из пула: превышено время ожидания")
+        try:
+            while True:
+                with self._lock:
+                    pooled = self._idle.pop() if self._idle else None
+                if pooled is None:
+                    return _PooledConnection(self._connect())
+                if self._is_healthy(pooled):
+                    with self._lock:
+                        self._stats['reused'] += 1
+                    return pooled
+                self._close(pooled)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, pooled):
+        conn = pooled.conn
+        keep = True
+        try:
+            if conn.in_transaction:
+                conn.rollback() # Незавершенная транзакция не должна попасть к следующему владельцу
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось откатить транзакцию при возврате соединения в пул: {e}")
+            keep = False
+        pooled.last_used = time.monotonic()
+        with self._lock:
+            if keep and len(self._idle) < self.max_idle:
+                self._idle.append(pooled)
+                pooled = None
+        if pooled is not None:
+            self._close(pooled)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Выдает соединение текущему потоку/гринлету (повторно используя уже выданное)."""
+        self._check_fork()
+        owner = _current_owner()
+        with self._lock:
+            pooled = self._in_use.get(owner)
+        if pooled is None:
+            pooled = self._acquire()
+            with self._lock:
+                self._in_use[owner] = pooled
+        pooled.depth += 1
+        try:
+            yield pooled.conn
+        finally:
+            pooled.depth -= 1
+            if pooled.depth == 0:
+                with self._lock:
+                    self._in_use.pop(owner, None)
+                self._release(pooled)
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        """
+        Транзакция на соединении текущего владельца: COMMIT при успехе, ROLLBACK при исключении.
+        BEGIN IMMEDIATE сразу берет блокировку записи, поэтому чтение и запись внутри
+        транзакции не пересекаются с конкурентными писателями.
+        Вложенный вызов внутри уже открытой транзакции просто присоединяется к ней.
+        """
+        with self.connection() as conn:
+            if conn.in_transaction:
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    def new_connection(self):
+        """Отдельное соединение вне пула (для скриптов и фоновых задач); закрывает вызывающий."""
+        return self._connect()
+
+    def close_all(self):
+        """Закрывает все свободные соединения пула."""
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for pooled in idle:
+            self._close(pooled)
+
+    def stats(self):
+        """Статистика пула для диагностики."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(idle=len(self._idle), in_use=len(self._in_use),
+                         max_connections=self.max_connections, max_idle=self.max_idle)
+        return stats
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
@@ -14,8 +14,22 @@ import os
 import io
 import re
 import sqlite3 # Основной модуль для работы с SQLite
-from captcha.image import ImageCaptcha
+import threading
+import functools
 import logging # Для логирования
+from .connection_module import ConnectionManager # Пул соединений SQLite
+from . import storage_module # WAL и PRAGMA профиля хранения
+from . import stats_module # Счетчики досок, поддерживаемые триггерами
+from . import cache_module # Кеш данных контекстных процессоров
+from . import captcha_module # Пул готовых CAPTCHA
+from . import fragment_module # Кеш отрендеренных фрагментов постов
+from . import quote_module # Индекс цитат для обратных ссылок
+from . import media_module # Очередь обработки загруженных файлов
+from . import media_store_module # Хранилище файлов по содержимому (счетчики ссылок)
+from . import media_gc_module # Фоновое удаление файлов
+from . import ratelimit_module # Лимиты частоты постинга по доскам
+from . import recent_module # Последние поднятые треды в памяти
+from . import row_module # Проекции столбцов и строки со __slots__
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -55,27 +69,50 @@ POST_THUMB_ABS_PATH = os.path.join(POST_IMAGE_ABS_PATH, 'thumbs')
 # Папка для миниатюр ответов (абсолютный путь)
 REPLY_THUMB_ABS_PATH = os.path.join(REPLY_IMAGE_ABS_PATH, 'thumbs')
 
+# --- Пул соединений ---
+# PRAGMA выполняются один раз при открытии соединения, а не на каждый запрос.
+# Остальные настройки (WAL, synchronous, cache_size...) задает профиль из storage_module.
+DB_INIT_PRAGMAS = ["PRAGMA foreign_keys = ON;"]
+connection_manager = ConnectionManager(
+    DATABASE_PATH,
+    init_pragmas=DB_INIT_PRAGMAS,
+    on_connect=storage_module.connection_initializer(DATABASE_PATH),
+    max_connections=int(os.environ.get('PEJCHAN_DB_MAX_CONNECTIONS', 16)),
+    max_idle=int(os.environ.get('PEJCHAN_DB_MAX_IDLE', 8)),
+)
+
 # --- Функции ---
 
 def get_db_conn():
-    """Устанавливает соединение с базой данных SQLite."""
+    """Устанавливает отдельное соединение с базой данных SQLite (вызывающий должен закрыть его сам)."""
     try:
-        os.makedirs(DATABASE_DIR, exist_ok=True) # Убеждаемся, что папка instance существует
-        conn = sqlite3.connect(DATABASE_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA foreign_keys = ON;")
-        return conn
+        return connection_manager.new_connection()
     except sqlite3.Error as e:
         logger.error(f"Ошибка подключения к базе данных: {e}", exc_info=True)
         raise
 
+def db_transaction():
+    """
+    Транзакция записи (BEGIN IMMEDIATE) на соединении из пула:
+        with db_transaction() as conn:
+            ...  # COMMIT при выходе, ROLLBACK при исключении
+    """
+    return connection_manager.transaction()
+
+def db_connection():
+    """
+    Контекстный менеджер соединения из пула.
+    Вложенные вызовы в одном потоке/гринлете используют одно соединение:
+        with db_connection() as conn:
+            ...
+    """
+    return connection_manager.connection()
+
 def generate_captcha():
-    """Генерирует CAPTCHA."""
+    """Берет CAPTCHA из пула (captcha_module) и возвращает (текст, data URI)."""
     try:
-        captcha_text = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        image = ImageCaptcha()
-        captcha_image_data = image.generate(captcha_text) # Возвращает BytesIO с PNG данными
-        image_base64 = base64.b64encode(captcha_image_data.getvalue()).decode('utf-8')
+        captcha_text, captcha_png = captcha_module.take_captcha()
+        image_base64 = base64.b64encode(captcha_png).decode('utf-8')
         return captcha_text, f"data:image/png;base64,{image_base64}"
     except Exception as e:
         logger.error(f"Ошибка генерации CAPTCHA: {e}", exc_info=True)
@@ -158,32 +195,48 @@ def format_datetime_for_display(dt_obj, user_tz_str='Europe/Moscow'):
         except: # Если даже это не сработает
              return str(dt_obj) # Просто строка
 
-def execute_query(query, params=(), fetchone=False, fetchall=True, commit=False):
-    """Выполняет SQL-запрос и возвращает результат."""
-    conn = None
+def execute_query(query, params=(), fetchone=False, fetchall=True, commit=False, row_factory=None):
+    """
+    Выполняет SQL-запрос на соединении из пула и возвращает результат.
+    row_factory - фабрика строк курсора (например, View.row_factory); по умолчанию sqlite3.Row.
+    """
     try:
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        if commit:
-            conn.commit(); return cursor.lastrowid
-        if fetchone: return cursor.fetchone()
-        elif fetchall: return cursor.fetchall()
-        else: return None # Для запросов без fetch (например, UPDATE без интереса к rowcount)
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка запроса к базе данных: {e}\nЗапрос: {query}\nПараметры: {params}", exc_info=True)
-        if conn and commit:
-            try: conn.rollback()
-            except sqlite3.Error as rb_err: logger.error(f"Ошибка при откате транзакции: {rb_err}")
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            if row_factory is not None: cursor.row_factory = row_factory
+            try:
+                cursor.execute(query, params)
+                if commit:
+                    conn.commit(); return cursor.lastrowid
+                if fetchone: return cursor.fetchone()
+                elif fetchall: return cursor.fetchall()
+                else: return None # Для запросов без fetch (например, UPDATE без интереса к rowcount)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка запроса к базе данных: {e}\nЗапрос: {query}\nПараметры: {params}", exc_info=True)
+                if commit:
+                    try: conn.rollback()
+                    except sqlite3.Error as rb_err: logger.error(f"Ошибка при откате транзакции: {rb_err}")
+                return None
+            except Exception as e:
+                logger.error(f"Неожиданная ошибка при выполнении запроса: {e}", exc_info=True)
+                if commit:
+                    try: conn.rollback()
+                    except sqlite3.Error as rb_err: logger.error(f"Ошибка при откате транзакции: {rb_err}")
+                return None
+            finally:
+                cursor.close()
+    except sqlite3.Error as e: # Не удалось получить соединение из пула
+        logger.error(f"Ошибка подключения к базе данных: {e}", exc_info=True)
         return None
-    except Exception as e:
-         logger.error(f"Неожиданная ошибка при выполнении запроса: {e}", exc_info=True)
-         if conn and commit:
-             try: conn.rollback()
-             except sqlite3.Error as rb_err: logger.error(f"Ошибка при откате транзакции: {rb_err}")
-         return None
-    finally:
-        if conn: conn.close()
+
+# --- Кеш контекста шаблонов ---
+def _invalidates_board_cache(func):
+    """Сбрасывает кеш списка досок и счетчиков после операции записи (даже неудачной)."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try: return func(*args, **kwargs)
+        finally: cache_module.invalidate_board_data()
+    return wrapper
 
 # --- Board Operations ---
 def verify_board_captcha(board_uri):
@@ -191,13 +244,52 @@ def verify_board_captcha(board_uri):
     result = execute_query(sql, (board_uri,), fetchone=True)
     return result['enable_captcha'] == 1 if result else False
 
+@_invalidates_board_cache
 def set_all_boards_captcha(option):
     enable_value = 1 if option == 'enable' else 0
     sql = "UPDATE boards SET enable_captcha = ?"
     result = execute_query(sql, (enable_value,), commit=True, fetchall=False) # fetchall=False
     return result is not None # Успех, если не было ошибки
 
+DEFAULT_PREVIEW_REPLIES = 4 # Последних ответов под тредом на странице доски
+MAX_PREVIEW_REPLIES = 20
+
+def ensure_board_preview_replies(conn):
+    """Добавляет boards.preview_replies в существующую базу. True, если столбец был добавлен."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(boards)")}
+    if 'preview_replies' in columns: return False
+    conn.execute(f"ALTER TABLE boards ADD COLUMN preview_replies INTEGER NOT NULL DEFAULT {DEFAULT_PREVIEW_REPLIES}")
+    return True
+
+def ensure_thumb_variants_columns(conn):
+    """Добавляет thumb_variants в posts и replies (варианты миниатюр, media_module). True, если что-то добавлено."""
+    added = False
+    for table in ('posts', 'replies'):
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if 'thumb_variants' not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN thumb_variants TEXT")
+            added = True
+    return added
+
+def get_board_preview_replies(board_info):
+    """Размер превью ответов для доски (строка boards или dict)."""
+    try: value = int(board_info['preview_replies'])
+    except (KeyError, IndexError, TypeError, ValueError): return DEFAULT_PREVIEW_REPLIES
+    return max(0, min(value, MAX_PREVIEW_REPLIES))
+
+@_invalidates_board_cache
+def set_board_preview_replies(board_uri, count):
+    """Меняет размер превью ответов доски (0..MAX_PREVIEW_REPLIES)."""
+    try: value = int(count)
+    except (ValueError, TypeError): return False
+    if not 0 <= value <= MAX_PREVIEW_REPLIES: return False
+    _ensure_derived_schema()
+    sql = "UPDATE boards SET preview_replies = ? WHERE board_uri = ?"
+    result = execute_query(sql, (value, board_uri), commit=True, fetchall=False)
+    return result is not None
+
 def get_board_info(board_uri):
+    _ensure_derived_schema()
     sql = "SELECT * FROM boards WHERE board_uri = ?"
     return execute_query(sql, (board_uri,), fetchone=True)
 
@@ -214,62 +306,84 @@ def get_board_banner(board_uri):
     except OSError as e: logger.error(f"Ошибка чтения изображений в {banner_folder_abs}: {e}", exc_info=True); return default_banner
     except Exception as e: logger.error(f"Ошибка выбора случайного баннера: {e}", exc_info=True); return default_banner
 
+_derived_schema_ready = False
+_derived_schema_lock = threading.Lock()
+
+def _ensure_derived_schema():
+    """
+    Один раз на процесс создает производные структуры (последовательность номеров, счетчики досок,
+    флаг pinned у постов, настройка превью ответов, кеш фрагментов, индекс цитат, очередь медиа,
+    хранилище файлов),
+    если база еще не мигрирована database_setup.py.
+    """
+    global _derived_schema_ready
+    if _derived_schema_ready: return True
+    with _derived_schema_lock:
+        if _derived_schema_ready: return True
+        try:
+            with db_transaction() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS post_sequence (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                if not stats_module.board_stats_exist(conn):
+                    stats_module.create_board_stats(conn, rebuild=False)
+                    logger.info("Таблица board_stats создана и заполнена из существующих данных.")
+                if ensure_post_pinned_flag(conn):
+                    logger.info("Добавлен столбец posts.pinned и индекс для постраничной навигации.")
+                if ensure_board_preview_replies(conn):
+                    logger.info("Добавлен столбец boards.preview_replies.")
+                if ensure_thumb_variants_columns(conn):
+                    logger.info("Добавлен столбец thumb_variants для вариантов миниатюр.")
+                fragment_module.create_fragment_table(conn)
+                if not quote_module.quote_table_exists(conn):
+                    quotes = quote_module.create_quote_table(conn)
+                    logger.info(f"Таблица post_quotes создана, записано цитат: {quotes}.")
+                media_module.create_media_jobs_table(conn)
+                if not media_store_module.media_store_exists(conn):
+                    media_store_module.create_media_store(conn) # Старые файлы отслеживаются после database_setup.py
+                media_module.create_media_meta_table(conn)
+                media_gc_module.create_media_gc_table(conn)
+                ratelimit_module.create_rate_limits_table(conn)
+            _derived_schema_ready = True
+        except sqlite3.Error as e: logger.error(f"Не удалось подготовить производные таблицы: {e}", exc_info=True)
+    return _derived_schema_ready
+
 def get_all_boards(include_stats=False):
-    boards_sql = "SELECT * FROM boards ORDER BY board_name"
+    if not include_stats:
+        boards_raw = execute_query("SELECT * FROM boards ORDER BY board_name", fetchall=True)
+        return [dict(board) for board in boards_raw] if boards_raw else []
+    _ensure_derived_schema()
+    # Счетчики поддерживаются триггерами (stats_module), поэтому достаточно одного JOIN
+    boards_sql = """
+        SELECT b.*,
+               IFNULL(s.thread_count, 0) - IFNULL(s.pinned_count, 0) AS thread_count,
+               IFNULL(s.reply_count, 0) AS reply_count,
+               s.last_activity AS last_activity
+        FROM boards b
+        LEFT JOIN board_stats s ON s.board_uri = b.board_uri
+        ORDER BY b.board_name
+    """
     boards_raw = execute_query(boards_sql, fetchall=True)
     if not boards_raw: return []
     boards_list = [dict(board) for board in boards_raw]
-    if include_stats:
-        for board in boards_list:
-            board_uri = board['board_uri']
-            thread_sql = """
-                SELECT COUNT(p.id) as count
-                FROM posts p
-                LEFT JOIN pinned pn ON p.post_id = pn.post_id AND p.board_uri = pn.board_uri
-                WHERE p.board_uri = ? AND pn.post_id IS NULL
-            """
-            thread_res = execute_query(thread_sql, (board_uri,), fetchone=True)
-            board['thread_count'] = thread_res['count'] if thread_res else 0
-            post_ids_sql = "SELECT post_id FROM posts WHERE board_uri = ?"
-            post_ids_res = execute_query(post_ids_sql, (board_uri,), fetchall=True)
-            post_ids = [row['post_id'] for row in post_ids_res] if post_ids_res else []
-            reply_count = 0
-            if post_ids:
-                placeholders = ','.join('?' * len(post_ids))
-                reply_sql = f"SELECT COUNT(*) as count FROM replies WHERE post_id IN ({placeholders})"
-                reply_res = execute_query(reply_sql, tuple(post_ids), fetchone=True)
-                reply_count = reply_res['count'] if reply_res else 0
-            board['reply_count'] = reply_count
-            board['total_posts'] = board['thread_count'] + reply_count
-            # Используем last_bumped для последней активности
-            last_activity_sql = "SELECT MAX(last_bumped) as last_date FROM posts WHERE board_uri = ?"
-            last_activity_res = execute_query(last_activity_sql, (board_uri,), fetchone=True)
-            board['last_activity'] = last_activity_res['last_date'] if last_activity_res else None
+    for board in boards_list:
+        board['total_posts'] = board['thread_count'] + board['reply_count']
     return boards_list
 
+def get_board_reply_counts():
+    """Словарь {board_uri: количество ответов} из счетчиков досок."""
+    _ensure_derived_schema()
+    rows = execute_query("SELECT board_uri, reply_count FROM board_stats", fetchall=True)
+    return {row['board_uri']: row['reply_count'] for row in rows} if rows else {}
+
 def get_board_thread_count(board_uri, include_pinned=False):
     """Получает количество тредов (OP) на доске, опционально исключая закрепленные."""
-    if include_pinned:
-        # Считаем ВСЕ посты на доске
-        sql = "SELECT COUNT(*) as count FROM posts WHERE board_uri = ?"
-        params = (board_uri,)
-    else:
-        # Считаем только те, которых НЕТ в таблице pinned для этой доски
-        sql = """
-            SELECT COUNT(p.id) as count
-            FROM posts p
-            LEFT JOIN pinned pn ON p.post_id = pn.post_id AND p.board_uri = pn.board_uri
-            WHERE p.board_uri = ? AND pn.post_id IS NULL
-        """
-        params = (board_uri,)
-
-    # Выполняем запрос и возвращаем результат
-    result = execute_query(sql, params, fetchone=True)
-    # Возвращаем 0, если запрос ничего не вернул или count равен NULL
-    return result['count'] if result and result['count'] is not None else 0
-
+    _ensure_derived_schema()
+    sql = "SELECT thread_count, pinned_count FROM board_stats WHERE board_uri = ?"
+    result = execute_query(sql, (board_uri,), fetchone=True)
+    if not result: return 0
+    return result['thread_count'] if include_pinned else max(result['thread_count'] - result['pinned_count'], 0)
 
 def get_max_post_id():
+    """Максимальный номер среди постов и ответов (используется только для засева последовательности)."""
     post_sql = "SELECT MAX(post_id) as max_id FROM posts"
     reply_sql = "SELECT MAX(reply_id) as max_id FROM replies"
     max_post_res = execute_query(post_sql, fetchone=True)
@@ -278,6 +392,40 @@ def get_max_post_id():
     max_reply_id = max_reply_res['max_id'] if max_reply_res and max_reply_res['max_id'] is not None else 0
     return max(max_post_id, max_reply_id)
 
+# --- Нумерация постов ---
+# Посты и ответы делят одну последовательность номеров, хранящуюся в таблице post_sequence.
+POST_SEQUENCE_NAME = 'post'
+_SEED_POST_SEQUENCE_SQL = """
+    INSERT OR IGNORE INTO post_sequence (name, value)
+    SELECT ?, MAX(IFNULL((SELECT MAX(post_id) FROM posts), 0), IFNULL((SELECT MAX(reply_id) FROM replies), 0))
+"""
+
+def allocate_post_ids(conn, count=1):
+    """
+    Выделяет count последовательных номеров в текущей транзакции conn и возвращает первый.
+    Вызывать внутри db_transaction(), чтобы номер и INSERT фиксировались вместе.
+    """
+    if count < 1: raise ValueError("count must be >= 1")
+    cursor = conn.execute("UPDATE post_sequence SET value = value + ? WHERE name = ?", (count, POST_SEQUENCE_NAME))
+    if cursor.rowcount == 0:
+        # База еще не мигрирована database_setup.py: засеваем последовательность из MAX() один раз
+        conn.execute(_SEED_POST_SEQUENCE_SQL, (POST_SEQUENCE_NAME,))
+        conn.execute("UPDATE post_sequence SET value = value + ? WHERE name = ?", (count, POST_SEQUENCE_NAME))
+        logger.info("Последовательность номеров постов засеяна из текущих MAX(post_id)/MAX(reply_id).")
+    last_id = conn.execute("SELECT value FROM post_sequence WHERE name = ?", (POST_SEQUENCE_NAME,)).fetchone()[0]
+    return last_id - count + 1
+
+def reserve_post_ids(count):
+    """Резервирует блок номеров одной транзакцией (для массового импорта). Возвращает range или None."""
+    _ensure_derived_schema()
+    try:
+        with db_transaction() as conn:
+            first_id = allocate_post_ids(conn, count)
+        return range(first_id, first_id + count)
+    except (sqlite3.Error, ValueError) as e:
+        logger.error(f"Не удалось зарезервировать {count} номеров постов: {e}", exc_info=True)
+        return None
+
 def create_banner_folder(board_uri):
     try:
         # Используем абсолютный путь
@@ -286,6 +434,7 @@ def create_banner_folder(board_uri):
         logger.info(f"Папка для баннеров создана или уже существует: {board_folder_abs}")
     except OSError as e: logger.error(f"Не удалось создать папку для баннеров {board_uri}: {e}", exc_info=True)
 
+@_invalidates_board_cache
 def add_new_board(board_uri, board_name, board_description, username, captcha_input, captcha_text):
     # Валидация капчи теперь происходит в роуте, здесь не нужна captcha_input/text
     # Но сама функция validate_captcha может остаться для других целей
@@ -301,42 +450,37 @@ def add_new_board(board_uri, board_name, board_description, username, captcha_in
     except sqlite3.IntegrityError as e: logger.error(f"Создание доски не удалось из-за IntegrityError: {e}", exc_info=True); return False
     except Exception as e: logger.error(f"Неожиданная ошибка при создании доски '{board_uri}': {e}", exc_info=True); return False
 
+@_invalidates_board_cache
 def remove_board(board_uri, username, role):
     board_info = get_board_info(board_uri)
     if not board_info: logger.warning(f"Удаление доски не удалось: Доска '{board_uri}' не найдена."); return False
     is_owner = board_info['board_owner'] == username
     is_admin = role and ('mod' in role.lower() or 'owner' in role.lower())
     if not is_owner and not is_admin: logger.warning(f"Удаление доски не удалось: Пользователь '{username}' не имеет прав для доски '{board_uri}'."); return False
-    conn = None
     try:
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT post_id, post_images, imagesthb FROM posts WHERE board_uri = ?", (board_uri,))
-        posts_to_delete = cursor.fetchall()
-        cursor.execute("SELECT r.images, r.imagesthb FROM replies r JOIN posts p ON r.post_id = p.post_id WHERE p.board_uri = ?", (board_uri,))
-        replies_to_delete = cursor.fetchall()
-        logger.info(f"Попытка удаления доски '{board_uri}'...")
-        cursor.execute("DELETE FROM boards WHERE board_uri = ?", (board_uri,))
-        rows_affected = cursor.rowcount
-        conn.commit()
-        if rows_affected > 0:
-            logger.info(f"Доска '{board_uri}' удалена из базы данных.")
-            for post_row in posts_to_delete:
-                delete_media_files(post_row['post_images'], POST_IMAGE_ABS_PATH)
-                delete_media_files(post_row['imagesthb'], STATIC_FOLDER_PATH) # База - static
-            for reply_row in replies_to_delete:
-                delete_media_files(reply_row['images'], REPLY_IMAGE_ABS_PATH)
-                delete_media_files(reply_row['imagesthb'], STATIC_FOLDER_PATH) # База - static
-            banner_folder_abs = os.path.join(STATIC_FOLDER_PATH, 'imgs', 'banners', board_uri)
-            if os.path.isdir(banner_folder_abs):
-                try: import shutil; shutil.rmtree(banner_folder_abs); logger.info(f"Удалена папка с баннерами: {banner_folder_abs}")
-                except OSError as e: logger.error(f"Не удалось удалить папку с баннерами {banner_folder_abs}: {e}")
-            return True
-        else: logger.warning(f"Доска '{board_uri}' не найдена в БД при попытке удаления."); return False
-    except sqlite3.Error as e: logger.error(f"Ошибка базы данных при удалении доски '{board_uri}': {e}", exc_info=True); conn.rollback(); return False
-    except Exception as e: logger.error(f"Неожиданная ошибка при удалении доски '{board_uri}': {e}", exc_info=True); conn.rollback(); return False
-    finally:
-        if conn: conn.close()
+        _ensure_derived_schema()
+        with db_connection() as conn: # Откат незавершенной транзакции выполнит пул
+            cursor = conn.cursor()
+            logger.info(f"Попытка удаления доски '{board_uri}'...")
+            # Файлы удалит media_gc_module после фиксации - запрос не ждет удаления тысяч файлов
+            media_gc_module.queue_item_files(conn, 'replies', "item.post_id IN (SELECT post_id FROM posts WHERE board_uri = ?)", (board_uri,))
+            media_gc_module.queue_item_files(conn, 'posts', "item.board_uri = ?", (board_uri,))
+            cursor.execute("DELETE FROM boards WHERE board_uri = ?", (board_uri,))
+            rows_affected = cursor.rowcount
+            media_gc_module.queue_paths(conn, media_store_module.release_unreferenced(conn)) # Счетчики уже уменьшены триггерами
+            conn.commit()
+            if rows_affected > 0:
+                logger.info(f"Доска '{board_uri}' удалена из базы данных.")
+                recent_module.recent_threads.invalidate()
+                media_gc_module.media_gc.wake()
+                banner_folder_abs = os.path.join(STATIC_FOLDER_PATH, 'imgs', 'banners', board_uri)
+                if os.path.isdir(banner_folder_abs):
+                    try: import shutil; shutil.rmtree(banner_folder_abs); logger.info(f"Удалена папка с баннерами: {banner_folder_abs}")
+                    except OSError as e: logger.error(f"Не удалось удалить папку с баннерами {banner_folder_abs}: {e}")
+                return True
+            else: logger.warning(f"Доска '{board_uri}' не найдена в БД при попытке удаления."); return False
+    except sqlite3.Error as e: logger.error(f"Ошибка базы данных при удалении доски '{board_uri}': {e}", exc_info=True); return False
+    except Exception as e: logger.error(f"Неожиданная ошибка при удалении доски '{board_uri}': {e}", exc_info=True); return False
 
 # --- User Operations ---
 def get_user_by_username(username):
@@ -453,6 +597,13 @@ def check_replyto_exist(thread_id):
     sql = "SELECT 1 FROM posts WHERE post_id = ?"
     return bool(execute_query(sql, (tid,), fetchone=True))
 
+def get_thread_board(thread_id):
+    """board_uri треда или None, если треда нет."""
+    try: tid = int(thread_id)
+    except (ValueError, TypeError): return None
+    row = execute_query("SELECT board_uri FROM posts WHERE post_id = ?", (tid,), fetchone=True)
+    return row['board_uri'] if row else None
+
 # --- Post Operations ---
 def get_thread_id_for_post(post_or_reply_id):
      try: pid = int(post_or_reply_id)
@@ -471,7 +622,7 @@ def bump_thread(thread_id):
     current_time_iso = get_current_datetime()
     sql = "UPDATE posts SET last_bumped = ? WHERE post_id = ?"
     result = execute_query(sql, (current_time_iso, tid), commit=True, fetchall=False)
-    if result is not None: return True
+    if result is not None: recent_module.recent_threads.update_thread(tid); return True
     else: logger.error(f"Не удалось поднять тред {tid}."); return False
 
 def _serialize_files(files_list):
@@ -499,144 +650,52 @@ def _deserialize_files(files_json):
              return []
     except (json.JSONDecodeError, TypeError) as e: logger.error(f"Ошибка десериализации JSON файлов '{files_json}': {e}"); return []
 
-def add_new_post(user_ip, board_id, post_name, original_content, comment, embed, files, filesthb):
-    """Создает новый пост (тред). files и filesthb - списки имен/путей."""
+@_invalidates_board_cache
+def add_new_post(user_ip, board_id, post_name, original_content, comment, embed, files, filesthb, thumb_variants=None):
+    """Создает новый пост (тред). files и filesthb - списки имен/путей, thumb_variants - {миниатюра: варианты}."""
     if not get_board_info(board_id): logger.error(f"Создание поста не удалось: Доска '{board_id}' не существует."); raise ValueError(f"Board '{board_id}' does not exist")
-    new_post_id = get_max_post_id() + 1
     current_time_iso = get_current_datetime()
     processed_name = generate_tripcode(post_name)
-    sql = """INSERT INTO posts (user_ip, post_id, post_user, post_date, board_uri, original_content, post_content, post_images, imagesthb, locked, visible, last_bumped) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-    params = (user_ip, new_post_id, processed_name, current_time_iso, board_id, original_content, comment, _serialize_files(files), _serialize_files(filesthb), 0, 1, current_time_iso)
+    _ensure_derived_schema()
+    sql = """INSERT INTO posts (user_ip, post_id, post_user, post_date, board_uri, original_content, post_content, post_images, imagesthb, locked, visible, last_bumped, thumb_variants) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
     try:
-        result_id = execute_query(sql, params, commit=True, fetchall=False)
-        if result_id is not None: logger.info(f"Новый пост создан с ID {new_post_id} на доске '{board_id}'."); return new_post_id
-        else: return None
+        with db_transaction() as conn: # Номер выделяется в той же транзакции, что и INSERT
+            new_post_id = allocate_post_ids(conn)
+            params = (user_ip, new_post_id, processed_name, current_time_iso, board_id, original_content, comment, _serialize_files(files), _serialize_files(filesthb), 0, 1, current_time_iso, json.dumps(thumb_variants) if thumb_variants else None)
+            conn.execute(sql, params)
+            quote_module.save_quotes(conn, new_post_id, new_post_id, comment, original_content)
+            media_store_module.save_refs(conn, new_post_id, POST_IMAGE_FOLDER_REL, files)
+        recent_module.recent_threads.update_thread(new_post_id)
+        logger.info(f"Новый пост создан с ID {new_post_id} на доске '{board_id}'."); return new_post_id
     except sqlite3.IntegrityError as e: logger.error(f"Создание поста не удалось из-за IntegrityError: {e}", exc_info=True); return None
     except Exception as e: logger.error(f"Неожиданная ошибка при создании поста: {e}", exc_info=True); return None
 
-def add_new_reply(user_ip, reply_to_thread_id, post_name, comment, embed, files, filesthb):
-    """Добавляет ответ к посту. files и filesthb - списки имен/путей."""
+@_invalidates_board_cache
+def add_new_reply(user_ip, reply_to_thread_id, post_name, comment, embed, files, filesthb, thumb_variants=None):
+    """Добавляет ответ к посту. files и filesthb - списки имен/путей, thumb_variants - {миниатюра: варианты}."""
     try: tid = int(reply_to_thread_id)
     except (ValueError, TypeError): logger.error(f"Создание ответа не удалось: неверный ID треда {reply_to_thread_id}"); return None
     if not check_replyto_exist(tid): logger.error(f"Создание ответа не удалось: Тред ID '{tid}' не существует."); return None
-    new_reply_id = get_max_post_id() + 1
     current_time_iso = get_current_datetime()
     processed_name = generate_tripcode(post_name)
-    sql = """INSERT INTO replies (user_ip, reply_id, post_id, post_user, post_date, content, images, imagesthb) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
-    params = (user_ip, new_reply_id, tid, processed_name, current_time_iso, comment, _serialize_files(files), _serialize_files(filesthb))
+    _ensure_derived_schema()
+    sql = """INSERT INTO replies (user_ip, reply_id, post_id, post_user, post_date, content, images, imagesthb, thumb_variants) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
     try:
-        result_id = execute_query(sql, params, commit=True, fetchall=False)
-        if result_id is not None:
-            if not bump_thread(tid): logger.warning(f"Ответ {new_reply_id} создан, но не удалось поднять тред {tid}.")
-            logger.info(f"Новый ответ создан с ID {new_reply_id} для треда {tid}."); return new_reply_id
-        else: return None
+        with db_transaction() as conn: # Номер, INSERT и подъем треда фиксируются вместе
+            new_reply_id = allocate_post_ids(conn)
+            params = (user_ip, new_reply_id, tid, processed_name, current_time_iso, comment, _serialize_files(files), _serialize_files(filesthb), json.dumps(thumb_variants) if thumb_variants else None)
+            conn.execute(sql, params)
+            quote_module.save_quotes(conn, new_reply_id, tid, comment)
+            media_store_module.save_refs(conn, new_reply_id, REPLY_IMAGE_FOLDER_REL, files)
+            bumped = conn.execute("UPDATE posts SET last_bumped = ? WHERE post_id = ?", (current_time_iso, tid)).rowcount
+        if not bumped: logger.warning(f"Ответ {new_reply_id} создан, но не удалось поднять тред {tid}.")
+        else: recent_module.recent_threads.update_thread(tid)
+        logger.info(f"Новый ответ создан с ID {new_reply_id} для треда {tid}."); return new_reply_id
     except sqlite3.IntegrityError as e: logger.error(f"Создание ответа не удалось из-за IntegrityError: {e}", exc_info=True); return None
     except Exception as e: logger.error(f"Неожиданная ошибка при создании ответа: {e}", exc_info=True); return None
     
     
-def delete_media_files(files_json_or_list, base_abs_path):
-    """
-    Вспомогательная функция для безопасного удаления медиафайлов.
-
-    Args:
-        files_json_or_list: Строка JSON со списком имен/путей или сам список.
-                            Для оригиналов это список имен файлов.
-                            Для миниатюр это список относительных путей от папки static
-                            (например, ['post_images/thumbs/thumb1.jpg', 'post_images/thumbs/thumb2.png']).
-        base_abs_path: Абсолютный путь к базовой папке, откуда нужно считать пути файлов.
-                       Для оригиналов это POST_IMAGE_ABS_PATH или REPLY_IMAGE_ABS_PATH.
-                       Для миниатюр это STATIC_FOLDER_PATH.
-    """
-    if not files_json_or_list:
-        # logger.debug(f"Нет файлов для удаления в {base_abs_path}.")
-        return
-
-    file_paths_to_delete = []
-    # Определяем, что пришло: строка JSON или уже список
-    if isinstance(files_json_or_list, str):
-        file_paths_to_delete = _deserialize_files(files_json_or_list)
-    elif isinstance(files_json_or_list, list):
-        file_paths_to_delete = files_json_or_list # Уже список
-    else:
-        logger.warning(f"Неверный тип данных для удаления файлов: {type(files_json_or_list)} в {base_abs_path}. Пропуск.")
-        return
-
-    # Дополнительная проверка после десериализации
-    if not isinstance(file_paths_to_delete, list):
-         logger.warning(f"Данные файлов после десериализации не являются списком: {file_paths_to_delete}. Пропуск удаления.")
-         return
-
-    logger.debug(f"Попытка удаления файлов: {file_paths_to_delete} из базового пути: {base_abs_path}")
-    deleted_count = 0
-    failed_count = 0
-
-    # Убедимся, что базовый путь существует и является директорией
-    if not os.path.isdir(base_abs_path):
-         logger.error(f"Базовый путь для удаления '{base_abs_path}' не существует или не является директорией. Удаление файлов отменено.")
-         return # Не можем продолжать без базового пути
-
-    for file_path_part in file_paths_to_delete:
-        if not file_path_part or not isinstance(file_path_part, str): # Пропускаем пустые или нестроковые элементы
-            logger.debug(f"Пропуск невалидной записи в списке файлов: {file_path_part}")
-            continue
-
-        # --- Сборка и проверка полного пути ---
-        # Нормализуем разделители для безопасности
-        clean_file_path_part = file_path_part.replace('\\', '/')
-
-        # Проверка безопасности: предотвращение обхода каталога
-        if '..' in clean_file_path_part or clean_file_path_part.startswith('/'):
-             logger.warning(f"Пропуск потенциально опасного пути к файлу: '{file_path_part}' в {base_abs_path}")
-             failed_count += 1
-             continue
-
-        # Собираем абсолютный путь
-        # os.path.join корректно обработает разделители
-        try:
-            full_abs_path_to_delete = os.path.abspath(os.path.join(base_abs_path, clean_file_path_part))
-        except Exception as path_err:
-             logger.error(f"Ошибка сборки пути для '{file_path_part}' в '{base_abs_path}': {path_err}")
-             failed_count += 1
-             continue
-
-        # Дополнительная проверка безопасности: убедимся, что файл находится ВНУТРИ ожидаемой базовой папки
-        # (на случай изощренных атак, которые обошли проверку '..')
-        common_prefix = os.path.commonpath([base_abs_path, full_abs_path_to_delete])
-        if os.path.abspath(common_prefix) != os.path.abspath(base_abs_path):
-            logger.error(f"Попытка удаления файла вне базовой директории! Путь: '{full_abs_path_to_delete}', База: '{base_abs_path}'. Отменено.")
-            failed_count += 1
-            continue
-
-        # --- Удаление файла ---
-        try:
-            # Проверяем существование файла перед удалением
-            if os.path.isfile(full_abs_path_to_delete):
-                os.remove(full_abs_path_to_delete)
-                logger.info(f"Удален файл: {full_abs_path_to_delete}") # Используем INFO для удаленных
-                deleted_count += 1
-            # else:
-                # Логировать ненайденные файлы может быть слишком шумно
-                # logger.debug(f"Файл не найден для удаления: {full_abs_path_to_delete}")
-                # failed_count += 1 # Считать ли ненайденный файл ошибкой? Зависит от логики.
-                pass
-        except OSError as e:
-            # Логируем ошибку ОС (например, нет прав)
-            logger.error(f"Ошибка удаления файла {clean_file_path_part} по пути {full_abs_path_to_delete}: {e}", exc_info=True)
-            failed_count += 1
-        except Exception as e:
-            # Логируем другие неожиданные ошибки
-            logger.error(f"Неожиданная ошибка при удалении файла {clean_file_path_part}: {e}", exc_info=True)
-            failed_count += 1
-
-    # Логируем итог операции
-    if failed_count > 0:
-         logger.warning(f"Завершено удаление медиа из '{base_abs_path}'. Удалено: {deleted_count}, Ошибки/Пропущено/Не найдено: {failed_count}")
-    elif deleted_count > 0:
-         logger.info(f"Завершено удаление медиа из '{base_abs_path}'. Удалено: {deleted_count}.")
-    else:
-         logger.debug(f"Нет файлов для удаления в '{base_abs_path}' или список был пуст.")
-
-
+@_invalidates_board_cache
 def remove_post(post_id):
     """Удаляет пост, его ответы, статус закрепления и связанные медиафайлы."""
     try:
@@ -645,57 +704,40 @@ def remove_post(post_id):
         logger.error(f"Не удалось удалить пост: неверный ID {post_id}")
         return False
 
-    conn = None
+    _ensure_derived_schema()
     try:
-        conn = get_db_conn()
-        cursor = conn.cursor()
-
-        # Получаем списки файлов ДО удаления из БД
-        cursor.execute("SELECT post_images, imagesthb FROM posts WHERE post_id = ?", (pid,))
-        post_files_row = cursor.fetchone()
-        cursor.execute("SELECT images, imagesthb FROM replies WHERE post_id = ?", (pid,))
-        reply_files_list_rows = cursor.fetchall()
-
-        # Удаляем пост (каскадно удалит ответы и пины)
-        cursor.execute("DELETE FROM posts WHERE post_id = ?", (pid,))
-        rows_affected = cursor.rowcount
-        conn.commit()
-
-        if rows_affected > 0:
-            logger.info(f"Пост {pid} и связанные ответы/пины удалены из базы данных.")
-
-            # --- Удаляем файлы ПОСЛЕ успешного удаления из БД ---
-            if post_files_row:
-                # Удаляем ОРИГИНАЛЬНЫЕ изображения поста
-                # Передаем АБСОЛЮТНЫЙ путь к папке с оригиналами
-                delete_media_files(post_files_row['post_images'], POST_IMAGE_ABS_PATH)
-                # Удаляем МИНИАТЮРЫ поста
-                # Передаем АБСОЛЮТНЫЙ путь к папке static, т.к. пути в imagesthb уже содержат 'post_images/thumbs/...'
-                delete_media_files(post_files_row['imagesthb'], STATIC_FOLDER_PATH)
-
-            # Удаляем файлы ответов
-            for reply_files_row in reply_files_list_rows:
-                # Удаляем ОРИГИНАЛЬНЫЕ изображения ответа
-                delete_media_files(reply_files_row['images'], REPLY_IMAGE_ABS_PATH)
-                # Удаляем МИНИАТЮРЫ ответа
-                delete_media_files(reply_files_row['imagesthb'], STATIC_FOLDER_PATH)
-            return True
-        else:
-            logger.warning(f"Попытка удаления поста {pid}, но он не найден в базе данных.")
-            return False
+        with db_connection() as conn: # Откат незавершенной транзакции выполнит пул
+            cursor = conn.cursor()
+
+            # Файлы ставятся в очередь ДО удаления строк и удаляются после фиксации (media_gc_module)
+            media_gc_module.queue_item_files(conn, 'replies', "item.post_id = ?", (pid,))
+            media_gc_module.queue_item_files(conn, 'posts', "item.post_id = ?", (pid,))
+
+            # Удаляем пост (каскадно удалит ответы и пины)
+            cursor.execute("DELETE FROM posts WHERE post_id = ?", (pid,))
+            rows_affected = cursor.rowcount
+            # Триггеры сняли ссылки поста и ответов; объекты без ссылок освобождаются в той же транзакции
+            media_gc_module.queue_paths(conn, media_store_module.release_unreferenced(conn))
+            conn.commit()
+
+            if rows_affected > 0:
+                logger.info(f"Пост {pid} и связанные ответы/пины удалены из базы данных.")
+                recent_module.recent_threads.invalidate()
+                media_gc_module.media_gc.wake()
+                return True
+            else:
+                logger.warning(f"Попытка удаления поста {pid}, но он не найден в базе данных.")
+                return False
 
     except sqlite3.Error as e:
         logger.error(f"Ошибка базы данных при удалении поста {pid}: {e}", exc_info=True)
-        if conn: conn.rollback()
         return False
     except Exception as e:
         logger.error(f"Неожиданная ошибка при удалении поста {pid}: {e}", exc_info=True)
-        if conn: conn.rollback()
         return False
-    finally:
-        if conn: conn.close()
 
 
+@_invalidates_board_cache
 def remove_reply(reply_id):
     """Удаляет один ответ и связанные с ним медиафайлы."""
     try:
@@ -704,44 +746,34 @@ def remove_reply(reply_id):
         logger.error(f"Не удалось удалить ответ: неверный ID {reply_id}")
         return False
 
-    conn = None
+    _ensure_derived_schema()
     try:
-        conn = get_db_conn()
-        cursor = conn.cursor()
-
-        # Получаем списки файлов ДО удаления из БД
-        cursor.execute("SELECT images, imagesthb FROM replies WHERE reply_id = ?", (rid,))
-        reply_files_row = cursor.fetchone()
-
-        # Удаляем ответ
-        cursor.execute("DELETE FROM replies WHERE reply_id = ?", (rid,))
-        rows_affected = cursor.rowcount
-        conn.commit()
-
-        if rows_affected > 0:
-            logger.info(f"Ответ {rid} удален из базы данных.")
-
-            # --- Удаляем файлы ПОСЛЕ успешного удаления из БД ---
-            if reply_files_row:
-                # Удаляем ОРИГИНАЛЬНЫЕ изображения ответа
-                delete_media_files(reply_files_row['images'], REPLY_IMAGE_ABS_PATH)
-                # Удаляем МИНИАТЮРЫ ответа
-                delete_media_files(reply_files_row['imagesthb'], STATIC_FOLDER_PATH)
-            return True
-        else:
-            logger.warning(f"Попытка удаления ответа {rid}, но он не найден.")
-            return False
+        with db_connection() as conn: # Откат незавершенной транзакции выполнит пул
+            cursor = conn.cursor()
+
+            # Файлы ставятся в очередь ДО удаления строки и удаляются после фиксации (media_gc_module)
+            media_gc_module.queue_item_files(conn, 'replies', "item.reply_id = ?", (rid,))
+
+            # Удаляем ответ
+            cursor.execute("DELETE FROM replies WHERE reply_id = ?", (rid,))
+            rows_affected = cursor.rowcount
+            media_gc_module.queue_paths(conn, media_store_module.release_unreferenced(conn))
+            conn.commit()
+
+            if rows_affected > 0:
+                logger.info(f"Ответ {rid} удален из базы данных.")
+                media_gc_module.media_gc.wake()
+                return True
+            else:
+                logger.warning(f"Попытка удаления ответа {rid}, но он не найден.")
+                return False
 
     except sqlite3.Error as e:
         logger.error(f"Ошибка базы данных при удалении ответа {rid}: {e}", exc_info=True)
-        if conn: conn.rollback()
         return False
     except Exception as e:
         logger.error(f"Неожиданная ошибка при удалении ответа {rid}: {e}", exc_info=True)
-        if conn: conn.rollback()
         return False
-    finally:
-        if conn: conn.close()
 
 
 def verify_locked_thread(thread_id):
@@ -776,6 +808,7 @@ def is_post_pinned(post_id, board_uri):
      sql = "SELECT 1 FROM pinned WHERE post_id = ? AND board_uri = ?"
      return bool(execute_query(sql, (pid, board_uri), fetchone=True))
 
+@_invalidates_board_cache
 def pin_post(post_id):
     """Закрепляет или открепляет пост."""
     try: pid = int(post_id)
@@ -803,46 +836,240 @@ def pin_post(post_id):
         except Exception as e: logger.error(f"Не удалось закрепить пост {pid}: {e}", exc_info=True); return False
 
 
-# --- Query Operations ---
-def get_posts_for_board(board_uri, offset=0, limit=10):
-    """Загружает страницы с постами (тредами) для доски, исключая закрепленные."""
-    sql = "SELECT p.* FROM posts p LEFT JOIN pinned pn ON p.post_id = pn.post_id AND p.board_uri = pn.board_uri WHERE p.board_uri = ? AND pn.post_id IS NULL ORDER BY p.last_bumped DESC LIMIT ? OFFSET ?"
-    params = (board_uri, limit, offset)
-    posts = execute_query(sql, params, fetchall=True)
-    return posts if posts else []
+# --- Флаг закрепления в posts ---
+# Копия таблицы pinned в самих постах: страницы доски читаются по индексу без анти-JOIN.
+_PINNED_FLAG_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_posts_pinned_flag_set AFTER INSERT ON pinned
+    BEGIN
+        UPDATE posts SET pinned = 1 WHERE post_id = NEW.post_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_posts_pinned_flag_clear AFTER DELETE ON pinned
+    BEGIN
+        UPDATE posts SET pinned = 0 WHERE post_id = OLD.post_id;
+    END
+    """,
+]
+
+def ensure_post_pinned_flag(conn):
+    """Добавляет posts.pinned, индекс страниц доски и триггеры синхронизации. True, если столбец был добавлен."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(posts)")}
+    added = 'pinned' not in columns
+    if added:
+        conn.execute("ALTER TABLE posts ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0")
+        conn.execute("UPDATE posts SET pinned = 1 WHERE post_id IN (SELECT post_id FROM pinned)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_post_board_page ON posts (board_uri, pinned, last_bumped DESC, post_id DESC)")
+    for trigger_sql in _PINNED_FLAG_TRIGGERS:
+        conn.execute(trigger_sql)
+    return added
 
-def get_pinned_posts(board_uri):
-    """Получает закрепленные посты для доски."""
-    sql = "SELECT p.* FROM posts p JOIN pinned pn ON p.post_id = pn.post_id WHERE pn.board_uri = ? ORDER BY p.post_date DESC"
+# --- Query Operations ---
+def encode_page_cursor(post):
+    """Курсор страницы доски: позиция поста в порядке (last_bumped, post_id)."""
+    raw = json.dumps([post['last_bumped'], post['post_id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_page_cursor(cursor):
+    """Возвращает (last_bumped, post_id) или None для испорченного курсора."""
+    if not cursor: return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        last_bumped, post_id = json.loads(raw)
+        if not isinstance(last_bumped, str): return None
+        return last_bumped, int(post_id)
+    except (ValueError, TypeError, UnicodeDecodeError): return None
+
+# --- Проекции представлений (row_module) ---
+# Страница доски и каталог показывают начало original_content (до 650 символов, см. шаблоны):
+# читается только PREVIEW_CHARS символов, post_content (HTML) не нужен
+PREVIEW_CHARS = 700
+BOARD_THREAD_VIEW = row_module.View('BoardThread', (
+    'post_id', 'board_uri', 'post_user', 'post_date', 'last_bumped', 'post_images', 'imagesthb', 'thumb_variants',
+    (f"substr({{t}}original_content, 1, {PREVIEW_CHARS})", 'original_content'),
+))
+# Страница треда показывает OP целиком (post_content); исходный текст не нужен
+THREAD_OP_VIEW = row_module.View('ThreadOp', (
+    'post_id', 'board_uri', 'post_user', 'post_date', 'last_bumped', 'post_content', 'post_images', 'imagesthb', 'thumb_variants',
+))
+REPLY_VIEW = row_module.View('Reply', (
+    'reply_id', 'post_id', 'post_user', 'post_date', 'content', 'images', 'imagesthb', 'thumb_variants',
+))
+REPLY_PREVIEW_VIEW = row_module.View('ReplyPreview', REPLY_VIEW.fields + (
+    ('ranked.rn', 'preview_rank'), ('ranked.thread_reply_count', 'thread_reply_count'),
+))
+
+def get_posts_for_board(board_uri, offset=0, limit=10, after=None, before=None, view=BOARD_THREAD_VIEW):
+    """
+    Загружает страницу тредов доски (без закрепленных) в порядке последнего подъема.
+    after/before - позиции (last_bumped, post_id) из decode_page_cursor: страница после/перед
+    этой позицией читается по индексу idx_post_board_page без пропуска строк (OFFSET).
+    Строки - объекты view.row_class только со столбцами представления.
+    """
+    _ensure_derived_schema()
+    base_sql = f"SELECT {view.select('p.')} FROM posts p WHERE p.board_uri = ? AND p.pinned = 0"
+    if after:
+        sql = base_sql + " AND (p.last_bumped, p.post_id) < (?, ?) ORDER BY p.last_bumped DESC, p.post_id DESC LIMIT ?"
+        params = (board_uri, after[0], after[1], limit)
+    elif before:
+        # Читаем в обратном порядке ближайшие к курсору посты, затем разворачиваем
+        sql = base_sql + " AND (p.last_bumped, p.post_id) > (?, ?) ORDER BY p.last_bumped ASC, p.post_id ASC LIMIT ?"
+        params = (board_uri, before[0], before[1], limit)
+    else:
+        sql = base_sql + " ORDER BY p.last_bumped DESC, p.post_id DESC LIMIT ? OFFSET ?"
+        params = (board_uri, limit, offset)
+    posts = execute_query(sql, params, fetchall=True, row_factory=view.row_factory)
+    if not posts: return []
+    return list(reversed(posts)) if before and not after else posts
+
+def get_pinned_posts(board_uri, view=BOARD_THREAD_VIEW):
+    """Получает закрепленные посты для доски (столбцы представления view)."""
+    sql = f"SELECT {view.select('p.')} FROM posts p JOIN pinned pn ON p.post_id = pn.post_id WHERE pn.board_uri = ? ORDER BY p.post_date DESC"
     params = (board_uri,)
-    pinned_posts = execute_query(sql, params, fetchall=True)
+    pinned_posts = execute_query(sql, params, fetchall=True, row_factory=view.row_factory)
     return pinned_posts if pinned_posts else []
 
-def get_replies_for_posts(post_ids):
+def get_replies_for_posts(post_ids, view=REPLY_VIEW):
     """Получает все ответы для списка ID постов."""
     if not post_ids or not isinstance(post_ids, (list, tuple)): return []
     placeholders = ','.join('?' * len(post_ids))
-    sql = f"SELECT * FROM replies WHERE post_id IN ({placeholders}) ORDER BY post_date ASC"
-    replies = execute_query(sql, tuple(post_ids), fetchall=True)
+    sql = f"SELECT {view.select()} FROM replies WHERE post_id IN ({placeholders}) ORDER BY post_date ASC"
+    replies = execute_query(sql, tuple(post_ids), fetchall=True, row_factory=view.row_factory)
     return replies if replies else []
 
+def get_reply_previews(post_ids, limit):
+    """
+    Последние limit ответов каждого треда (для страницы доски) одним оконным запросом.
+    Возвращает (ответы по возрастанию, {post_id: всего ответов}); скрыто = всего - показано.
+    Нумерация идет по (post_id, id) из индекса idx_reply_post_id, полные строки читаются только для превью.
+    """
+    if not post_ids or not isinstance(post_ids, (list, tuple)): return [], {}
+    placeholders = ','.join('?' * len(post_ids))
+    sql = f"""
+        WITH ranked AS (
+            SELECT id, post_id,
+                   ROW_NUMBER() OVER (PARTITION BY post_id ORDER BY id DESC) AS rn,
+                   COUNT(*) OVER (PARTITION BY post_id) AS thread_reply_count
+            FROM replies WHERE post_id IN ({placeholders})
+        )
+        SELECT {REPLY_PREVIEW_VIEW.select('r.')}
+        FROM ranked JOIN replies r ON r.id = ranked.id
+        WHERE ranked.rn <= ? OR ranked.rn = 1
+        ORDER BY r.post_id, r.id
+    """
+    rows = execute_query(sql, tuple(post_ids) + (limit,), fetchall=True, row_factory=REPLY_PREVIEW_VIEW.row_factory)
+    if not rows: return [], {}
+    totals = {row['post_id']: row['thread_reply_count'] for row in rows}
+    # rn = 1 запрашивается всегда, чтобы получить счетчик даже при limit = 0
+    replies = [row for row in rows if row['preview_rank'] <= limit]
+    return replies, totals
+
+def get_reply_counts(post_ids):
+    """{post_id: количество ответов} для списка тредов (каталог)."""
+    if not post_ids or not isinstance(post_ids, (list, tuple)): return {}
+    placeholders = ','.join('?' * len(post_ids))
+    sql = f"SELECT post_id, COUNT(*) AS reply_count FROM replies WHERE post_id IN ({placeholders}) GROUP BY post_id"
+    rows = execute_query(sql, tuple(post_ids), fetchall=True)
+    return {row['post_id']: row['reply_count'] for row in rows} if rows else {}
+
 def get_post_and_replies(thread_id):
-     """Получает конкретный пост (OP треда) и все его ответы."""
+     """Получает конкретный пост (OP треда) и все его ответы (строки THREAD_OP_VIEW и REPLY_VIEW)."""
      try: tid = int(thread_id)
      except (ValueError, TypeError): return None, []
-     post_sql = "SELECT * FROM posts WHERE post_id = ?"
-     thread_op = execute_query(post_sql, (tid,), fetchone=True)
+     post_sql = f"SELECT {THREAD_OP_VIEW.select()} FROM posts WHERE post_id = ?"
+     thread_op = execute_query(post_sql, (tid,), fetchone=True, row_factory=THREAD_OP_VIEW.row_factory)
      if not thread_op: return None, []
-     replies_sql = "SELECT * FROM replies WHERE post_id = ? ORDER BY post_date ASC"
-     replies = execute_query(replies_sql, (tid,), fetchall=True)
+     replies_sql = f"SELECT {REPLY_VIEW.select()} FROM replies WHERE post_id = ? ORDER BY post_date ASC"
+     replies = execute_query(replies_sql, (tid,), fetchall=True, row_factory=REPLY_VIEW.row_factory)
      return thread_op, (replies if replies else [])
 
+def find_media_by_hash(sha256):
+    """Посты и ответы с файлом данного содержимого (для модерации): [{'path', 'item_id', 'refcount'}]."""
+    if not sha256: return []
+    sql = """
+        SELECT o.path, o.thumb_rel, o.refcount, r.item_id
+        FROM media_objects o JOIN media_refs r ON r.path = o.path
+        WHERE o.sha256 = ? ORDER BY r.item_id
+    """
+    rows = execute_query(sql, (sha256.lower(),), fetchall=True)
+    return [dict(row) for row in rows] if rows else []
+
+def get_backlinks(thread_ids, item_ids):
+    """
+    Обратные ссылки для страницы одним запросом по индексу цитат.
+    Возвращает {to_id: [from_id, ...]}; учитываются только цитирующие посты из item_ids,
+    в порядке их следования в item_ids (как они показаны на странице).
+    Читаются только ребра постов страницы: (thread_id, from_id) - префикс первичного ключа,
+    а номер поста принадлежит одному треду, так что пересечение двух IN точное.
+    """
+    if not thread_ids or not item_ids: return {}
+    _ensure_derived_schema()
+    thread_ids = list(dict.fromkeys(thread_ids))
+    item_ids = list(dict.fromkeys(item_ids))
+    sql = (f"SELECT from_id, to_id FROM post_quotes WHERE thread_id IN ({','.join('?' * len(thread_ids))})"
+           f" AND from_id IN ({','.join('?' * len(item_ids))})")
+    rows = execute_query(sql, tuple(thread_ids) + tuple(item_ids), fetchall=True)
+    if not rows: return {}
+    position = {item_id: index for index, item_id in enumerate(item_ids)}
+    backlinks = {}
+    for row in sorted(rows, key=lambda row: position[row['from_id']]):
+        backlinks.setdefault(row['to_id'], []).append(row['from_id'])
+    return backlinks
+
+# --- Render Fragments ---
+def get_render_fragments(item_ids, variant):
+    """{item_id: (date_display, files_html)} для найденных фрагментов."""
+    if not item_ids: return {}
+    _ensure_derived_schema()
+    placeholders = ','.join('?' * len(item_ids))
+    sql = f"SELECT item_id, date_display, files_html FROM render_fragments WHERE variant = ? AND item_id IN ({placeholders})"
+    rows = execute_query(sql, (variant,) + tuple(item_ids), fetchall=True)
+    return {row['item_id']: (row['date_display'], row['files_html']) for row in rows} if rows else {}
+
+def save_render_fragments(rows):
+    """Сохраняет фрагменты [(item_id, variant, date_display, files_html), ...] одной транзакцией."""
+    if not rows: return True
+    try:
+        with db_transaction() as conn:
+            # Пост мог быть удален, пока рендерился фрагмент: сохраняем только существующие
+            conn.executemany("""
+                INSERT OR REPLACE INTO render_fragments (item_id, variant, date_display, files_html)
+                SELECT ?1, ?2, ?3, ?4
+                WHERE EXISTS (SELECT 1 FROM posts WHERE post_id = ?1) OR EXISTS (SELECT 1 FROM replies WHERE reply_id = ?1)
+            """, rows)
+        return True
+    except sqlite3.Error as e:
+        logger.warning(f"Не удалось сохранить фрагменты ({len(rows)} шт.): {e}")
+        return False
+
+def invalidate_render_fragments(item_ids=None):
+    """Удаляет фрагменты указанных постов/ответов (None - все, например после смены шаблона)."""
+    _ensure_derived_schema()
+    if item_ids is None:
+        return execute_query("DELETE FROM render_fragments", commit=True) is not None
+    if not item_ids: return True
+    placeholders = ','.join('?' * len(item_ids))
+    sql = f"DELETE FROM render_fragments WHERE item_id IN ({placeholders})"
+    return execute_query(sql, tuple(item_ids), commit=True) is not None
+
+def get_item_for_render(kind, item_id):
+    """Строка поста ('post') или ответа ('reply') с полями, нужными для фрагмента."""
+    if kind == 'post': sql = "SELECT post_id, post_date, post_images, imagesthb, thumb_variants FROM posts WHERE post_id = ?"
+    else: sql = "SELECT reply_id, post_id, post_date, images, imagesthb, thumb_variants FROM replies WHERE reply_id = ?"
+    return execute_query(sql, (item_id,), fetchone=True)
+
 def get_user_boards(username):
     """Получает все доски, принадлежащие пользователю."""
     sql = "SELECT * FROM boards WHERE board_owner = ? ORDER BY board_name"
     boards = execute_query(sql, (username,), fetchall=True)
     return boards if boards else []
 
+def get_custom_themes_version():
+    """mtime папки пользовательских тем: меняется при добавлении/удалении файла темы."""
+    try: return os.stat(os.path.join(STATIC_FOLDER_PATH, 'css', 'custom')).st_mtime_ns
+    except OSError: return None
+
 def get_custom_themes():
     """Получает доступные пользовательские темы (работа с файловой системой)."""
     custom_css_path = os.path.join(STATIC_FOLDER_PATH, 'css', 'custom')
@@ -873,6 +1100,33 @@ def get_all_banners(board_uri):
     return banners_paths
 
 
+# --- Последние треды (главная страница, панель управления) ---
+# Только столбцы, которые нужны спискам последних тредов и их фрагментам (fragment_module)
+RECENT_THREAD_COLUMNS = ('post_id', 'board_uri', 'post_user', 'post_date', 'last_bumped',
+                         'original_content', 'post_images', 'imagesthb', 'thumb_variants')
+
+def _projection(columns):
+    if not columns or not all(isinstance(column, str) and column.isidentifier() for column in columns):
+        raise ValueError(f"Неверный список столбцов: {columns}")
+    return ', '.join(columns)
+
+def get_recent_threads(limit=6, columns=RECENT_THREAD_COLUMNS):
+    """Последние поднятые треды: limit строк по индексу idx_post_last_bumped, только columns. None при ошибке."""
+    sql = f"SELECT {_projection(columns)} FROM posts ORDER BY last_bumped DESC LIMIT ?"
+    return execute_query(sql, (int(limit),), fetchall=True)
+
+def get_recent_thread(post_id, columns=RECENT_THREAD_COLUMNS):
+    """Одна строка треда с теми же столбцами, что и get_recent_threads (для обновления списка в памяти)."""
+    sql = f"SELECT {_projection(columns)} FROM posts WHERE post_id = ?"
+    return execute_query(sql, (post_id,), fetchone=True)
+
+def get_total_thread_count():
+    """Количество тредов сайта из счетчиков досок (stats_module), без COUNT по posts."""
+    _ensure_derived_schema()
+    result = execute_query("SELECT IFNULL(SUM(thread_count), 0) AS total FROM board_stats", fetchone=True)
+    return result['total'] if result else 0
+
+
 # --- Functions needed for context processors etc. ---
 def get_all_posts_simple(sort_by_date=True):
     """Получает все посты (только OP), опционально отсортированные."""
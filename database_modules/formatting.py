@@ -5,6 +5,10 @@ def escape_html(s):
     # Scape html to remove any XSS.
     return html.escape(s).replace('&gt;', '>').replace('&lt;', '<')
 
+def escape_html_post_info(s):
+    # Nome do autor é exibido com |safe nos templates, então escapa tudo.
+    return html.escape(s)
+
 def filter_xss(comment):
     # Regular expression to search html tags.
     pattern = re.compile(r'<(script|h[1-6]|a|/a|/img|body|p|/p)>', re.IGNORECASE)
@@ -15,125 +19,393 @@ def filter_xss(comment):
     else:
         return False
 
-def format_comment(comment):
+# --- Formatação de comentários ---
+# O formatador antigo (benchmarks/legacy_formatting.py) aplica uma sequência de substituições ao texto
+# inteiro, e cada etapa vê o HTML gerado pelas anteriores. Aqui o texto é percorrido uma vez
+# por três camadas encadeadas que reproduzem essas etapas byte a byte, sem recorrer a ele:
+#   _lex       - '>' / '<' / quebras de linha, citações '>>N' e links markdown [texto](url);
+#   _autolink  - URLs soltas, como a etapa antiga as via (depois dos links markdown);
+#   _render    - '(((' ')))', tags [b] etc., '==' / '||' e [wikinet], que valem para todo o
+#                texto, inclusive o conteúdo das URLs.
+# Entre as camadas passam peças: ('text', s) - texto que ainda passa pelas etapas seguintes;
+# ('html', s) - marcação já gerada; ('anchor', url) - início de link markdown; ('url', url).
+
+# Tags simples [x] -> HTML. Para uma tag nova basta uma entrada aqui.
+BBCODE_TAGS = {
+    '[b]': '<span class="strong">', '[/b]': '</span>',
+    '[i]': '<span class="italic">', '[/i]': '</span>',
+    '[s]': '<span class="s">', '[/s]': '</span>',
+    '[spoiler]': '<span class="spoiler">', '[/spoiler]': '</span>',
+    '[r]': '<span class="rainbowtext">', '[/r]': '</span>',
+}
+
+# Delimitadores que abrem e fecham um span alternadamente (o último fica aberto até o fim).
+TOGGLE_TAGS = {
+    '==': 'red-text',
+    '||': 'spoiler',
+}
+
+WIKINET_OPEN = '[wikinet]'
+WIKINET_CLOSE = '[/wikinet]'
+
+_LEX_RE = re.compile(r'[<>\[\]]|&gt;')
+_LEX_IN_SPAN_RE = re.compile(r'[<>\n\[\]]|&gt;') # Quebra de linha só importa com um span aberto
+_LATE_RE = re.compile(r'[()\[]|' + '|'.join(map(re.escape, TOGGLE_TAGS)))
+_BBCODE_RE = re.compile('|'.join(map(re.escape, sorted(BBCODE_TAGS, key=len, reverse=True))))
+_SPAN_CHARS_RE = re.compile(r'[<>\n]')
+_URL_BREAK_RE = re.compile(r'[<>]|&gt;')
+_GT_UNITS_RE = re.compile(r'(?:>|&gt;)+')
+_ENTITY_UNITS_RE = re.compile(r'(?:&gt;)+')
+_DIGITS_RE = re.compile(r'\d+')
+_RUN_RE = re.compile(r'\S*')
+_SPACE_RE = re.compile(r'\s')
+_URL_START_RE = re.compile(r'https?://')
+
+_NO_AUTOLINK_AFTER = '("\'>' # URL solta logo após estes caracteres não vira link
+
+_TEMPLATES = {
+    'verde': '<span class="verde">',
+    'vermelho': '<span class="vermelho">',
+    'close': '</span>',
+    'quote': '<span class="quote-reply" data-id="{0}">&gt;&gt;{0}</span>',
+    'link_start': '<a class="hyper-link" href="',
+    'link_href_end': '" target="_blank" rel="noopener noreferrer">',
+    'link_end': '</a>',
+    'wikinet': '<a class="wikinet-hyper-link" href="https://wikinet.pro/wiki/{0}" target="_blank"><span>{0}</span></a>',
+}
 
-    # Manipulação de '>' e '<'
-    formatted_comment = []
-    inside_verde = False
-    inside_vermelho = False
-    buffer = []
 
-    for char in comment:
+def _quote_run(comment, start, verde):
+    """
+    Sequência de '&gt;' em start como a etapa de citações a vê: '>' digitados e '&gt;'
+    literais formam uma só sequência, exceto o '>' que abre o span verde (a tag fica no meio).
+    Retorna (fim, quantidade de '&gt;').
+    """
+    units_re = _GT_UNITS_RE if verde or comment[start] == '>' else _ENTITY_UNITS_RE
+    run = units_re.match(comment, start).group()
+    return start + len(run), len(run) - 3 * run.count('&gt;')
+
+
+def _url_run_end(comment, start, verde, vermelho):
+    """
+    Fim da sequência sem espaços em start, como a etapa de links a vê: ela termina também
+    onde um '>' ou '<' abre um span ou onde começa uma citação (o HTML gerado tem espaço).
+    """
+    end = _RUN_RE.match(comment, start).end()
+    pos = start
+    while True:
+        match = _URL_BREAK_RE.search(comment, pos, end)
+        if match is None:
+            return end
+        index = match.start()
+        if comment[index] == '<':
+            if not vermelho:
+                return index
+            pos = index + 1
+            continue
+        if comment[index] == '>' and not verde:
+            return index
+        pos, count = _quote_run(comment, index, verde)
+        if count % 2 == 0 and _DIGITS_RE.match(comment, pos):
+            return index
+
+
+def _markdown_link(comment, start, verde, vermelho):
+    """
+    [texto](url) com '[' em start; verde/vermelho - spans abertos em start.
+    O texto vai até o primeiro ']', a url até o último ')' da sequência sem espaços.
+    Retorna ((pos do ']', fim do link, url), pos do ']') ou (None, pos do ']').
+    """
+    close = comment.find(']', start + 1)
+    if close <= start + 1 or not comment.startswith('(', close + 1):
+        return None, close
+    scheme = _URL_START_RE.match(comment, close + 2)
+    if not scheme:
+        return None, close
+    # O texto do link também passa pela etapa de '>' e '<': estado dos spans no ']'
+    for char in _SPAN_CHARS_RE.findall(comment, start + 1, close):
         if char == '>':
-            if not inside_verde:
-                if buffer:
-                    formatted_comment.append(''.join(buffer))
-                    buffer = []
-                formatted_comment.append('<span class="verde">&gt;')
-                inside_verde = True
-            else:
-                buffer.append('&gt;')
+            verde = True
         elif char == '<':
-            if not inside_vermelho:
-                if buffer:
-                    formatted_comment.append(''.join(buffer))
-                    buffer = []
-                formatted_comment.append('<span class="vermelho">&lt;')
-                inside_vermelho = True
+            vermelho = True
+        elif verde:
+            verde = False
+        else:
+            vermelho = False
+    last = comment.rfind(')', scheme.end() + 1, _url_run_end(comment, scheme.start(), verde, vermelho))
+    if last == -1:
+        return None, close
+    # Dentro da url os spans já estão abertos: '>' e '<' aparecem como entidades
+    url = comment[scheme.start():last].replace('>', '&gt;').replace('<', '&lt;')
+    return (close, last + 1, url), close
+
+
+def _lex(comment):
+    """
+    Primeiras etapas: spans verde/vermelho, citações e links markdown.
+    Retorna a lista de peças; texto vizinho já vem unido (as etapas seguintes procuram
+    padrões no texto contínuo).
+    """
+    length = len(comment)
+    pieces = []
+    text = [] # Texto desde a última peça de marcação
+    add_text = text.append
+
+    def add(kind, value):
+        if text:
+            pieces.append(('text', ''.join(text)))
+            text.clear()
+        pieces.append((kind, value))
+
+    pos = 0
+    verde = vermelho = False
+    link = None         # (pos do ']', fim do link) do link markdown aberto
+    no_link_until = -1  # '[' antes desta posição não abrem link markdown
+
+    while True:
+        match = (_LEX_IN_SPAN_RE if verde or vermelho else _LEX_RE).search(comment, pos)
+        if match is None:
+            if pos < length:
+                add_text(comment[pos:])
+            break
+        start = match.start()
+        if start > pos:
+            add_text(comment[pos:start])
+        char = comment[start]
+        pos = start + 1
+
+        if char == '>' or char == '&':
+            # Greentext; um número par de '&gt;' seguido de dígitos vira citação
+            if char == '>':
+                if not verde:
+                    add('html', _TEMPLATES['verde'])
+                    verde = True
+                if not comment.startswith(('>', '&gt;'), pos):
+                    add_text('&gt;') # Um único '>' (o caso comum)
+                    continue
+            end, count = _quote_run(comment, start, verde)
+            digits = _DIGITS_RE.match(comment, end) if count % 2 == 0 else None
+            if digits:
+                if count > 2:
+                    add_text('&gt;' * (count - 2))
+                add('html', _TEMPLATES['quote'].format(digits.group()))
+                pos = digits.end()
             else:
-                buffer.append('&lt;')
+                add_text('&gt;' * count)
+                pos = end
+        elif char == '<':
+            if not vermelho:
+                add('html', _TEMPLATES['vermelho'])
+                vermelho = True
+            add_text('&lt;')
         elif char == '\n':
-            buffer.append(char)
-            if inside_verde:
-                formatted_comment.append(''.join(buffer))
-                formatted_comment.append('</span>')
-                buffer = []
-                inside_verde = False
-            elif inside_vermelho:
-                formatted_comment.append(''.join(buffer))
-                formatted_comment.append('</span>')
-                buffer = []
-                inside_vermelho = False
-        else:
-            buffer.append(char)
-
-    if buffer:
-        formatted_comment.append(''.join(buffer))
-
-    if inside_verde:
-        formatted_comment.append('</span>')
-    if inside_vermelho:
-        formatted_comment.append('</span>')
-
-    comment = ''.join(formatted_comment)
-
-    # Manipulação de citações (>>)
-    parts = comment.split('&gt;&gt;')
-    formatted_comment = [parts[0]]
-    for part in parts[1:]:
-        number = re.match(r'^\d+', part)
-        if number:
-            quoted_id = number.group(0)
-            quote_span = f'<span class="quote-reply" data-id="{quoted_id}">&gt;&gt;{quoted_id}</span>'
-            formatted_comment.append(f'{quote_span}{part[len(quoted_id):]}')
+            # A quebra de linha fecha um único span (verde tem prioridade)
+            add_text('\n')
+            if verde or vermelho:
+                add('html', _TEMPLATES['close'])
+                if verde:
+                    verde = False
+                else:
+                    vermelho = False
+        elif char == '[':
+            if link is None and start >= no_link_until:
+                found, close = _markdown_link(comment, start, verde, vermelho)
+                if found:
+                    link = found[:2]
+                    add('anchor', found[2])
+                    continue
+                if close == -1:
+                    no_link_until = length
+                elif close > start + 1:
+                    no_link_until = close
+            add_text('[')
+        elif link is not None and start == link[0]:
+            add('html', _TEMPLATES['link_end'])
+            pos = link[1]
+            link = None
         else:
-            formatted_comment.append(f'&gt;&gt;{part}')
-    comment = ''.join(formatted_comment)
-
-    # Substituir links
-    comment = re.sub(
-        r'\[([^\]]+)\]\((https?://[^\s]+)\)',
-        r'<a class="hyper-link" href="\2" target="_blank" rel="noopener noreferrer">\1</a>',
-        comment
-    )
-    comment = re.sub(
-        r'(?<![("\'>])(https?://[^\s]+)(?![^<]*>)',
-        r'<a class="hyper-link" href="\1" target="_blank" rel="noopener noreferrer">\1</a>',
-        comment
-    )
-
-
-    # Manipulação de '((('
-    parts = comment.split('(((')
-    for index in range(1, len(parts)):
-        match = re.match(r'^[^()]*\)\)\)', parts[index])
-        if match:
-            parts[index] = f'<span class="detected">((({match.group(0)}</span>{parts[index][len(match.group(0)):]}'
-        else:
-            parts[index] = f'((({parts[index]}'
-    comment = ''.join(parts)
+            add_text(']')
+
+    if verde:
+        add('html', _TEMPLATES['close'])
+    if vermelho:
+        add('html', _TEMPLATES['close'])
+    if text:
+        pieces.append(('text', ''.join(text)))
+    return pieces
 
-    comment = comment.replace('[b]', '<span class="strong">').replace('[/b]', '</span>')  
 
-    comment = comment.replace('[i]', '<span class="italic">').replace('[/i]', '</span>') 
+def _autolink(pieces):
+    """
+    URLs soltas. A URL vai até o primeiro espaço do texto já com HTML: passa por tags de
+    fechamento ('</span>' no fim do texto, '</a>' de um link markdown) e para antes de uma
+    tag de abertura.
+    """
+    pieces = iter(pieces)
+    pending = [] # Peça lida além do fim de uma URL
+    last = ''    # Caractere anterior à peça atual
+    while True:
+        piece = pending.pop() if pending else next(pieces, None)
+        if piece is None:
+            return
+        kind, value = piece
+        if kind != 'text':
+            yield piece
+            last = '>'
+            continue
+        if '://' not in value:
+            yield piece
+            last = value[-1]
+            continue
+        pos = search_from = 0
+        while True:
+            match = _URL_START_RE.search(value, search_from)
+            if match is None:
+                if pos < len(value):
+                    yield 'text', value[pos:]
+                last = value[-1]
+                break
+            start = match.start()
+            search_from = start + 1
+            before = value[start - 1] if start else last
+            if before and before in _NO_AUTOLINK_AFTER:
+                continue
+            space = _SPACE_RE.search(value, match.end())
+            if space is not None:
+                if space.start() == match.end():
+                    continue
+                if start > pos:
+                    yield 'text', value[pos:start]
+                yield 'url', value[start:space.start()]
+                pos = search_from = space.start()
+                continue
+            parts = [value[start:]]
+            while True:
+                following = pending.pop() if pending else next(pieces, None)
+                if following is None:
+                    break
+                if following[0] == 'html' and following[1].startswith('</'):
+                    parts.append(following[1])
+                    continue
+                if following[0] == 'text':
+                    space = _SPACE_RE.search(following[1])
+                    if space is None:
+                        parts.append(following[1])
+                        continue
+                    parts.append(following[1][:space.start()])
+                    following = ('text', following[1][space.start():])
+                pending.append(following)
+                break
+            url = ''.join(parts)
+            if len(url) == match.end() - start:
+                continue # Nada depois de 'http://'
+            if start > pos:
+                yield 'text', value[pos:start]
+            yield 'url', url
+            last = url[-1]
+            break
 
-    comment = comment.replace('[s]', '<span class="s">').replace('[/s]', '</span>') 
 
-    # Manipulação de '=='
-    parts = comment.split('==')
-    for index in range(1, len(parts), 2):
-        parts[index] = f'<span class="red-text">{parts[index]}</span>'
-    comment = ''.join(parts)
+def _tokenize(comment):
+    """Peças para _render."""
+    return _autolink(_lex(comment))
 
-    # Manipulação de '||'
-    parts = comment.split('||')
-    for index in range(1, len(parts), 2):
-        parts[index] = f'<span class="spoiler">{parts[index]}</span>'
-    comment = ''.join(parts)
 
-    # Manipulação de [spoiler]
-    comment = comment.replace('[spoiler]', '<span class="spoiler">').replace('[/spoiler]', '</span>')
+def _render(pieces):
+    """Etapas finais sobre as peças de _tokenize; monta o HTML."""
+    out = []
+    append = out.append
+    detected = None       # Índice do '(((' que ainda espera ')))'
+    wikinet = None        # Índice do '[wikinet]' que ainda espera '[/wikinet]'
+    wikinet_spans = []    # (índice do '[wikinet]', fim do '[/wikinet]') em out
+    toggles = dict.fromkeys(TOGGLE_TAGS.values(), False)
 
-    # Manipulação de [r]
-    comment = comment.replace('[r]', '<span class="rainbowtext">').replace('[/r]', '</span>')
+    def text(value):
+        nonlocal detected, wikinet
+        if not ('(' in value or ')' in value or '[' in value or '==' in value or '||' in value):
+            append(value)
+            return
+        pos = 0
+        while True:
+            match = _LATE_RE.search(value, pos)
+            if match is None:
+                if pos < len(value):
+                    append(value[pos:])
+                return
+            start = match.start()
+            if start > pos:
+                append(value[pos:start])
+            token = match.group()
+            pos = match.end()
+            if token == '(' or token == ')':
+                # '(((' ... ')))' sem outro parêntese no meio
+                if value.startswith(token * 3, start):
+                    pos = start + 3
+                    if token == '(':
+                        detected = len(out)
+                        append('(((')
+                    elif detected is not None:
+                        out[detected] = '<span class="detected">((('
+                        detected = None
+                        append(')))</span>')
+                    else:
+                        append(')))')
+                else:
+                    detected = None
+                    append(token)
+            elif token == '[':
+                tag = _BBCODE_RE.match(value, start)
+                if tag:
+                    append(BBCODE_TAGS[tag.group()])
+                    pos = tag.end()
+                elif value.startswith(WIKINET_OPEN, start):
+                    wikinet = len(out)
+                    append(WIKINET_OPEN)
+                    pos = start + len(WIKINET_OPEN)
+                elif wikinet is not None and len(out) > wikinet + 1 and value.startswith(WIKINET_CLOSE, start):
+                    append(WIKINET_CLOSE)
+                    wikinet_spans.append((wikinet, len(out)))
+                    wikinet = None
+                    pos = start + len(WIKINET_CLOSE)
+                else:
+                    # Qualquer outro '[' interrompe o conteúdo de [wikinet]
+                    wikinet = None
+                    append('[')
+            else:
+                css_class = TOGGLE_TAGS[token]
+                append('</span>' if toggles[css_class] else f'<span class="{css_class}">')
+                toggles[css_class] = not toggles[css_class]
 
-    comment = re.sub(
-        r'\[wikinet\]([^\[]+)\[/wikinet\]',
-        r'<a class="wikinet-hyper-link" href="https://wikinet.pro/wiki/\1" target="_blank"><span>\1</span></a>',
-        comment
-    )
+    for kind, value in pieces:
+        if kind == 'text':
+            text(value)
+        elif kind == 'html':
+            append(value)
+        else:
+            # O conteúdo da URL também passa pelas etapas finais (no href e, na URL solta, no texto)
+            append(_TEMPLATES['link_start'])
+            text(value)
+            append(_TEMPLATES['link_href_end'])
+            if kind == 'url':
+                text(value)
+                append(_TEMPLATES['link_end'])
+    for is_open in toggles.values():
+        if is_open:
+            append('</span>')
 
-    return comment
+    if wikinet_spans:
+        # [wikinet] é a última etapa: o conteúdo já tem a marcação das anteriores
+        spans, out, last = out, [], 0
+        for first, end in wikinet_spans:
+            out.extend(spans[last:first])
+            out.append(_TEMPLATES['wikinet'].format(''.join(spans[first + 1:end - 1])))
+            last = end
+        out.extend(spans[last:])
+    return ''.join(out)
+
+
+def format_comment(comment):
+    return _render(_tokenize(comment))
 
 if __name__ == '__main__':
     print("This module should not be run directly.")
\ No newline at end of file
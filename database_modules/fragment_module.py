@@ -0,0 +1,134 @@
+"""
+Кеш отрендеренных фрагментов постов.
+Посты не меняются после создания, поэтому неизменяемые части разметки - блок файлов
+(utils/post_files.html) и дата в часовом поясе отображения - рендерятся один раз
+(при создании поста или при первом просмотре) и хранятся в таблице render_fragments.
+Изменяемые части (ссылки-ответы, кнопки модерации, язык интерфейса) рендерятся как раньше.
+
+Вариант фрагмента: "<версия>:<часовой пояс>". При изменении шаблона post_files.html
+увеличьте FRAGMENT_VERSION - старые варианты просто перестанут читаться и будут удалены
+database_setup.py.
+"""
+
+import os
+import logging
+from . import media_module
+
+logger = logging.getLogger(__name__)
+
+FRAGMENT_VERSION = 3
+DEFAULT_DISPLAY_TZ = 'Europe/Moscow' # Совпадает с format_datetime_for_display
+FILES_TEMPLATE = 'utils/post_files.html'
+
+RENDER_FRAGMENTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS render_fragments (
+        item_id INTEGER NOT NULL, -- post_id треда или reply_id ответа (общая нумерация)
+        variant TEXT NOT NULL, -- "<FRAGMENT_VERSION>:<часовой пояс>"
+        date_display TEXT,
+        files_html TEXT,
+        PRIMARY KEY (item_id, variant)
+    ) WITHOUT ROWID
+"""
+
+# Удаление поста/ответа (в т.ч. каскадное) удаляет его фрагменты
+RENDER_FRAGMENTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_render_fragments_post_delete AFTER DELETE ON posts
+    BEGIN
+        DELETE FROM render_fragments WHERE item_id = OLD.post_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_render_fragments_reply_delete AFTER DELETE ON replies
+    BEGIN
+        DELETE FROM render_fragments WHERE item_id = OLD.reply_id;
+    END
+    """,
+]
+
+
+def create_fragment_table(conn):
+    conn.execute(RENDER_FRAGMENTS_TABLE)
+    for trigger_sql in RENDER_FRAGMENTS_TRIGGERS:
+        conn.execute(trigger_sql)
+
+def purge_stale_variants(conn):
+    """Удаляет фрагменты прошлых версий шаблона. Возвращает количество удаленных строк."""
+    return conn.execute("DELETE FROM render_fragments WHERE variant NOT LIKE ?", (f"{FRAGMENT_VERSION}:%",)).rowcount
+
+def variant_key(tz_name=DEFAULT_DISPLAY_TZ):
+    return f"{FRAGMENT_VERSION}:{tz_name}"
+
+def item_kind_and_id(item):
+    """('post', post_id) для треда или ('reply', reply_id) для ответа."""
+    if 'reply_id' in item:
+        return 'reply', item.get('reply_id')
+    return 'post', item.get('post_id')
+
+def video_paths(item):
+    """Пути видеофайлов поста/ответа относительно static (для media_meta)."""
+    kind = item_kind_and_id(item)[0]
+    files = item.get('post_images_list' if kind == 'post' else 'images_list') or []
+    folder = 'post_images/' if kind == 'post' else 'reply_images/'
+    return [folder + filename for filename in files
+            if isinstance(filename, str) and os.path.splitext(filename)[1].lower() in media_module.VIDEO_EXTENSIONS]
+
+def render_files_html(item, kind):
+    """Рендерит блок файлов; item должен содержать *_list (см. format_content_for_template_pass_through_html)."""
+    from flask import render_template
+    return render_template(FILES_TEMPLATE, item=item, kind=kind)
+
+def apply_fragments(items, tz_name=DEFAULT_DISPLAY_TZ):
+    """
+    Заполняет date_display и files_html у подготовленных словарей постов/ответов.
+    Найденные фрагменты читаются одним запросом, недостающие рендерятся и сохраняются.
+    """
+    from . import database_module
+    if not items: return items
+    variant = variant_key(tz_name)
+    ids = [item_id for item_id in (item_kind_and_id(item)[1] for item in items) if item_id is not None]
+    cached = database_module.get_render_fragments(ids, variant)
+    missing = []
+    thumb_states = media_meta = None
+    for item in items:
+        kind, item_id = item_kind_and_id(item)
+        fragment = cached.get(item_id)
+        if fragment is None:
+            if thumb_states is None:
+                thumb_states = media_module.get_thumb_states([i for i in ids if i not in cached])
+                media_meta = media_module.get_media_meta(
+                    path for other in items if item_kind_and_id(other)[1] not in cached for path in video_paths(other))
+            item['thumb_states'] = thumb_states.get(item_id)
+            item['media_meta'] = media_meta
+            dt_obj = database_module.parse_datetime(item.get('post_date'))
+            fragment = (database_module.format_datetime_for_display(dt_obj, tz_name), render_files_html(item, kind))
+            # Пока миниатюры в очереди, фрагмент с заглушкой не сохраняется (его сбросит media_module по готовности)
+            if item_id is not None and not media_module.has_pending(item['thumb_states']):
+                cached[item_id] = fragment
+                missing.append((item_id, variant, fragment[0], fragment[1]))
+        item['date_display'], item['files_html'] = fragment
+    if missing:
+        database_module.save_render_fragments(missing)
+    return items
+
+def prerender(kind, item_id, tz_name=DEFAULT_DISPLAY_TZ):
+    """Рендерит фрагмент сразу после создания поста (kind: 'post' или 'reply')."""
+    from . import database_module
+    row = database_module.get_item_for_render(kind, item_id)
+    if not row:
+        return False
+    item = dict(row)
+    image_key = 'post_images' if kind == 'post' else 'images'
+    item[f'{image_key}_list'] = database_module._deserialize_files(item.get(image_key))
+    item['imagesthb_list'] = database_module._deserialize_files(item.get('imagesthb'))
+    item['thumb_sources'] = media_module.thumb_sources(item.get('thumb_variants'))
+    try:
+        apply_fragments([item], tz_name)
+        return True
+    except Exception as e:
+        logger.error(f"Не удалось отрендерить фрагмент {kind} {item_id}: {e}", exc_info=True)
+        return False
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
@@ -1,20 +1,81 @@
 import json
+import os
+import tempfile
+import threading
+from types import MappingProxyType
 
-def load_langs():
+LANGUAGES_PATH = './config/languages.json'
+
+# Registro em memória: o arquivo é relido apenas quando o mtime muda.
+# O estado é trocado inteiro (tupla) para que leitores sem lock nunca vejam uma mistura.
+_registry_lock = threading.Lock()
+_registry = (None, None, MappingProxyType({})) # (mtime, conteúdo bruto, idiomas resolvidos)
+
+def _file_mtime():
     try:
-        with open('./config/languages.json','r', encoding="utf-8") as langs:
-            lang_db = json.load(langs)
-            return lang_db
-    except:
+        return os.stat(LANGUAGES_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+def _resolve(lang_db):
+    """Cada idioma vira um dict imutável (o primeiro item da lista no JSON)."""
+    resolved = {}
+    for code, entries in lang_db.items():
+        if isinstance(entries, list) and entries and isinstance(entries[0], dict):
+            resolved[code] = MappingProxyType(dict(entries[0]))
+    return MappingProxyType(resolved)
+
+def _get_registry():
+    global _registry
+    mtime = _file_mtime()
+    registry = _registry
+    if mtime is not None and mtime == registry[0]:
+        return registry
+    with _registry_lock:
+        if mtime is None or mtime != _registry[0]:
+            lang_db = _read_langs()
+            if lang_db is not None:
+                _registry = (mtime, lang_db, _resolve(lang_db))
+        return _registry
+
+def _read_langs():
+    try:
+        with open(LANGUAGES_PATH, 'r', encoding="utf-8") as langs:
+            return json.load(langs)
+    except (OSError, ValueError):
         print('Ocorreu um erro ao carregar a base de dados.')
+        return None
+
+def invalidate():
+    """Força a releitura do arquivo na próxima consulta."""
+    global _registry
+    with _registry_lock:
+        _registry = (None,) + _registry[1:]
+
+def load_langs():
+    """Cópia do conteúdo bruto de languages.json (pode ser alterada pelo chamador)."""
+    raw = _get_registry()[1]
+    return json.loads(json.dumps(raw)) if raw is not None else None
 
 def save_new_lang(lang):
-    with open('./config/languages.json', 'w') as f:
-        json.dump(lang, f, indent=4)
+    """Grava de forma atômica: arquivo temporário no mesmo diretório + os.replace."""
+    directory = os.path.dirname(os.path.abspath(LANGUAGES_PATH))
+    fd, tmp_path = tempfile.mkstemp(prefix='.languages-', suffix='.json', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as f:
+            json.dump(lang, f, indent=4)
+        try: os.chmod(tmp_path, os.stat(LANGUAGES_PATH).st_mode & 0o777) # mkstemp cria com 0600
+        except OSError: pass
+        os.replace(tmp_path, LANGUAGES_PATH)
+    except BaseException:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+    invalidate()
 
 def change_general_language(new_lang):
     languages = load_langs()
-    if new_lang in languages:
+    if languages and new_lang in languages:
         lang_content = languages[new_lang]
         if 'default' in languages:
             del languages['default']
@@ -25,11 +86,11 @@ def change_general_language(new_lang):
         return False
 
 def get_user_lang(user_lang):
-    langs = load_langs()
+    langs = _get_registry()[2]
     if user_lang in langs:
-        return langs[user_lang][0]
+        return langs[user_lang]
     else:
-        return langs["default"][0]
+        return langs.get("default")
 
 if __name__ == '__main__':
     print("This module should not be run directly.")
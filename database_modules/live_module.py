@@ -0,0 +1,123 @@
+"""
+Комнаты Socket.IO для событий в реальном времени.
+Раньше новые посты и готовые миниатюры рассылались всем подключенным клиентам сайта, а
+socket.js отбрасывал события чужих досок. Теперь клиент при подключении сообщает страницу
+(auth: {board, thread}) и попадает в одну комнату: доски ('board:<uri>' - страница доски и
+каталог) или треда ('thread:<id>'). События отправляются только в комнаты своей доски и
+треда, поэтому стоимость рассылки растет с аудиторией доски, а не всего сайта.
+
+Счетчики подписчиков ведутся в процессе; при работе нескольких воркеров через message_queue
+каждый воркер считает только свои соединения.
+"""
+
+import threading
+import logging
+from collections import Counter
+
+from flask import request
+from flask_socketio import join_room
+
+logger = logging.getLogger(__name__)
+
+MAX_BOARD_URI_LENGTH = 64 # Длиннее URI досок не бывает; защита от мусора в auth
+
+
+def board_room(board_uri):
+    return f"board:{board_uri}"
+
+def thread_room(thread_id):
+    return f"thread:{thread_id}"
+
+def item_rooms(board_uri, thread_id=None):
+    """Комнаты, которым интересно событие поста: доска и (для ответа) тред. Сокет получает событие один раз."""
+    rooms = [board_room(board_uri)]
+    if thread_id: rooms.append(thread_room(thread_id))
+    return rooms
+
+
+def resolve_room(auth):
+    """(комната, доска) для данных подключения {board, thread} или None (нет такой доски/треда)."""
+    from . import database_module
+    if not isinstance(auth, dict): return None
+    board_uri, thread = auth.get('board'), auth.get('thread')
+    if not isinstance(board_uri, str) or not board_uri or len(board_uri) > MAX_BOARD_URI_LENGTH:
+        return None
+    if thread not in (None, ''):
+        try: thread_id = int(thread)
+        except (TypeError, ValueError): return None
+        row = database_module.execute_query("SELECT 1 FROM posts WHERE post_id = ? AND board_uri = ?",
+                                            (thread_id, board_uri), fetchone=True)
+        return (thread_room(thread_id), board_uri) if row else None
+    return (board_room(board_uri), board_uri) if database_module.get_board_info(board_uri) else None
+
+
+class LiveRooms:
+    """Подписка сокетов на комнаты при подключении, адресная рассылка и счетчики подписчиков."""
+
+    def __init__(self):
+        self._socketio = None
+        self._lock = threading.Lock()
+        self._rooms = {} # sid -> (комната, доска)
+        self._counts = Counter() # комната -> подписчиков
+        self._audience = Counter() # доска -> подписчиков страниц доски и ее тредов
+        self._stats = {'connections': 0, 'unsubscribed': 0, 'emitted': 0}
+
+    def init_app(self, app, socketio):
+        self._socketio = socketio
+        app.extensions['live_rooms'] = self
+        socketio.on_event('connect', self._on_connect)
+        socketio.on_event('disconnect', self._on_disconnect)
+
+    def _on_connect(self, auth=None):
+        try:
+            subscription = resolve_room(auth)
+        except Exception as e:
+            logger.error(f"Не удалось определить комнату для подключения: {e}", exc_info=True)
+            subscription = None
+        with self._lock:
+            self._stats['connections'] += 1
+            if subscription is None:
+                self._stats['unsubscribed'] += 1
+                return
+            previous = self._rooms.get(request.sid)
+            if previous is not None: self._release(previous)
+            self._rooms[request.sid] = subscription
+            self._counts[subscription[0]] += 1
+            self._audience[subscription[1]] += 1
+        join_room(subscription[0])
+
+    def _on_disconnect(self):
+        with self._lock:
+            subscription = self._rooms.pop(request.sid, None)
+            if subscription is not None: self._release(subscription)
+
+    def _release(self, subscription):
+        room, board_uri = subscription
+        for counter, key in ((self._counts, room), (self._audience, board_uri)):
+            counter[key] -= 1
+            if counter[key] <= 0: del counter[key]
+
+    def emit(self, event, payload, board_uri, thread_id=None):
+        """Отправляет событие подписчикам доски и (если указан) треда."""
+        if self._socketio is None: return False
+        self._socketio.emit(event, payload, to=item_rooms(board_uri, thread_id))
+        self._stats['emitted'] += 1
+        return True
+
+    def subscribers(self, board_uri=None, thread_id=None):
+        """Подписчики треда или вся аудитория доски (страница, каталог и треды)."""
+        with self._lock:
+            if thread_id is not None: return self._counts.get(thread_room(thread_id), 0)
+            return self._audience.get(board_uri, 0)
+
+    def stats(self):
+        with self._lock:
+            rooms = dict(self._counts)
+            return dict(self._stats, subscribed=len(self._rooms), boards=dict(self._audience), rooms=rooms)
+
+
+live_rooms = LiveRooms()
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
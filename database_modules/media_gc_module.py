@@ -0,0 +1,320 @@
+"""
+Фоновое удаление медиафайлов.
+Удаление поста, ответа или доски больше не удаляет файлы в запросе: пути ставятся в таблицу
+media_gc_queue одним INSERT ... SELECT в той же транзакции, что и DELETE (и только после
+фиксации становятся видны сборщику). Поток сборщика удаляет файлы пачками по GC_BATCH_SIZE.
+
+Файл, которым снова владеет хранилище (media_store_module: то же содержимое загрузили заново
+после освобождения), не удаляется. Проверка и удаление пачки выполняются в транзакции
+BEGIN IMMEDIATE, а загрузка регистрирует объект до переноса файла, поэтому сборщик не может
+удалить только что загруженный файл.
+
+Периодически сборщик освобождает объекты без ссылок, у которых истек RELEASE_GRACE_SECONDS
+(например, файлы поста, который так и не был сохранен), и сверяет содержимое post_images и
+reply_images с базой (scan_orphans): файлы, на которые ничего не ссылается, и брошенные
+временные файлы старше ORPHAN_MIN_AGE учитываются как занимающие место зря и ставятся в очередь.
+"""
+
+import os
+import time
+import logging
+import threading
+
+from . import media_module
+from . import media_store_module
+
+logger = logging.getLogger(__name__)
+
+GC_BATCH_SIZE = 500 # Файлов за одну транзакцию сборщика
+GC_INTERVAL = 30.0 # Секунд между проверками очереди и освобождением объектов без ссылок
+RECONCILE_INTERVAL = int(os.environ.get('PEJCHAN_MEDIA_GC_RECONCILE_INTERVAL', 6 * 3600)) # 0 - не сверять
+RECONCILE_DELAY = 300 # Первая сверка - через столько секунд после запуска
+# 'delete' - найденные файлы-сироты ставятся в очередь, 'report' - только подсчитываются
+RECONCILE_MODE = os.environ.get('PEJCHAN_MEDIA_GC_RECONCILE', 'delete')
+ORPHAN_MIN_AGE = 24 * 3600 # Более новые файлы могут принадлежать загрузке, которая еще не сохранила пост
+
+MEDIA_FOLDERS = ('post_images', 'reply_images') # Относительно static; в каждой есть thumbs/
+# Столбец файлов и папка оригиналов для таблиц постов и ответов
+ITEM_FILE_COLUMNS = {'posts': ('post_images', 'post_images/'), 'replies': ('images', 'reply_images/')}
+TEMP_PREFIXES = ('.upload-',) # media_store_module.store_stream
+TEMP_SUFFIXES = ('.tmp',) # Недописанные миниатюры и варианты (media_module)
+
+MEDIA_GC_QUEUE_TABLE = """
+    CREATE TABLE IF NOT EXISTS media_gc_queue (
+        path TEXT PRIMARY KEY, -- Относительно static ('post_images/<имя>', 'post_images/thumbs/<имя>')
+        queued_at REAL NOT NULL
+    ) WITHOUT ROWID
+"""
+
+
+def create_media_gc_table(conn):
+    conn.execute(MEDIA_GC_QUEUE_TABLE)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_gc_queue_time ON media_gc_queue (queued_at)")
+
+
+# --- Постановка в очередь (в транзакции вызывающего) ---
+def queue_paths(conn, rel_paths):
+    """Ставит пути (относительно static) в очередь удаления. Возвращает количество переданных путей."""
+    rows = [(path, time.time()) for path in dict.fromkeys(rel_paths) if path and isinstance(path, str)]
+    if rows:
+        conn.executemany("INSERT OR IGNORE INTO media_gc_queue (path, queued_at) VALUES (?, ?)", rows)
+    return len(rows)
+
+def queue_item_files(conn, table, where_sql, params=()):
+    """
+    Ставит в очередь оригиналы и миниатюры строк posts/replies (псевдоним item), выбранных
+    условием where_sql. Вызывается до DELETE: файлы читаются из JSON-столбцов средствами SQLite,
+    без загрузки строк в Python (доска может содержать тысячи постов).
+    """
+    files_column, folder = ITEM_FILE_COLUMNS[table]
+    now = time.time()
+    for column, prefix in ((files_column, folder), ('imagesthb', '')):
+        conn.execute(f"""
+            INSERT OR IGNORE INTO media_gc_queue (path, queued_at)
+            SELECT ? || f.value, ? FROM {table} AS item,
+                json_each(CASE WHEN json_valid(item.{column}) THEN item.{column} ELSE '[]' END) AS f
+            WHERE f.type = 'text' AND f.value != '' AND ({where_sql})
+        """, (prefix, now) + tuple(params))
+
+def queue_standalone(rel_paths):
+    """Ставит пути в очередь в отдельной транзакции и будит сборщик."""
+    from . import database_module
+    try:
+        with database_module.db_transaction() as conn:
+            queue_paths(conn, rel_paths)
+    except Exception as e:
+        logger.error(f"Не удалось поставить файлы в очередь удаления: {e}", exc_info=True)
+        return False
+    media_gc.wake()
+    return True
+
+
+# --- Проверка путей ---
+def _safe_abs_path(static_root, rel_path):
+    """Абсолютный путь файла внутри папок загрузок или None для подозрительного пути."""
+    rel_path = rel_path.replace('\\', '/')
+    if '..' in rel_path.split('/') or rel_path.startswith('/') or rel_path.split('/', 1)[0] not in MEDIA_FOLDERS:
+        return None
+    full_path = os.path.abspath(os.path.join(static_root, rel_path))
+    if os.path.commonpath([os.path.abspath(static_root), full_path]) != os.path.abspath(static_root):
+        return None
+    return full_path
+
+def _is_temp_name(name):
+    return name.startswith(TEMP_PREFIXES) or name.endswith(TEMP_SUFFIXES)
+
+
+# --- Сверка с базой ---
+REFERENCED_PATHS_SQL = """
+    SELECT 'post_images/' || f.value FROM posts AS item,
+        json_each(CASE WHEN json_valid(item.post_images) THEN item.post_images ELSE '[]' END) AS f
+    UNION ALL
+    SELECT f.value FROM posts AS item,
+        json_each(CASE WHEN json_valid(item.imagesthb) THEN item.imagesthb ELSE '[]' END) AS f
+    UNION ALL
+    SELECT 'reply_images/' || f.value FROM replies AS item,
+        json_each(CASE WHEN json_valid(item.images) THEN item.images ELSE '[]' END) AS f
+    UNION ALL
+    SELECT f.value FROM replies AS item,
+        json_each(CASE WHEN json_valid(item.imagesthb) THEN item.imagesthb ELSE '[]' END) AS f
+    UNION ALL SELECT path FROM media_objects
+    UNION ALL SELECT thumb_rel FROM media_objects WHERE thumb_rel IS NOT NULL
+    UNION ALL SELECT original_rel FROM media_jobs
+    UNION ALL SELECT thumb_rel FROM media_jobs
+    UNION ALL SELECT path FROM media_gc_queue
+"""
+
+def _referenced_paths(conn):
+    """Множество путей, на которые ссылается база (строки читаются курсором, а не списком)."""
+    referenced = set()
+    for (path,) in conn.execute(REFERENCED_PATHS_SQL):
+        if isinstance(path, str): referenced.add(path)
+    return referenced
+
+def _is_referenced(rel_path, referenced, thumb_stems):
+    if rel_path in referenced: return True
+    # Вариант миниатюры (thumbs/<имя>_<ширина>.<формат>) живет, пока жива сама миниатюра
+    stem = os.path.splitext(rel_path)[0]
+    base, _, width = stem.rpartition('_')
+    return bool(base) and width.isdigit() and base in thumb_stems
+
+def scan_orphans(static_root, min_age=ORPHAN_MIN_AGE, queue=False):
+    """
+    Сверяет папки загрузок с базой. Возвращает отчет: сколько файлов просмотрено, сколько
+    из них - сироты старше min_age и сколько байт можно освободить; при queue=True сироты
+    ставятся в очередь удаления. Папки читаются os.scandir по одной записи.
+    """
+    from . import database_module
+    started = time.monotonic()
+    with database_module.db_connection() as conn:
+        referenced = _referenced_paths(conn)
+    thumb_stems = {os.path.splitext(path)[0] for path in referenced if '/thumbs/' in path}
+    cutoff = time.time() - min_age
+    report = {'scanned': 0, 'orphans': 0, 'reclaimable_bytes': 0, 'temp_files': 0, 'queued': 0, 'by_folder': {}}
+    batch = []
+
+    def flush():
+        if not batch: return
+        with database_module.db_transaction() as conn:
+            report['queued'] += queue_paths(conn, batch)
+        batch.clear()
+
+    for folder in MEDIA_FOLDERS:
+        for rel_dir in (folder, f"{folder}/thumbs"):
+            abs_dir = os.path.join(static_root, rel_dir)
+            try: entries = os.scandir(abs_dir)
+            except OSError: continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if not entry.is_file(follow_symlinks=False): continue
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if entry.name.startswith('.') and not _is_temp_name(entry.name): continue # .gitkeep и т.п.
+                    report['scanned'] += 1
+                    rel_path = f"{rel_dir}/{entry.name}"
+                    if stat.st_mtime > cutoff or _is_referenced(rel_path, referenced, thumb_stems):
+                        continue
+                    report['orphans'] += 1
+                    report['reclaimable_bytes'] += stat.st_size
+                    if _is_temp_name(entry.name): report['temp_files'] += 1
+                    folder_report = report['by_folder'].setdefault(rel_dir, {'files': 0, 'bytes': 0})
+                    folder_report['files'] += 1; folder_report['bytes'] += stat.st_size
+                    if queue:
+                        batch.append(rel_path)
+                        if len(batch) >= GC_BATCH_SIZE: flush()
+    if queue: flush()
+    report['seconds'] = round(time.monotonic() - started, 3)
+    report['finished_at'] = time.time()
+    return report
+
+
+# --- Сборщик ---
+class MediaCollector:
+    """Фоновый поток: удаляет файлы из media_gc_queue пачками, освобождает объекты и сверяет папки."""
+
+    def __init__(self, batch_size=GC_BATCH_SIZE, interval=GC_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._static_root = None
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._next_reconcile = time.monotonic() + RECONCILE_DELAY
+        self._stats = {'deleted': 0, 'deleted_bytes': 0, 'kept': 0, 'missing': 0, 'errors': 0, 'released': 0, 'last_scan': None}
+
+    def init_app(self, app, static_root=None):
+        """Запоминает папку static и запускает поток (периодические задачи нужны и без удалений)."""
+        self._static_root = static_root or app.static_folder
+        app.extensions['media_gc'] = self
+        self.start()
+
+    def _root(self):
+        if self._static_root: return self._static_root
+        from . import database_module
+        return database_module.STATIC_FOLDER_PATH
+
+    def start(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid(): self._reset_state()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='media-gc', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        from . import database_module
+        while True:
+            try:
+                database_module._ensure_derived_schema()
+                self.release_expired()
+                while self.collect_batch() >= self.batch_size:
+                    time.sleep(0) # Между пачками другие транзакции успевают взять блокировку
+                if RECONCILE_INTERVAL and time.monotonic() >= self._next_reconcile:
+                    self._next_reconcile = time.monotonic() + RECONCILE_INTERVAL
+                    self.reconcile(queue=RECONCILE_MODE == 'delete')
+            except Exception as e:
+                logger.error(f"Ошибка сборщика медиафайлов: {e}", exc_info=True)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def release_expired(self):
+        """Освобождает объекты хранилища без ссылок, у которых истек срок ожидания."""
+        from . import database_module
+        with database_module.db_transaction() as conn:
+            released = media_store_module.release_unreferenced(conn)
+            queue_paths(conn, released)
+        self._stats['released'] += len(released)
+        return len(released)
+
+    def collect_batch(self):
+        """Удаляет одну пачку файлов из очереди. Возвращает количество обработанных путей."""
+        from . import database_module
+        static_root = self._root()
+        with database_module.db_transaction() as conn:
+            paths = [row[0] for row in conn.execute(
+                "SELECT path FROM media_gc_queue ORDER BY queued_at LIMIT ?", (self.batch_size,))]
+            if not paths: return 0
+            kept = media_store_module.tracked_paths(conn, paths) # Содержимое загрузили снова
+            to_delete = []
+            for path in paths:
+                if path in kept: self._stats['kept'] += 1; continue
+                to_delete.append(path)
+                if '/thumbs/' in path:
+                    to_delete.extend(media_module.variant_files(path, static_root))
+            for path in to_delete:
+                self._unlink(static_root, path)
+            conn.executemany("DELETE FROM media_gc_queue WHERE path = ?", [(path,) for path in paths])
+        return len(paths)
+
+    def _unlink(self, static_root, rel_path):
+        full_path = _safe_abs_path(static_root, rel_path)
+        if full_path is None:
+            logger.warning(f"Пропуск подозрительного пути в очереди удаления: '{rel_path}'")
+            self._stats['errors'] += 1
+            return
+        try:
+            size = os.path.getsize(full_path)
+            os.remove(full_path)
+        except FileNotFoundError:
+            self._stats['missing'] += 1
+        except OSError as e:
+            logger.error(f"Не удалось удалить файл {full_path}: {e}")
+            self._stats['errors'] += 1
+        else:
+            self._stats['deleted'] += 1; self._stats['deleted_bytes'] += size
+
+    def reconcile(self, queue=False, min_age=ORPHAN_MIN_AGE):
+        report = scan_orphans(self._root(), min_age=min_age, queue=queue)
+        self._stats['last_scan'] = report
+        logger.info(f"Сверка медиафайлов: просмотрено {report['scanned']}, сирот {report['orphans']} "
+                    f"({report['reclaimable_bytes']} байт), в очередь {report['queued']}, {report['seconds']} с")
+        if report['queued']: self._wakeup.set()
+        return report
+
+    def depth(self):
+        from . import database_module
+        row = database_module.execute_query("SELECT COUNT(*) AS depth FROM media_gc_queue", fetchone=True)
+        return row['depth'] if row else 0
+
+    def stats(self):
+        return dict(self._stats, queued=self.depth(), batch_size=self.batch_size)
+
+
+media_gc = MediaCollector()
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
@@ -0,0 +1,690 @@
+"""
+Асинхронная обработка загруженных файлов.
+Запрос только сохраняет оригинал и ставит задачу в таблицу media_jobs; миниатюры
+создаются в пуле процессов. Пока задача не выполнена, страница показывает заглушку
+"обработка", а по готовности клиенты получают событие SocketIO 'thumbnail_ready'.
+
+Очередь живет в SQLite, поэтому переживает перезапуск и делится между процессами
+веб-сервера: задача забирается атомарно (UPDATE ... RETURNING в BEGIN IMMEDIATE).
+Задачи, упавшие с исключением или вместе с процессом-воркером, повторяются до MAX_ATTEMPTS раз;
+глубина очереди ограничена MAX_QUEUE_DEPTH. Каждый воркер - отдельный процесс со своим каналом,
+поэтому зависшая задача (дольше JOB_TIMEOUT) снимается завершением только ее процесса:
+поврежденный файл не может занять воркер навсегда, а задачи других воркеров не затрагиваются.
+Для видео воркер также возвращает метаданные (media_meta), которые показывают шаблоны.
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import logging
+import threading
+import multiprocessing
+import multiprocessing.connection
+
+from PIL import Image, ExifTags
+import cv2
+
+logger = logging.getLogger(__name__)
+
+THUMB_SIZE = (250, 250)
+WORKERS = int(os.environ.get('PEJCHAN_MEDIA_WORKERS', max(1, min(2, os.cpu_count() or 1))))
+MAX_QUEUE_DEPTH = int(os.environ.get('PEJCHAN_MEDIA_QUEUE_DEPTH', 64)) # Задач в очереди и в работе
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 5 # Секунд; умножается на номер попытки
+JOB_LEASE_SECONDS = 300 # Задача в 'running' дольше этого считается брошенной и возвращается в очередь
+POLL_INTERVAL = 2.0 # Проверка задач других процессов и отложенных повторов
+# Задача дольше этого считается зависшей (поврежденный файл): ее процесс-воркер завершается
+JOB_TIMEOUT = int(os.environ.get('PEJCHAN_MEDIA_JOB_TIMEOUT', 60))
+VIDEO_TIME_BUDGET = float(os.environ.get('PEJCHAN_VIDEO_BUDGET', 10)) # Секунд на открытие видео и поиск обложки
+POSTER_OFFSET_SECONDS = 1.0 # Обложка - кадр примерно через секунду от начала
+
+# Миниатюры этих типов строятся в пуле; для mp3 копируется статичная картинка прямо в запросе
+WORKER_EXTENSIONS = {'.jpeg', '.jpg', '.png', '.webp', '.gif', '.mp4', '.mov', '.webm'}
+IMAGE_EXTENSIONS = {'.jpeg', '.jpg', '.png', '.webp', '.gif'}
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.webm'}
+MP3_THUMB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'play.jpg')
+
+PENDING_STATES = ('queued', 'running')
+
+MEDIA_JOBS_TABLE = """
+    CREATE TABLE IF NOT EXISTS media_jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item_kind TEXT NOT NULL, -- 'post' или 'reply'
+        item_id INTEGER NOT NULL, -- post_id или reply_id
+        board_uri TEXT NOT NULL,
+        thread_id INTEGER NOT NULL,
+        original_rel TEXT NOT NULL, -- Путь оригинала относительно static
+        thumb_rel TEXT NOT NULL, -- Путь миниатюры относительно static (как в imagesthb)
+        file_ext TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued', -- queued / running / failed (выполненные удаляются)
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL, -- time.time(), раньше которого задачу не брать (повторы)
+        claimed_at REAL,
+        last_error TEXT
+    )
+"""
+
+MEDIA_JOBS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_media_jobs_status ON media_jobs (status, available_at)",
+    "CREATE INDEX IF NOT EXISTS idx_media_jobs_item ON media_jobs (item_id)",
+]
+
+# Удаленный пост или ответ больше не нуждается в миниатюрах
+MEDIA_JOBS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_media_jobs_post_delete AFTER DELETE ON posts
+    BEGIN
+        DELETE FROM media_jobs WHERE item_id = OLD.post_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_media_jobs_reply_delete AFTER DELETE ON replies
+    BEGIN
+        DELETE FROM media_jobs WHERE item_id = OLD.reply_id;
+    END
+    """,
+]
+
+
+# Метаданные видео, полученные воркером вместе с обложкой: шаблоны не открывают файлы
+MEDIA_META_TABLE = """
+    CREATE TABLE IF NOT EXISTS media_meta (
+        path TEXT PRIMARY KEY, -- Оригинал относительно static (как media_objects.path)
+        width INTEGER,
+        height INTEGER,
+        duration REAL, -- Секунд; NULL, если контейнер ее не сообщает
+        codec TEXT, -- FourCC видеопотока ('avc1', 'VP90', ...)
+        fps REAL
+    ) WITHOUT ROWID
+"""
+
+# Файл с одинаковым содержимым общий для постов (media_store_module): метаданные живут, пока жив объект
+MEDIA_META_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS trg_media_meta_object_delete AFTER DELETE ON media_objects
+    BEGIN
+        DELETE FROM media_meta WHERE path = OLD.path;
+    END
+"""
+
+
+def create_media_jobs_table(conn):
+    conn.execute(MEDIA_JOBS_TABLE)
+    for sql in MEDIA_JOBS_INDEXES + MEDIA_JOBS_TRIGGERS:
+        conn.execute(sql)
+
+def create_media_meta_table(conn):
+    """Таблица метаданных; вызывается после create_media_store (триггер на media_objects)."""
+    conn.execute(MEDIA_META_TABLE)
+    conn.execute(MEDIA_META_TRIGGER)
+
+
+# --- Миниатюры (выполняются в процессе-воркере) ---
+def process_media(original_path, thumb_path, file_ext):
+    """Задача пула: (создана ли миниатюра, метаданные видео или None, варианты [[формат, ширина], ...])."""
+    result = {}
+    ok = generate_thumbnail(original_path, thumb_path, file_ext, result)
+    return ok, result.get('meta'), result.get('variants') or []
+
+def generate_thumbnail(original_path, thumb_path, file_ext, result=None):
+    """
+    Создает миниатюру и ее варианты (write_variants). Файлы пишутся во временные и
+    переименовываются, поэтому веб-сервер никогда не отдаст недописанную миниатюру.
+    В словарь result (если передан) записываются 'meta' (метаданные видео, см. video_info)
+    и 'variants'. Возвращает True/False; исключения пробрасываются (ошибка попадет в last_error).
+    """
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    tmp_path = f"{thumb_path}.{os.getpid()}.tmp"
+    result = {} if result is None else result
+    try:
+        if file_ext in ['.jpeg', '.jpg', '.png', '.webp']:
+            thumb, has_transparency = _image_thumbnail(original_path)
+        elif file_ext == '.gif':
+            with Image.open(original_path) as img:
+                img.seek(0) # Нужен только первый кадр - остальные не декодируются
+                thumb, has_transparency = shrink_image(img.convert('RGBA'), THUMB_SIZE), True
+        elif file_ext in VIDEO_EXTENSIONS:
+            thumb, result['meta'] = capture_frame_from_video(original_path)
+            if thumb is None: return False
+            has_transparency = False
+        elif file_ext == '.mp3':
+            if not os.path.exists(MP3_THUMB_PATH): return False
+            shutil.copy2(MP3_THUMB_PATH, tmp_path) # Общая картинка - варианты не нужны
+            os.replace(tmp_path, thumb_path)
+            return True
+        else:
+            logger.warning(f"Генерация миниатюр не поддерживается для расширения: {file_ext}")
+            return False
+        save_thumbnail(thumb, tmp_path, has_transparency)
+        os.replace(tmp_path, thumb_path)
+        result['variants'] = write_variants(thumb, thumb_path, has_transparency)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            try: os.remove(tmp_path)
+            except OSError: pass
+
+# --- Варианты миниатюр (srcset / <picture>) ---
+# Основная миниатюра (JPEG/PNG) остается запасным вариантом для старых браузеров и JS;
+# варианты в современных форматах в несколько раз меньше (особенно PNG первого кадра GIF)
+VARIANT_WIDTHS = (125, 250) # Ширина в пикселях; больше самой миниатюры не бывает
+VARIANT_ENCODERS = { # В порядке предпочтения для <source>
+    'avif': {'quality': 55},
+    'webp': {'quality': 80, 'method': 4},
+}
+
+def _can_encode(format_name):
+    Image.init() # Регистрирует все плагины: AVIF есть только в сборках Pillow с libavif
+    return format_name.upper() in Image.SAVE
+
+VARIANT_FORMATS = [fmt for fmt in VARIANT_ENCODERS if _can_encode(fmt)]
+
+def variant_rel(thumb_rel, fmt, width):
+    """Путь варианта рядом с миниатюрой: thumbs/thumb_<хеш>.jpg -> thumbs/thumb_<хеш>_125.webp."""
+    return f"{os.path.splitext(thumb_rel)[0]}_{width}.{fmt}"
+
+def write_variants(thumb, thumb_path, has_transparency=False):
+    """Сохраняет варианты миниатюры (изображение в памяти) и возвращает их описания [[формат, ширина], ...]."""
+    if not VARIANT_FORMATS: return []
+    img = thumb.convert('RGBA' if has_transparency else 'RGB')
+    variants = []
+    for width in sorted({min(width, img.width) for width in VARIANT_WIDTHS}):
+        sized = img if width == img.width else img.resize(
+            (width, max(1, round(img.height * width / img.width))), Image.Resampling.LANCZOS)
+        for fmt in VARIANT_FORMATS:
+            path = variant_rel(thumb_path, fmt, width)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                sized.save(tmp_path, format=fmt.upper(), **VARIANT_ENCODERS[fmt])
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning(f"Вариант {path} не создан: {e}")
+                try: os.remove(tmp_path)
+                except OSError: pass
+                continue
+            variants.append([fmt, width])
+    return variants
+
+def existing_variants(thumb_path):
+    """Варианты уже созданной миниатюры (повторная загрузка того же содержимого) - по файлам на диске."""
+    thumb_dir, stem = os.path.split(os.path.splitext(thumb_path)[0])
+    variants = []
+    try: names = set(os.listdir(thumb_dir)) if VARIANT_FORMATS else set()
+    except OSError: return []
+    for fmt in VARIANT_FORMATS:
+        prefix, suffix = f"{stem}_", f".{fmt}"
+        widths = sorted(int(name[len(prefix):-len(suffix)]) for name in names
+                        if name.startswith(prefix) and name.endswith(suffix) and name[len(prefix):-len(suffix)].isdigit())
+        variants.extend([fmt, width] for width in widths)
+    return variants
+
+def variant_files(thumb_rel, static_root):
+    """Все файлы вариантов миниатюры на диске (пути относительно static) - для удаления."""
+    return [variant_rel(thumb_rel, fmt, width) for fmt, width in existing_variants(os.path.join(static_root, thumb_rel))]
+
+def record_variants(conn, item_kind, item_id, variants_by_thumb):
+    """Дописывает варианты в столбец thumb_variants поста/ответа (в транзакции вызывающего)."""
+    table, id_column = ('posts', 'post_id') if item_kind == 'post' else ('replies', 'reply_id')
+    for thumb_rel, variants in variants_by_thumb.items():
+        conn.execute(f"""
+            UPDATE {table} SET thumb_variants = json_set(COALESCE(thumb_variants, '{{}}'), ?, json(?))
+            WHERE {id_column} = ?
+        """, (f'$."{thumb_rel}"', json.dumps(variants), item_id))
+
+def thumb_sources(variants_json):
+    """
+    {путь миниатюры: [{'type': 'image/webp', 'srcset': [(путь варианта, ширина), ...]}, ...]}
+    из столбца thumb_variants - для <source> в шаблонах.
+    """
+    if not variants_json: return {}
+    try:
+        recorded = json.loads(variants_json) if isinstance(variants_json, str) else variants_json
+    except (TypeError, ValueError):
+        return {}
+    sources = {}
+    for thumb_rel, variants in (recorded or {}).items():
+        by_format = {}
+        for fmt, width in variants or []:
+            by_format.setdefault(fmt, []).append((variant_rel(thumb_rel, fmt, width), width))
+        sources[thumb_rel] = [{'type': f'image/{fmt}', 'srcset': by_format[fmt]}
+                              for fmt in VARIANT_ENCODERS if fmt in by_format]
+    return sources
+
+# --- Движок миниатюр ---
+# Тег Orientation ищется один раз, а не перебором ExifTags.TAGS при каждом вызове
+ORIENTATION_TAG = next((tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation'), 0x0112)
+# Поворот/отражение для значений Orientation (как в ImageOps.exif_transpose)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180, 4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE, 6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# Запас разрешения перед финальным ресемплингом: draft()/reduce() уменьшают изображение
+# грубо (целым коэффициентом), а точный фильтр работает уже по небольшому промежуточному
+REDUCING_GAP = 2.0
+# Фильтр по оставшемуся коэффициенту уменьшения: при малом - резкий LANCZOS,
+# при большом (нет draft/reduce, например P-режим) - дешевые усредняющие фильтры
+RESAMPLE_BY_SCALE = [
+    (2.0, Image.Resampling.LANCZOS),
+    (4.0, Image.Resampling.BICUBIC),
+    (float('inf'), Image.Resampling.BOX),
+]
+
+def fit_size(size, box=THUMB_SIZE):
+    """Размер, вписанный в box с сохранением пропорций, без увеличения (округление как в Image.thumbnail)."""
+    width, height = size
+    x, y = box
+    if x >= width and y >= height:
+        return width, height
+    aspect = width / height
+    if x / y >= aspect:
+        x = max(min(math.floor(y * aspect), math.ceil(y * aspect), key=lambda n: abs(aspect - n / y)), 1)
+    else:
+        y = max(min(math.floor(x / aspect), math.ceil(x / aspect), key=lambda n: 0 if n == 0 else abs(aspect - x / n)), 1)
+    return x, y
+
+def choose_resample(scale):
+    for max_scale, resample in RESAMPLE_BY_SCALE:
+        if scale <= max_scale:
+            return resample
+    return Image.Resampling.BOX
+
+def read_orientation(img):
+    """Значение EXIF Orientation без декодирования пикселей (1, если нет)."""
+    try:
+        return img.getexif().get(ORIENTATION_TAG, 1) or 1
+    except Exception:
+        return 1
+
+def shrink_image(img, box=THUMB_SIZE, orientation=1):
+    """
+    Уменьшает изображение до box. Для JPEG draft() декодирует сразу в уменьшенном
+    масштабе (1/2..1/8), затем reduce() сжимает целым коэффициентом, и только
+    последний шаг - точный ресемплинг. Поворот по EXIF применяется к уже маленькому результату.
+    """
+    transpose = ORIENTATION_TRANSPOSE.get(orientation)
+    rotated = transpose in (Image.Transpose.TRANSPOSE, Image.Transpose.TRANSVERSE, Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270)
+    # Размер считается для повернутого изображения, уменьшается - исходное
+    if rotated:
+        target = fit_size((img.size[1], img.size[0]), box)[::-1]
+    else:
+        target = fit_size(img.size, box)
+    if img.format == 'JPEG' and img.mode in ('RGB', 'L', 'CMYK', 'YCbCr'):
+        img.draft(img.mode, (int(target[0] * REDUCING_GAP), int(target[1] * REDUCING_GAP)))
+    if img.mode == 'P':
+        img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        img = img.convert('RGB')
+    factor = int(min(img.size[0] / target[0], img.size[1] / target[1]) / REDUCING_GAP)
+    if factor >= 2:
+        img = img.reduce(factor)
+    if img.size != target:
+        img = img.resize(target, choose_resample(img.size[0] / target[0]))
+    if transpose is not None:
+        img = img.transpose(transpose)
+    return img
+
+def save_thumbnail(img, thumb_path, has_transparency=None):
+    """Сохраняет миниатюру: PNG для изображений с прозрачностью, иначе прогрессивный JPEG."""
+    if has_transparency is None:
+        has_transparency = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    if has_transparency:
+        if img.mode != 'RGBA': img = img.convert('RGBA')
+        img.save(thumb_path, format='PNG', optimize=True)
+    else:
+        if img.mode != 'RGB': img = img.convert('RGB')
+        img.save(thumb_path, format='JPEG', quality=85, optimize=True, progressive=True)
+
+def _image_thumbnail(original_path):
+    """(уменьшенное изображение, есть ли прозрачность)."""
+    with Image.open(original_path) as img:
+        orientation = read_orientation(img)
+        has_transparency = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        return shrink_image(img, THUMB_SIZE, orientation), has_transparency
+
+def video_info(cap):
+    """Метаданные из заголовка контейнера (кадры не декодируются)."""
+    fps = cap.get(cv2.CAP_PROP_FPS); frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    codec = ''.join(chr((fourcc >> 8 * i) & 0xff) for i in range(4)).strip('\x00 ')
+    fps = fps if fps and 0 < fps < 1000 else None # Контейнеры без индекса сообщают мусор
+    duration = frame_count / fps if fps and frame_count and frame_count > 0 else None
+    return {
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or None,
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or None,
+        'duration': round(duration, 3) if duration else None,
+        'codec': codec if codec.isprintable() and codec else None,
+        'fps': round(fps, 3) if fps else None,
+    }
+
+def _open_video(video_path, budget):
+    timeout_ms = max(1, int(budget * 1000))
+    # Таймауты ffmpeg прерывают зависшее открытие или чтение поврежденного файла
+    return cv2.VideoCapture(video_path, cv2.CAP_FFMPEG, [
+        cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, timeout_ms, cv2.CAP_PROP_READ_TIMEOUT_MSEC, timeout_ms,
+    ])
+
+def capture_frame_from_video(video_path, budget=None):
+    """
+    Возвращает (уменьшенный кадр-обложку, метаданные видео) или (None, None), если кадр не получен.
+    Кадры пропускаются через grab() (без преобразования в RGB) от начала до POSTER_OFFSET_SECONDS
+    (середины короткого видео): поиск по номеру кадра в OpenCV все равно декодирует от ближайшего
+    ключевого кадра, а в файлах без индекса - от начала, повторяя поиск при неудаче.
+    Вся работа ограничена бюджетом времени: по его исчерпании берется последний прочитанный кадр.
+    """
+    budget = VIDEO_TIME_BUDGET if budget is None else budget
+    deadline = time.monotonic() + budget
+    cap = None
+    try:
+        cap = _open_video(video_path, budget)
+        if not cap.isOpened(): return None, None
+        info = video_info(cap)
+        target_ms = POSTER_OFFSET_SECONDS * 1000
+        if info['duration']: target_ms = min(target_ms, info['duration'] * 500)
+        grabbed = 0
+        while time.monotonic() < deadline:
+            if not cap.grab(): break
+            grabbed += 1
+            if cap.get(cv2.CAP_PROP_POS_MSEC) >= target_ms: break
+        else:
+            logger.warning(f"Бюджет времени ({budget} с) исчерпан при поиске кадра в {video_path}, кадров: {grabbed}")
+        ret, frame = cap.retrieve() if grabbed else (False, None)
+        if not ret and grabbed:
+            # Поток кончился раньше цели (длительность неизвестна): берется первый кадр
+            cap.release(); cap = _open_video(video_path, max(0.1, deadline - time.monotonic()))
+            ret, frame = cap.read()
+        if not ret: return None, None
+        if not info['width'] or not info['height']:
+            info['height'], info['width'] = frame.shape[:2]
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return shrink_image(Image.fromarray(frame_rgb), THUMB_SIZE), info
+    finally:
+        if cap: cap.release()
+
+def probe_upload(path, file_ext):
+    """Быстрая проверка в запросе: изображение должно распознаваться Pillow (без декодирования)."""
+    if file_ext not in IMAGE_EXTENSIONS:
+        return True
+    try:
+        with Image.open(path):
+            return True
+    except Exception:
+        return False
+
+
+# --- Воркеры ---
+def _worker_main(conn):
+    """Цикл процесса-воркера: принимает аргументы process_media и возвращает ('ok', результат) или ('error', repr)."""
+    while True:
+        try:
+            args = conn.recv()
+        except (EOFError, OSError):
+            return # Диспетчер закрыл канал
+        try:
+            conn.send(('ok', process_media(*args)))
+        except Exception as e:
+            conn.send(('error', repr(e)))
+
+class _Worker:
+    """Процесс-воркер с собственным каналом: диспетчер знает, какую задачу он выполняет, и может снять только ее."""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), name='media-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.started = None # time.monotonic(), когда задача передана воркеру
+
+    def submit(self, job, args):
+        self.conn.send(args)
+        self.job, self.started = job, time.monotonic()
+
+    def receive(self):
+        """Возвращает (задача, результат, ошибка); при падении процесса ошибка - 'worker crashed'."""
+        job, self.job = self.job, None
+        try:
+            status, value = self.conn.recv()
+        except (EOFError, OSError):
+            self.kill()
+            return job, None, f'worker crashed: exit code {self.process.exitcode}'
+        return (job, value, None) if status == 'ok' else (job, None, value)
+
+    def alive(self):
+        return self.process.is_alive() and not self.conn.closed
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.join(1)
+        except Exception:
+            pass
+        self.conn.close()
+        self.job = None
+
+
+# --- Очередь ---
+def _static_root():
+    from . import database_module
+    return database_module.STATIC_FOLDER_PATH
+
+def get_thumb_states(item_ids):
+    """{item_id: {thumb_rel: status}} для незавершенных и неудачных задач."""
+    from . import database_module
+    if not item_ids: return {}
+    placeholders = ','.join('?' * len(item_ids))
+    sql = f"SELECT item_id, thumb_rel, status FROM media_jobs WHERE item_id IN ({placeholders})"
+    rows = database_module.execute_query(sql, tuple(item_ids), fetchall=True)
+    states = {}
+    for row in rows or []:
+        states.setdefault(row['item_id'], {})[row['thumb_rel']] = row['status']
+    if any(status in PENDING_STATES for item in states.values() for status in item.values()):
+        media_queue.start() # Например, задачи остались после перезапуска
+    return states
+
+def get_media_meta(rel_paths):
+    """{путь оригинала относительно static: метаданные} для известных файлов."""
+    from . import database_module
+    rel_paths = list(dict.fromkeys(rel_paths))
+    if not rel_paths: return {}
+    placeholders = ','.join('?' * len(rel_paths))
+    rows = database_module.execute_query(
+        f"SELECT path, width, height, duration, codec, fps FROM media_meta WHERE path IN ({placeholders})",
+        tuple(rel_paths), fetchall=True)
+    return {row['path']: dict(row) for row in rows or []}
+
+def has_pending(states):
+    return any(status in PENDING_STATES for status in (states or {}).values())
+
+
+class MediaQueue:
+    """Диспетчер: забирает задачи из media_jobs и выполняет их в процессах-воркерах."""
+
+    def __init__(self, workers=WORKERS, max_depth=MAX_QUEUE_DEPTH):
+        self.workers = max(1, workers)
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._app = None
+        self._socketio = None
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stats = {'done': 0, 'retried': 0, 'failed': 0}
+
+    def init_app(self, app, socketio=None):
+        """Запоминает приложение и SocketIO для уведомлений. Диспетчер стартует при первой задаче."""
+        self._app = app
+        self._socketio = socketio
+        app.extensions['media_queue'] = self
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset_state()
+
+    def start(self):
+        self._check_fork()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='media-queue', daemon=True)
+                self._thread.start()
+
+    def depth(self):
+        from . import database_module
+        row = database_module.execute_query(
+            "SELECT COUNT(*) AS depth FROM media_jobs WHERE status IN ('queued', 'running')", fetchone=True)
+        return row['depth'] if row else 0
+
+    def has_capacity(self, count=1):
+        """Ограничение глубины очереди: при перегрузке новые загрузки отклоняются, а не ждут в запросе."""
+        return self.depth() + count <= self.max_depth
+
+    def enqueue(self, item_kind, item_id, board_uri, thread_id, jobs):
+        """jobs: [(original_rel, thumb_rel, file_ext), ...]. Возвращает True, если задачи записаны."""
+        from . import database_module
+        if not jobs: return True
+        now = time.time()
+        rows = [(item_kind, item_id, board_uri, thread_id, original_rel, thumb_rel, file_ext, now)
+                for original_rel, thumb_rel, file_ext in jobs]
+        try:
+            with database_module.db_transaction() as conn:
+                conn.executemany("""
+                    INSERT INTO media_jobs (item_kind, item_id, board_uri, thread_id, original_rel, thumb_rel, file_ext, available_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+        except Exception as e:
+            logger.error(f"Не удалось поставить задачи обработки для {item_kind} {item_id}: {e}", exc_info=True)
+            return False
+        self.start()
+        self._wakeup.set()
+        return True
+
+    def _claim(self, limit):
+        from . import database_module
+        now = time.time()
+        with database_module.db_transaction() as conn:
+            return conn.execute("""
+                UPDATE media_jobs SET status = 'running', attempts = attempts + 1, claimed_at = :now
+                WHERE job_id IN (
+                    SELECT job_id FROM media_jobs
+                    WHERE (status = 'queued' AND available_at <= :now)
+                       OR (status = 'running' AND claimed_at < :stale)
+                    ORDER BY job_id LIMIT :limit
+                )
+                RETURNING job_id, item_kind, item_id, board_uri, thread_id, original_rel, thumb_rel, file_ext, attempts
+            """, {'now': now, 'stale': now - JOB_LEASE_SECONDS, 'limit': limit}).fetchall()
+
+    def _run(self):
+        # spawn: дочерние процессы не наследуют потоки и соединения веб-процесса
+        context = multiprocessing.get_context('spawn')
+        workers = []
+        while True:
+            try:
+                workers = [worker for worker in workers if worker.job is not None or worker.alive()]
+                idle = [worker for worker in workers if worker.job is None]
+                free = self.workers - (len(workers) - len(idle))
+                if free > 0:
+                    root = _static_root()
+                    for job in self._claim(free):
+                        try:
+                            if not idle: workers.append(_Worker(context)); idle.append(workers[-1])
+                            idle.pop().submit(job, (os.path.join(root, job['original_rel']),
+                                                    os.path.join(root, job['thumb_rel']), job['file_ext']))
+                        except Exception:
+                            self._release(job) # Воркер не запустился: задача возвращается в очередь без попытки
+                            raise
+                busy = [worker for worker in workers if worker.job is not None]
+                if busy:
+                    ready = multiprocessing.connection.wait([worker.conn for worker in busy], timeout=POLL_INTERVAL / 4)
+                    now = time.monotonic()
+                    for worker in busy:
+                        if worker.conn in ready:
+                            self._finish(*worker.receive())
+                        elif now - worker.started > JOB_TIMEOUT:
+                            job = worker.job
+                            logger.error(f"Обработка {job['original_rel']} дольше {JOB_TIMEOUT} с, процесс воркера завершается")
+                            worker.kill()
+                            self._finish(job, None, f'timed out after {JOB_TIMEOUT}s')
+                else:
+                    self._wakeup.wait(POLL_INTERVAL)
+                    self._wakeup.clear()
+            except Exception as e:
+                logger.error(f"Ошибка диспетчера обработки медиа: {e}", exc_info=True)
+                time.sleep(POLL_INTERVAL)
+
+    def _release(self, job):
+        from . import database_module
+        database_module.execute_query(
+            "UPDATE media_jobs SET status = 'queued', attempts = attempts - 1, claimed_at = NULL WHERE job_id = ?",
+            (job['job_id'],), commit=True)
+
+    def _finish(self, job, result, error=None):
+        """result - (ok, meta, variants) из process_media; error - причина, если результата нет."""
+        from . import database_module
+        ok, meta, variants = result if result is not None else (False, None, [])
+        retryable = job['attempts'] < MAX_ATTEMPTS
+        if result is not None and not ok:
+            error, retryable = 'thumbnail was not generated', False # Файл не читается - повтор не поможет
+
+        with database_module.db_transaction() as conn:
+            if ok:
+                still_wanted = conn.execute("DELETE FROM media_jobs WHERE job_id = ?", (job['job_id'],)).rowcount
+                if still_wanted and meta:
+                    conn.execute("""
+                        INSERT OR REPLACE INTO media_meta (path, width, height, duration, codec, fps)
+                        VALUES (:path, :width, :height, :duration, :codec, :fps)
+                    """, dict(meta, path=job['original_rel']))
+                if still_wanted and variants:
+                    record_variants(conn, job['item_kind'], job['item_id'], {job['thumb_rel']: variants})
+            elif retryable:
+                conn.execute("UPDATE media_jobs SET status = 'queued', available_at = ?, last_error = ? WHERE job_id = ?",
+                             (time.time() + RETRY_DELAY * job['attempts'], error, job['job_id']))
+            else:
+                conn.execute("UPDATE media_jobs SET status = 'failed', last_error = ? WHERE job_id = ?", (error, job['job_id']))
+
+        if ok and not still_wanted:
+            # Пост удален, пока строилась миниатюра; общая миниатюра хранилища останется (media_gc_module)
+            from . import media_gc_module
+            media_gc_module.queue_standalone([job['thumb_rel']])
+            return
+        if not ok and retryable:
+            self._stats['retried'] += 1
+            logger.warning(f"Миниатюра {job['thumb_rel']} не создана (попытка {job['attempts']}): {error}")
+            return
+
+        self._stats['done' if ok else 'failed'] += 1
+        if not ok: logger.error(f"Миниатюра {job['thumb_rel']} не создана (попыток: {job['attempts']}): {error}")
+        database_module.invalidate_render_fragments([job['item_id']])
+        if ok and variants and job['item_kind'] == 'post': # Варианты миниатюры OP видны в списке последних тредов
+            from . import recent_module
+            recent_module.recent_threads.update_thread(job['item_id'])
+        if ok: self._notify(job)
+
+    def _notify(self, job):
+        if self._socketio is None: return
+        from . import live_module # Комнаты доски и треда (живет в процессе приложения, не в воркерах)
+        static_url = self._app.static_url_path if self._app is not None else '/static'
+        try:
+            live_module.live_rooms.emit('thumbnail_ready', {
+                'id': job['item_id'], 'kind': job['item_kind'], 'thread_id': job['thread_id'],
+                'board': job['board_uri'], 'thumbnail': f"{static_url}/{job['thumb_rel']}",
+            }, job['board_uri'], job['thread_id'])
+        except Exception as e:
+            logger.error(f"Не удалось отправить thumbnail_ready для {job['item_id']}: {e}", exc_info=True)
+
+    def stats(self):
+        return dict(self._stats, workers=self.workers, max_depth=self.max_depth)
+
+
+media_queue = MediaQueue()
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
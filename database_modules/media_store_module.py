@@ -0,0 +1,217 @@
+"""
+Хранилище загруженных файлов с адресацией по содержимому.
+Файл сохраняется под именем из sha256 содержимого ('<sha256[:32]><ext>' в post_images/ или
+reply_images/), поэтому повторная загрузка той же картинки не создает ни нового файла,
+ни новой миниатюры. Таблица media_objects хранит хеш и число ссылок; ссылки (media_refs)
+записываются в транзакции создания поста, а счетчик поддерживается триггерами, как и
+остальные производные данные. Удаление поста уменьшает счетчики, а файлы удаляются только
+когда ссылок не осталось.
+
+Файлы, загруженные до появления хранилища, не отслеживаются и удаляются по-старому,
+пока database_setup.py не заполнит таблицы из существующих постов.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+HASH_NAME_LENGTH = 32 # Символов sha256 в имени файла
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Объект без ссылок не удаляется, пока его содержимое могла только что загрузить
+# другая форма (ссылка появится при сохранении поста)
+RELEASE_GRACE_SECONDS = 120
+
+MEDIA_OBJECTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS media_objects (
+        path TEXT PRIMARY KEY, -- Оригинал относительно static ('post_images/<sha256[:32]>.png')
+        sha256 TEXT NOT NULL,
+        thumb_rel TEXT, -- Миниатюра относительно static
+        size INTEGER,
+        refcount INTEGER NOT NULL DEFAULT 0, -- Поддерживается триггерами media_refs
+        touched_at REAL NOT NULL -- time.time() последней загрузки этого содержимого
+    )
+"""
+
+MEDIA_REFS_TABLE = """
+    CREATE TABLE IF NOT EXISTS media_refs (
+        path TEXT NOT NULL,
+        item_id INTEGER NOT NULL, -- post_id или reply_id
+        PRIMARY KEY (path, item_id)
+    ) WITHOUT ROWID
+"""
+
+MEDIA_STORE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_media_objects_sha256 ON media_objects (sha256)",
+    "CREATE INDEX IF NOT EXISTS idx_media_objects_thumb ON media_objects (thumb_rel)",
+    "CREATE INDEX IF NOT EXISTS idx_media_objects_unreferenced ON media_objects (touched_at) WHERE refcount <= 0",
+    "CREATE INDEX IF NOT EXISTS idx_media_refs_item ON media_refs (item_id)",
+]
+
+MEDIA_STORE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_media_refs_insert AFTER INSERT ON media_refs
+    BEGIN
+        UPDATE media_objects SET refcount = refcount + 1 WHERE path = NEW.path;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_media_refs_delete AFTER DELETE ON media_refs
+    BEGIN
+        UPDATE media_objects SET refcount = refcount - 1 WHERE path = OLD.path;
+    END
+    """,
+    # Удаление поста/ответа (в т.ч. каскадное при удалении треда или доски) снимает его ссылки
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_media_refs_post_delete AFTER DELETE ON posts
+    BEGIN
+        DELETE FROM media_refs WHERE item_id = OLD.post_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_media_refs_reply_delete AFTER DELETE ON replies
+    BEGIN
+        DELETE FROM media_refs WHERE item_id = OLD.reply_id;
+    END
+    """,
+]
+
+
+def content_name(sha256):
+    return sha256[:HASH_NAME_LENGTH]
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def store_stream(stream, folder_abs):
+    """
+    Копирует поток во временный файл в folder_abs, считая sha256 на лету.
+    Возвращает (sha256, size, tmp_path); вызывающий переименовывает или удаляет tmp_path.
+    """
+    digest = hashlib.sha256(); size = 0
+    fd, tmp_path = tempfile.mkstemp(prefix='.upload-', dir=folder_abs)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: stream.read(STREAM_CHUNK_SIZE), b''):
+                digest.update(chunk); size += len(chunk)
+                out.write(chunk)
+    except BaseException:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+    return digest.hexdigest(), size, tmp_path
+
+
+# --- Схема ---
+def media_store_exists(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'media_objects'").fetchone() is not None
+
+def create_media_store(conn, static_root=None, rebuild=False):
+    """
+    Создает таблицы и триггеры. При rebuild=True (нужен static_root) отслеживает файлы
+    всех существующих постов и ответов: хеширует их и пересчитывает ссылки.
+    Возвращает количество отслеживаемых объектов после заполнения.
+    """
+    conn.execute(MEDIA_OBJECTS_TABLE)
+    conn.execute(MEDIA_REFS_TABLE)
+    for sql in MEDIA_STORE_INDEXES + MEDIA_STORE_TRIGGERS:
+        conn.execute(sql)
+    if not rebuild or not static_root:
+        return 0
+    import json
+    conn.execute("DELETE FROM media_refs")
+    now = time.time()
+    sources = [
+        ("SELECT post_id, post_images, imagesthb FROM posts", 'post_images'),
+        ("SELECT reply_id, images, imagesthb FROM replies", 'reply_images'),
+    ]
+    for sql, folder in sources:
+        for item_id, files_json, thumbs_json in conn.execute(sql).fetchall():
+            try:
+                files = json.loads(files_json) if files_json else []
+                thumbs = json.loads(thumbs_json) if thumbs_json else []
+            except (TypeError, ValueError):
+                continue
+            for index, filename in enumerate(files):
+                if not filename or not isinstance(filename, str): continue
+                path = f"{folder}/{filename}"
+                full_path = os.path.join(static_root, path)
+                if not os.path.isfile(full_path): continue
+                thumb_rel = thumbs[index] if index < len(thumbs) else None
+                conn.execute("""
+                    INSERT INTO media_objects (path, sha256, thumb_rel, size, touched_at) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(path) DO NOTHING
+                """, (path, hash_file(full_path), thumb_rel, os.path.getsize(full_path), now))
+                conn.execute("INSERT OR IGNORE INTO media_refs (path, item_id) VALUES (?, ?)", (path, item_id))
+    return conn.execute("SELECT COUNT(*) FROM media_objects").fetchone()[0]
+
+
+# --- Объекты и ссылки ---
+def register_object(path, sha256, thumb_rel, size):
+    """
+    Регистрирует загруженное содержимое (или продлевает срок жизни известного объекта).
+    Возвращает True, если объект уже был в хранилище.
+    """
+    from . import database_module
+    with database_module.db_transaction() as conn:
+        existed = conn.execute("UPDATE media_objects SET touched_at = ? WHERE path = ?", (time.time(), path)).rowcount
+        if not existed:
+            conn.execute("INSERT INTO media_objects (path, sha256, thumb_rel, size, touched_at) VALUES (?, ?, ?, ?, ?)",
+                         (path, sha256, thumb_rel, size, time.time()))
+    return bool(existed)
+
+def discard_object(path, static_root):
+    """Удаляет только что зарегистрированный объект, если на него так и не сослались (файл оказался негодным)."""
+    from . import database_module
+    with database_module.db_transaction() as conn:
+        row = conn.execute("DELETE FROM media_objects WHERE path = ? AND refcount <= 0 RETURNING thumb_rel", (path,)).fetchone()
+    if row is None: return False
+    for rel_path in (path, row['thumb_rel']):
+        if not rel_path: continue
+        try: os.remove(os.path.join(static_root, rel_path))
+        except OSError: pass
+    return True
+
+def save_refs(conn, item_id, folder_rel, filenames):
+    """Записывает ссылки нового поста/ответа (в транзакции вызывающего); счетчики увеличат триггеры."""
+    if filenames:
+        conn.executemany("INSERT OR IGNORE INTO media_refs (path, item_id) VALUES (?, ?)",
+                         [(f"{folder_rel}/{filename}", item_id) for filename in filenames if filename])
+
+def release_unreferenced(conn):
+    """
+    Удаляет (в транзакции вызывающего) объекты без ссылок и возвращает пути их файлов
+    относительно static - удалить их с диска нужно после фиксации транзакции.
+    """
+    rows = conn.execute("""
+        DELETE FROM media_objects WHERE refcount <= 0 AND touched_at < ?
+        RETURNING path, thumb_rel
+    """, (time.time() - RELEASE_GRACE_SECONDS,)).fetchall()
+    released = []
+    for path, thumb_rel in rows:
+        released.append(path)
+        if thumb_rel: released.append(thumb_rel)
+    return released
+
+def tracked_paths(conn, rel_paths):
+    """Подмножество путей (относительно static), которыми владеет хранилище - как оригиналы или миниатюры."""
+    if not rel_paths: return set()
+    rel_paths = list(rel_paths)
+    placeholders = ','.join('?' * len(rel_paths))
+    tracked = set()
+    for path, thumb_rel in conn.execute(
+            f"SELECT path, thumb_rel FROM media_objects WHERE path IN ({placeholders}) OR thumb_rel IN ({placeholders})",
+            rel_paths + rel_paths):
+        tracked.add(path); tracked.add(thumb_rel)
+    return tracked & set(rel_paths)
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
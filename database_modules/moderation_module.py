@@ -4,11 +4,26 @@
 Timeout and Ban Management Module using SQLite
 Handles user timeouts and bans.
 Relies on database_module for DB connection and query execution.
+
+Active bans and timeouts are kept in memory (ModerationIndex): lookups are a dict access
+with precomputed expiry timestamps, no SQL and no date parsing per post. Writes go through
+to the database first. A single scheduler thread expires entries from a heap (instead of
+one threading.Timer per IP) and periodically reloads the tables, so that bans issued by
+other worker processes become visible.
+
+The bans table also holds range bans: user_ip is then an IPv4/IPv6 network in CIDR
+notation ('203.0.113.0/24', '2001:db8:1:2::/64'). Ranges are compiled into a PrefixIndex
+(one hash table per prefix length in use), so a check costs a few dict lookups no matter
+how many ranges are banned. Blocklists are imported with
+    python -m database_modules.moderation_module import-blocklist FILE [--reason ...] [--hours N]
 """
 
+import os
+import time
+import heapq
+import ipaddress
 import threading
 from datetime import datetime, timedelta, timezone
-# sqlite3 и os теперь не нужны здесь напрямую, если get_db_conn и execute_query импортируются
 import logging
 
 # --- Импортируем необходимые функции из database_module ---
@@ -18,6 +33,7 @@ import logging
 from .database_module import (
     get_db_conn,
     execute_query,
+    db_transaction,
     parse_datetime,             # Импортируем напрямую
     format_datetime_for_display # Импортируем напрямую
 )
@@ -26,12 +42,291 @@ from .database_module import (
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Перечитывание таблиц (баны и таймауты, выданные другими процессами); 0 - не перечитывать
+RELOAD_INTERVAL = float(os.environ.get('PEJCHAN_MODERATION_RELOAD_INTERVAL', 60))
+LOAD_RETRY_SECONDS = 5.0
+# Области бана из формы модератора: длина префикса для IPv4 и IPv6
+BAN_RANGES = {'subnet': (24, 64), 'wide': (16, 48)}
+
+
+# --- Адреса и диапазоны ---
+def parse_address(user_ip):
+    """ipaddress-объект адреса (IPv4-mapped IPv6 приводится к IPv4) или None."""
+    try: address = ipaddress.ip_address(user_ip.strip())
+    except (ValueError, AttributeError): return None
+    if address.version == 6 and address.ipv4_mapped is not None: return address.ipv4_mapped
+    return address
+
+def normalize_ban_target(target):
+    """
+    IP или CIDR -> (значение bans.user_ip, сеть или None). Диапазон из одного адреса хранится
+    как обычный IP; одиночный адрес не проверяется (бан ставится на то, что записано в посте).
+    ValueError для неверной записи CIDR.
+    """
+    target = (target or '').strip()
+    if '/' not in target:
+        return target, None
+    network = ipaddress.ip_network(target, strict=False)
+    if network.prefixlen == network.max_prefixlen: return str(network.network_address), None
+    return str(network), network
+
+def ban_range_for(user_ip, scope):
+    """CIDR-диапазон вокруг адреса для области из BAN_RANGES или сам адрес ('exact', неизвестная область)."""
+    address = parse_address(user_ip)
+    if scope not in BAN_RANGES or address is None: return user_ip
+    prefixlen = BAN_RANGES[scope][0 if address.version == 4 else 1]
+    return str(ipaddress.ip_network(f"{address}/{prefixlen}", strict=False))
+
+
+class PrefixIndex:
+    """
+    Диапазоны адресов: для каждой версии IP и длины префикса - словарь {номер сети: значение}.
+    Поиск проверяет только встречающиеся длины, от самой длинной (самый точный диапазон первым).
+    """
+
+    def __init__(self):
+        self._tables = {4: {}, 6: {}} # версия -> {длина префикса: {int(сеть) >> (бит - длина): значение}}
+        self._lengths = {4: (), 6: ()}
+
+    @staticmethod
+    def _key(network):
+        return int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+
+    def add(self, network, value):
+        self._tables[network.version].setdefault(network.prefixlen, {})[self._key(network)] = value
+        self._lengths[network.version] = tuple(sorted(self._tables[network.version], reverse=True))
+
+    def remove(self, network):
+        table = self._tables[network.version].get(network.prefixlen)
+        if table is None: return
+        table.pop(self._key(network), None)
+        if not table:
+            del self._tables[network.version][network.prefixlen]
+            self._lengths[network.version] = tuple(sorted(self._tables[network.version], reverse=True))
+
+    def lookup(self, address, accept=None):
+        """
+        Значение самого точного диапазона, содержащего адрес (и принятого accept), или None.
+        Вызывается без блокировки: remove() может удалить таблицу длины из уже прочитанного кортежа, такая длина пропускается.
+        """
+        value_int, bits = int(address), address.max_prefixlen
+        tables = self._tables[address.version]
+        for prefixlen in self._lengths[address.version]:
+            table = tables.get(prefixlen)
+            if table is None: continue
+            value = table.get(value_int >> (bits - prefixlen))
+            if value is not None and (accept is None or accept(value)): return value
+        return None
+
+    def empty(self):
+        return not (self._lengths[4] or self._lengths[6])
+
+    def __len__(self):
+        return sum(len(table) for tables in self._tables.values() for table in list(tables.values()))
+
+
+# --- In-memory index ---
+class _Entry:
+    __slots__ = ('expires', 'end_time_raw', 'info', 'network')
+
+    def __init__(self, expires, end_time_raw, info, network=None):
+        self.expires = expires # time.time() окончания или None для постоянного бана
+        self.end_time_raw = end_time_raw # end_time как в базе (условие удаления истекшей записи)
+        self.info = info # Готовый ответ check_timeout/is_banned
+        self.network = network # ipaddress-сеть для бана диапазона
+
+    def active(self, now=None):
+        return self.expires is None or self.expires > (now or time.time())
+
+
+class ModerationIndex:
+    """Активные таймауты и баны в памяти; один поток снимает истекшие и перечитывает базу."""
+
+    def __init__(self, reload_interval=RELOAD_INTERVAL):
+        self.reload_interval = reload_interval
+        self._fork_lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._entries = {'timeouts': {}, 'bans': {}} # Таблица -> {ip или CIDR: _Entry}
+        self._ranges = PrefixIndex() # Баны диапазонов
+        self._heap = [] # (expires, таблица, ip, end_time_raw)
+        self._loaded = False
+        self._next_reload = 0.0
+        self._thread = None
+        self._stats = {'loads': 0, 'expired': 0}
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            with self._fork_lock:
+                if self._pid != os.getpid():
+                    self._reset_state()
+
+    def _ensure_ready(self):
+        self._check_fork()
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded: self._load()
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='moderation-expiry', daemon=True)
+                    self._thread.start()
+
+    # --- Загрузка из базы (под self._lock) ---
+    def _load(self):
+        timeouts_rows = execute_query("SELECT user_ip, end_time, reason, moderator, applied_at FROM timeouts", fetchall=True)
+        bans_rows = execute_query("SELECT user_ip, end_time, reason, moderator, applied_at, is_permanent FROM bans", fetchall=True)
+        if timeouts_rows is None or bans_rows is None:
+            logger.error("Could not load bans/timeouts from the database; keeping the current index.")
+            self._next_reload = time.monotonic() + LOAD_RETRY_SECONDS
+            return False
+        now = time.time()
+        entries = {'timeouts': {}, 'bans': {}}
+        ranges = PrefixIndex()
+        heap = []
+        for row in timeouts_rows:
+            end_time = parse_datetime(row['end_time'])
+            expires = end_time.timestamp() if end_time else now # Неразбираемая запись удаляется сразу
+            if end_time and expires > now:
+                entries['timeouts'][row['user_ip']] = _Entry(expires, row['end_time'], {
+                    'is_timeout': True, 'end_time': end_time,
+                    'reason': row['reason'] or '', 'moderator': row['moderator'] or 'System'})
+            heap.append((expires, 'timeouts', row['user_ip'], row['end_time']))
+        for row in bans_rows:
+            applied_at = parse_datetime(row['applied_at'])
+            info = {'is_banned': True, 'is_permanent': bool(row['is_permanent']),
+                    'reason': row['reason'] or '', 'moderator': row['moderator'] or 'System',
+                    'applied_at': applied_at, 'applied_at_raw': row['applied_at']}
+            network = None
+            if '/' in row['user_ip']:
+                try: network = ipaddress.ip_network(row['user_ip'], strict=False)
+                except ValueError:
+                    logger.warning(f"Skipping invalid range ban '{row['user_ip']}'.")
+                    continue
+            if info['is_permanent']:
+                entries['bans'][row['user_ip']] = entry = _Entry(None, row['end_time'], info, network)
+                if network is not None: ranges.add(network, entry)
+                continue
+            end_time = parse_datetime(row['end_time'])
+            expires = end_time.timestamp() if end_time else now # Временный бан без даты окончания некорректен
+            if end_time and expires > now:
+                info['end_time'] = end_time
+                entries['bans'][row['user_ip']] = entry = _Entry(expires, row['end_time'], info, network)
+                if network is not None: ranges.add(network, entry)
+            else:
+                logger.info(f"Expired or invalid temporary ban for IP {row['user_ip']} found on load. Removing.")
+            heap.append((expires, 'bans', row['user_ip'], row['end_time']))
+        heapq.heapify(heap)
+        self._entries, self._ranges, self._heap = entries, ranges, heap
+        self._loaded = True
+        self._next_reload = time.monotonic() + self.reload_interval if self.reload_interval else float('inf')
+        self._stats['loads'] += 1
+        self._wakeup.notify()
+        return True
+
+    def reload(self):
+        self._check_fork()
+        with self._lock:
+            return self._load()
+
+    # --- Поток истечения ---
+    def _run(self):
+        while True:
+            try:
+                with self._lock:
+                    now = time.time()
+                    wait = self._next_reload - time.monotonic()
+                    if self._heap: wait = min(wait, self._heap[0][0] - now)
+                    if wait > 0:
+                        self._wakeup.wait(min(wait, 3600))
+                        continue
+                    due = []
+                    while self._heap and self._heap[0][0] <= now:
+                        expires, table, user_ip, end_time_raw = heapq.heappop(self._heap)
+                        entry = self._entries[table].get(user_ip)
+                        if entry is not None and entry.end_time_raw == end_time_raw:
+                            self._drop(table, user_ip)
+                        elif entry is not None:
+                            continue # Запись продлена - в куче уже есть новый срок
+                        due.append((table, user_ip, end_time_raw))
+                    reload_due = time.monotonic() >= self._next_reload
+                if due: self._delete_expired(due)
+                if reload_due: self.reload()
+            except Exception as e:
+                logger.error(f"Moderation expiry thread error: {e}", exc_info=True)
+                time.sleep(1)
+
+    def _delete_expired(self, due):
+        """Удаляет истекшие записи одной транзакцией. Запись, продленную другим процессом, не трогает."""
+        try:
+            with db_transaction() as conn:
+                for table, user_ip, end_time_raw in due:
+                    if end_time_raw is None:
+                        conn.execute(f"DELETE FROM {table} WHERE user_ip = ? AND end_time IS NULL AND is_permanent = 0", (user_ip,))
+                    else:
+                        conn.execute(f"DELETE FROM {table} WHERE user_ip = ? AND end_time = ?", (user_ip, end_time_raw))
+            self._stats['expired'] += len(due)
+        except Exception as e:
+            logger.error(f"Failed to delete {len(due)} expired bans/timeouts: {e}", exc_info=True)
+
+    # --- Запись (сначала база, затем память) ---
+    def put(self, table, user_ip, entry):
+        self._ensure_ready()
+        with self._lock:
+            previous = self._entries[table].get(user_ip)
+            if previous is not None and previous.network is not None: self._ranges.remove(previous.network)
+            self._entries[table][user_ip] = entry
+            if entry.network is not None: self._ranges.add(entry.network, entry)
+            if entry.expires is not None:
+                item = (entry.expires, table, user_ip, entry.end_time_raw)
+                heapq.heappush(self._heap, item)
+                if self._heap[0] is item: self._wakeup.notify()
+
+    def discard(self, table, user_ip):
+        self._ensure_ready()
+        with self._lock:
+            self._drop(table, user_ip) # Элемент кучи останется и будет пропущен
+
+    def _drop(self, table, user_ip):
+        entry = self._entries[table].pop(user_ip, None)
+        if entry is not None and entry.network is not None: self._ranges.remove(entry.network)
+
+    # --- Чтение ---
+    def get(self, table, user_ip):
+        """Активная запись или None. Словари читаются без блокировки."""
+        self._ensure_ready()
+        now = time.time()
+        entry = self._entries[table].get(user_ip)
+        if entry is not None and entry.active(now):
+            return entry
+        if table != 'bans' or self._ranges.empty():
+            return None
+        address = parse_address(user_ip)
+        if address is None: return None
+        return self._ranges.lookup(address, lambda candidate: candidate.active(now))
+
+    def active(self, table):
+        self._ensure_ready()
+        now = time.time()
+        return [(user_ip, entry) for user_ip, entry in list(self._entries[table].items()) if entry.active(now)]
+
+    def stats(self):
+        return dict(self._stats, timeouts=len(self._entries['timeouts']), bans=len(self._entries['bans']),
+                    ranges=len(self._ranges), scheduled=len(self._heap))
+
+
+moderation_index = ModerationIndex()
+
+
 # --- Timeout Management ---
 class TimeoutManager:
-    def __init__(self):
+    def __init__(self, index=None):
+        self.index = index or moderation_index
         self.lock = threading.Lock()
-        self.active_timers = {}
-        self.cleanup_expired()
 
     def apply_timeout(self, user_ip, duration_seconds=35, reason="", moderator="System"):
         with self.lock:
@@ -52,61 +347,25 @@ class TimeoutManager:
 
             if result is not None: # lastrowid или None при ошибке
                 logger.info(f"Timeout applied/updated for IP {user_ip} until {end_time_iso}. Reason: {reason}")
-                self._setup_timer(user_ip, duration_seconds)
+                self.index.put('timeouts', user_ip, _Entry(end_time_dt.timestamp(), end_time_iso, {
+                    'is_timeout': True, 'end_time': end_time_dt, 'reason': reason or '', 'moderator': moderator or 'System'}))
                 return True
             else:
                 logger.error(f"Failed to apply timeout for IP {user_ip}.")
                 return False
 
-    def _setup_timer(self, user_ip, duration):
-        if user_ip in self.active_timers:
-            self.active_timers[user_ip].cancel()
-        timer = threading.Timer(duration, self.remove_timeout_by_ip, args=[user_ip])
-        timer.daemon = True
-        timer.start()
-        self.active_timers[user_ip] = timer
-
     def remove_timeout_by_ip(self, user_ip):
         with self.lock:
             logger.info(f"Attempting to remove timeout for IP: {user_ip}")
             sql = "DELETE FROM timeouts WHERE user_ip = ?"
             execute_query(sql, (user_ip,), commit=True, fetchall=False)
-            if user_ip in self.active_timers:
-                try: self.active_timers[user_ip].cancel()
-                except Exception: pass # Игнорируем ошибки при отмене, если таймер уже завершился
-                del self.active_timers[user_ip]
+            self.index.discard('timeouts', user_ip)
 
     def check_timeout(self, user_ip):
-        sql = "SELECT * FROM timeouts WHERE user_ip = ?"
-        timeout_row = execute_query(sql, (user_ip,), fetchone=True)
-
-        if not timeout_row:
+        entry = self.index.get('timeouts', user_ip)
+        if entry is None:
             return {'is_timeout': False}
-        
-        timeout = dict(timeout_row) # Конвертируем sqlite3.Row в dict для удобства
-        try:
-            end_time_str = timeout.get('end_time')
-            end_time = parse_datetime(end_time_str) # Используем импортированную функцию
-            now = datetime.now(timezone.utc)
-
-            if end_time and now < end_time:
-                return {
-                    'is_timeout': True,
-                    'end_time': end_time,
-                    'reason': timeout.get('reason', ''),
-                    'moderator': timeout.get('moderator', 'System')
-                }
-            else:
-                if end_time is None and end_time_str:
-                     logger.error(f"Could not parse end_time '{end_time_str}' for timeout IP {user_ip}.")
-                logger.info(f"Expired or unparseable timeout found for IP {user_ip}. Removing.")
-                self.remove_timeout_by_ip(user_ip)
-                return {'is_timeout': False}
-        except Exception as e:
-             logger.error(f"Error processing timeout for IP {user_ip}: {e}", exc_info=True)
-             self.remove_timeout_by_ip(user_ip) # Удаляем при любой ошибке обработки
-             return {'is_timeout': False}
-
+        return dict(entry.info)
 
     def cleanup_expired(self):
         with self.lock:
@@ -118,16 +377,21 @@ class TimeoutManager:
 
 # --- Ban Management ---
 class BanManager:
-    def __init__(self):
+    def __init__(self, index=None):
+        self.index = index or moderation_index
         self.lock = threading.Lock()
-        self.active_timers = {}
-        self.cleanup_expired()
 
     def ban_user(self, user_ip, duration_seconds=None, reason="", moderator="System"):
+        """user_ip - адрес или диапазон в записи CIDR ('198.51.100.0/24', '2001:db8::/64')."""
+        try: user_ip, network = normalize_ban_target(user_ip)
+        except ValueError as e:
+            logger.error(f"Failed to apply ban: {e}")
+            return False
         with self.lock:
             now = datetime.now(timezone.utc)
             applied_at_iso = now.isoformat()
             is_permanent = duration_seconds is None
+            end_time_dt = None
             end_time_iso = None
             if not is_permanent and isinstance(duration_seconds, (int, float)) and duration_seconds > 0:
                 end_time_dt = now + timedelta(seconds=duration_seconds)
@@ -147,27 +411,18 @@ class BanManager:
             if result is not None:
                 ban_type = "Permanent" if is_permanent else f"Temporary until {end_time_iso}"
                 logger.info(f"{ban_type} ban applied/updated for IP {user_ip}. Reason: {reason}")
-                # Управляем таймером
-                if not is_permanent and duration_seconds and duration_seconds > 0:
-                    self._setup_timer(user_ip, duration_seconds)
-                elif user_ip in self.active_timers: # Если бан стал перманентным или длительность 0
-                    try: self.active_timers[user_ip].cancel()
-                    except Exception: pass
-                    del self.active_timers[user_ip]
+                info = {'is_banned': True, 'is_permanent': is_permanent, 'reason': reason or '',
+                        'moderator': moderator or 'System', 'applied_at': now, 'applied_at_raw': applied_at_iso}
+                if not is_permanent: info['end_time'] = end_time_dt
+                self.index.put('bans', user_ip, _Entry(None if is_permanent else end_time_dt.timestamp(), end_time_iso, info, network))
                 return True
             else:
                 logger.error(f"Failed to apply ban for IP {user_ip}.")
                 return False
 
-    def _setup_timer(self, user_ip, duration):
-        if user_ip in self.active_timers:
-            self.active_timers[user_ip].cancel()
-        timer = threading.Timer(duration, self.unban_user, args=[user_ip])
-        timer.daemon = True
-        timer.start()
-        self.active_timers[user_ip] = timer
-
     def unban_user(self, user_ip):
+        try: user_ip, _ = normalize_ban_target(user_ip)
+        except ValueError: pass
         with self.lock:
             logger.info(f"Attempting to unban IP: {user_ip}")
             sql = "DELETE FROM bans WHERE user_ip = ?"
@@ -176,10 +431,7 @@ class BanManager:
             # result будет lastrowid (не очень полезно для DELETE) или None при ошибке
             # Проверяем, что не было ошибки (result is not None)
             if result is not None:
-                if user_ip in self.active_timers:
-                    try: self.active_timers[user_ip].cancel()
-                    except Exception as e_timer: logger.warning(f"Could not cancel timer for unbanned IP {user_ip}: {e_timer}")
-                    del self.active_timers[user_ip]
+                self.index.discard('bans', user_ip)
                 logger.info(f"Ban for IP {user_ip} lifted.")
                 return True
             else:
@@ -189,101 +441,28 @@ class BanManager:
 
     def get_active_bans(self):
         active_bans_list = []
-        now_utc = datetime.now(timezone.utc)
-        all_bans_db = execute_query("SELECT * FROM bans", fetchall=True)
-
-        if not all_bans_db:
-            return []
-
-        for ban_row in all_bans_db:
-            ban = dict(ban_row) # Конвертируем sqlite3.Row в словарь
-            keep_ban = False
-            ban_info_for_template = {
-                'user_ip': ban['user_ip'],
-                'reason': ban.get('reason', 'N/A'),
-                'moderator': ban.get('moderator', 'System'),
-                'applied_at_raw': ban['applied_at'],
-                'is_permanent': bool(ban.get('is_permanent', 0))
-            }
-
-            applied_at_dt = parse_datetime(ban['applied_at']) # Используем импортированную функцию
-            ban_info_for_template['applied_at_display'] = format_datetime_for_display(applied_at_dt) if applied_at_dt else 'N/A'
-
-            if ban_info_for_template['is_permanent']:
-                ban_info_for_template['end_time_display'] = "Permanent"
-                keep_ban = True
-            else:
-                end_time_str = ban.get('end_time')
-                if end_time_str:
-                    end_time_dt = parse_datetime(end_time_str) # Используем импортированную функцию
-                    if end_time_dt and now_utc < end_time_dt:
-                        ban_info_for_template['end_time_display'] = format_datetime_for_display(end_time_dt)
-                        keep_ban = True
-                    elif end_time_dt and now_utc >= end_time_dt:
-                        logger.info(f"Expired temporary ban for IP {ban['user_ip']} found in get_active_bans. Removing.")
-                        self.unban_user(ban['user_ip']) # Удалит бан и связанный таймер
-                    elif not end_time_dt : # Ошибка парсинга end_time_str
-                        logger.error(f"Could not parse end_time '{end_time_str}' for ban IP {ban['user_ip']}. Removing ban.")
-                        self.unban_user(ban['user_ip']) # Удаляем некорректный бан
-                else: # Временный бан без end_time - некорректно
-                    logger.warning(f"Temporary ban for IP {ban['user_ip']} has no end_time. Removing ban.")
-                    self.unban_user(ban['user_ip']) # Удаляем некорректный бан
-            
-            if keep_ban:
-                active_bans_list.append(ban_info_for_template)
+        for user_ip, entry in self.index.active('bans'):
+            info = entry.info
+            active_bans_list.append({
+                'user_ip': user_ip,
+                'reason': info['reason'] or 'N/A',
+                'moderator': info['moderator'],
+                'applied_at_raw': info['applied_at_raw'],
+                'is_permanent': info['is_permanent'],
+                'applied_at_display': format_datetime_for_display(info['applied_at']) if info['applied_at'] else 'N/A',
+                'end_time_display': "Permanent" if info['is_permanent'] else format_datetime_for_display(info['end_time']),
+            })
 
         active_bans_list.sort(key=lambda x: x['applied_at_raw'], reverse=True)
         return active_bans_list
 
     def is_banned(self, user_ip):
-        sql = "SELECT * FROM bans WHERE user_ip = ?"
-        ban_row = execute_query(sql, (user_ip,), fetchone=True)
-
-        if not ban_row:
+        entry = self.index.get('bans', user_ip)
+        if entry is None:
             return {'is_banned': False}
-        
-        ban = dict(ban_row) # Конвертируем в dict
-
-        if ban.get('is_permanent') == 1:
-             applied_at_dt = parse_datetime(ban['applied_at']) # Используем импортированную функцию
-             return {
-                'is_banned': True,
-                'is_permanent': True,
-                'reason': ban.get('reason', ''),
-                'moderator': ban.get('moderator', 'System'),
-                'applied_at': applied_at_dt
-             }
-        else:
-            end_time_str = ban.get('end_time')
-            if end_time_str:
-                end_time_dt = parse_datetime(end_time_str) # Используем импортированную функцию
-                now = datetime.now(timezone.utc)
-
-                if end_time_dt and now < end_time_dt:
-                    applied_at_dt = parse_datetime(ban['applied_at'])
-                    return {
-                        'is_banned': True,
-                        'is_permanent': False,
-                        'end_time': end_time_dt,
-                        'reason': ban.get('reason', ''),
-                        'moderator': ban.get('moderator', 'System'),
-                        'applied_at': applied_at_dt
-                    }
-                elif end_time_dt and now >= end_time_dt: # Бан истек
-                    logger.info(f"Expired temporary ban for IP {user_ip} checked by is_banned. Removing.")
-                    self.unban_user(user_ip)
-                    return {'is_banned': False}
-                elif not end_time_dt : # Ошибка парсинга
-                     logger.error(f"Could not parse end_time '{end_time_str}' for is_banned check IP {user_ip}. Removing ban.")
-                     self.unban_user(user_ip)
-                     return {'is_banned': False}
-            else: # Временный бан без end_time
-                 logger.warning(f"Temporary ban for IP {user_ip} has no end_time in is_banned. Removing ban.")
-                 self.unban_user(user_ip)
-                 return {'is_banned': False}
-        
-        # На случай, если ни одно из условий выше не выполнилось (не должно происходить)
-        return {'is_banned': False}
+        info = dict(entry.info)
+        info.pop('applied_at_raw', None)
+        return info
 
 
     def cleanup_expired(self):
@@ -296,8 +475,68 @@ class BanManager:
             logger.info("Expired temporary bans cleanup complete.")
 
 
-if __name__ == '__main__':
-    logger.info("Moderation module loaded (run directly). Example checks can be added here.")
-    logger.info("This module should typically be imported by other parts of the application.")
+# --- Bulk import ---
+def read_blocklist(lines):
+    """
+    Разбирает строки списка блокировок: один IP или CIDR в начале строки, комментарии
+    после '#' или ';'. Возвращает (список нормализованных записей, количество неверных строк).
+    """
+    targets, invalid = [], 0
+    for line in lines:
+        line = line.split('#', 1)[0].split(';', 1)[0].strip()
+        if not line: continue
+        token = line.split()[0]
+        try:
+            target, network = normalize_ban_target(token)
+            if network is None and parse_address(target) is None: raise ValueError(token)
+        except ValueError:
+            invalid += 1
+            continue
+        targets.append(target)
+    return list(dict.fromkeys(targets)), invalid
+
+def import_blocklist(path, reason="Blocklist", moderator="System", duration_seconds=None, index=None):
+    """
+    Импортирует список блокировок из локального файла одной транзакцией (существующие баны тех же
+    адресов заменяются) и перестраивает индекс. Возвращает {'imported', 'invalid'} или None при ошибке.
+    """
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            targets, invalid = read_blocklist(f)
+    except OSError as e:
+        logger.error(f"Could not read blocklist '{path}': {e}")
+        return None
+    now = datetime.now(timezone.utc)
+    end_time_iso = (now + timedelta(seconds=duration_seconds)).isoformat() if duration_seconds else None
+    rows = [(target, end_time_iso, reason, moderator, now.isoformat(), 0 if duration_seconds else 1) for target in targets]
+    try:
+        with db_transaction() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO bans (user_ip, end_time, reason, moderator, applied_at, is_permanent)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+    except Exception as e:
+        logger.error(f"Failed to import blocklist '{path}': {e}", exc_info=True)
+        return None
+    (index or moderation_index).reload()
+    logger.info(f"Imported {len(rows)} bans from '{path}' ({invalid} invalid lines skipped).")
+    return {'imported': len(rows), 'invalid': invalid}
+
 
-# --- END OF FILE moderation_module.py ---
\ No newline at end of file
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Moderation tools (run as: python -m database_modules.moderation_module ...)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import-blocklist', help="ban every IP/CIDR listed in a local file")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--reason', default="Blocklist")
+    import_parser.add_argument('--moderator', default="System")
+    import_parser.add_argument('--hours', type=float, default=None, help="temporary ban duration (default: permanent)")
+    args = parser.parse_args()
+    if args.command == 'import-blocklist':
+        result = import_blocklist(args.path, reason=args.reason, moderator=args.moderator,
+                                  duration_seconds=int(args.hours * 3600) if args.hours else None)
+        if result is None: raise SystemExit(1)
+        print(f"Imported: {result['imported']}, invalid lines skipped: {result['invalid']}")
+
+# --- END OF FILE moderation_module.py ---
@@ -0,0 +1,90 @@
+"""
+Индекс цитат (>>N) между постами.
+Ребро (from_id, to_id, thread_id) записывается один раз при создании поста или ответа,
+страница читает обратные ссылки одним запросом по своим тредам вместо поиска
+data-id регулярным выражением в HTML каждого поста при каждом запросе.
+Удаление поста/ответа (в т.ч. каскадное) удаляет его ребра триггерами.
+"""
+
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Те же выражения, что раньше применялись при рендере страницы
+QUOTE_HTML_RE = re.compile(r'data-id="(\d+)"')
+QUOTE_RAW_RE = re.compile(r'>>(\d+)')
+
+POST_QUOTES_TABLE = """
+    CREATE TABLE IF NOT EXISTS post_quotes (
+        thread_id INTEGER NOT NULL, -- Тред цитирующего поста
+        from_id INTEGER NOT NULL, -- post_id или reply_id цитирующего поста
+        to_id INTEGER NOT NULL, -- Процитированный номер (пост может быть в другом треде или уже удален)
+        PRIMARY KEY (thread_id, from_id, to_id)
+    ) WITHOUT ROWID
+"""
+
+POST_QUOTES_TRIGGERS = [
+    # Удаление треда убирает ребра OP и всех его ответов
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_post_quotes_post_delete AFTER DELETE ON posts
+    BEGIN
+        DELETE FROM post_quotes WHERE thread_id = OLD.post_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_post_quotes_reply_delete AFTER DELETE ON replies
+    BEGIN
+        DELETE FROM post_quotes WHERE thread_id = OLD.post_id AND from_id = OLD.reply_id;
+    END
+    """,
+]
+
+
+def extract_quote_ids(html_content, raw_content=None):
+    """
+    Номера, на которые ссылается пост, в порядке появления и без повторов.
+    Ищет data-id в отформатированном HTML; если HTML пуст - >>N в исходном тексте.
+    """
+    if html_content:
+        matches = QUOTE_HTML_RE.findall(html_content)
+    elif raw_content:
+        matches = QUOTE_RAW_RE.findall(raw_content)
+    else:
+        return []
+    return list(dict.fromkeys(int(quoted_id) for quoted_id in matches))
+
+def save_quotes(conn, from_id, thread_id, html_content, raw_content=None):
+    """Записывает ребра нового поста/ответа (в транзакции вызывающего). Возвращает их количество."""
+    quoted_ids = extract_quote_ids(html_content, raw_content)
+    if quoted_ids:
+        conn.executemany(
+            "INSERT OR IGNORE INTO post_quotes (thread_id, from_id, to_id) VALUES (?, ?, ?)",
+            [(thread_id, from_id, to_id) for to_id in quoted_ids]
+        )
+    return len(quoted_ids)
+
+def quote_table_exists(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_quotes'").fetchone() is not None
+
+def create_quote_table(conn, rebuild=True):
+    """
+    Создает таблицу и триггеры. При rebuild=True заполняет ребра заново из всех
+    существующих постов и ответов. Возвращает количество записанных ребер.
+    """
+    conn.execute(POST_QUOTES_TABLE)
+    for trigger_sql in POST_QUOTES_TRIGGERS:
+        conn.execute(trigger_sql)
+    if not rebuild:
+        return 0
+    conn.execute("DELETE FROM post_quotes")
+    total = 0
+    for row in conn.execute("SELECT post_id, post_content, original_content FROM posts"):
+        total += save_quotes(conn, row[0], row[0], row[1], row[2])
+    for row in conn.execute("SELECT reply_id, post_id, content FROM replies"):
+        total += save_quotes(conn, row[0], row[1], row[2])
+    return total
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
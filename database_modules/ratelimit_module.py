@@ -0,0 +1,263 @@
+"""
+Ограничение частоты постинга маркерными корзинами (token bucket).
+Раньше каждый пост записывал 35-секундный таймаут в таблицу timeouts, а следующий пост читал
+его обратно. Теперь для каждой пары (IP, доска) и действия ведется корзина в памяти процесса:
+    'thread'       - создание треда (маркер на тред),
+    'reply'        - ответ (маркер на ответ),
+    'upload_bytes' - объем загружаемых файлов (маркер на байт).
+Лимит задается как "capacity за per_seconds": корзина вмещает capacity маркеров (допустимый
+всплеск) и пополняется со скоростью capacity / per_seconds. Лимиты доски хранятся в таблице
+board_rate_limits (недостающие действия берутся из DEFAULT_LIMITS) и перечитываются раз в
+LIMITS_RELOAD_INTERVAL секунд, так что проверка на пути запроса не обращается к диску.
+
+Несколько воркеров могут делить корзины через SQLite-файл вне основной базы
+(PEJCHAN_RATELIMIT_BACKEND=sqlite). По умолчанию файл создается в /dev/shm (общая память,
+без записи на диск), иначе в instance/.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import Counter, namedtuple
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+ACTIONS = ('thread', 'reply', 'upload_bytes')
+Limit = namedtuple('Limit', 'capacity per_seconds')
+# Средний темп прежнего таймаута (один пост в 35 секунд), но с небольшим запасом на всплеск ответов
+DEFAULT_LIMITS = {
+    'thread': Limit(1, 35),
+    'reply': Limit(5, 175),
+    'upload_bytes': Limit(60 * MB, 300),
+}
+LIMITS_RELOAD_INTERVAL = 60.0 # Лимиты досок, измененные в другом процессе, подхватываются за это время
+PRUNE_INTERVAL = 300.0 # Как часто удалять заполнившиеся (ничего не помнящие) корзины
+
+BACKEND = os.environ.get('PEJCHAN_RATELIMIT_BACKEND', 'memory') # 'memory' или 'sqlite'
+_SHM_DIR = '/dev/shm'
+_INSTANCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance')
+SQLITE_PATH = os.environ.get('PEJCHAN_RATELIMIT_DB') or os.path.join(
+    _SHM_DIR if os.path.isdir(_SHM_DIR) and os.access(_SHM_DIR, os.W_OK) else _INSTANCE_DIR, 'pejchan-ratelimit.sqlite3')
+
+BOARD_RATE_LIMITS_TABLE = """
+    CREATE TABLE IF NOT EXISTS board_rate_limits (
+        board_uri TEXT NOT NULL REFERENCES boards (board_uri) ON DELETE CASCADE,
+        action TEXT NOT NULL, -- thread, reply, upload_bytes
+        capacity REAL NOT NULL, -- Маркеров в полной корзине
+        per_seconds REAL NOT NULL, -- За сколько секунд корзина наполняется с нуля
+        PRIMARY KEY (board_uri, action)
+    ) WITHOUT ROWID
+"""
+
+
+def create_rate_limits_table(conn):
+    conn.execute(BOARD_RATE_LIMITS_TABLE)
+
+
+def refill(tokens, updated, now, limit):
+    return min(limit.capacity, tokens + (now - updated) * limit.capacity / limit.per_seconds)
+
+def take_tokens(tokens, amount, limit):
+    """
+    Списывает amount маркеров. Возвращает (разрешено, остаток, секунд до разрешения).
+    Запрос больше всей корзины (большой файл) разрешается при полной корзине и уводит ее в минус.
+    """
+    needed = min(amount, limit.capacity)
+    if tokens >= needed:
+        return True, tokens - amount, 0.0
+    return False, tokens, (needed - tokens) * limit.per_seconds / limit.capacity
+
+
+# --- Хранилища корзин ---
+class MemoryBackend:
+    """Корзины в словаре процесса."""
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {} # ключ -> (маркеры, время обновления, лимит)
+        self._next_prune = time.monotonic() + PRUNE_INTERVAL
+
+    def take(self, key, amount, limit):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (limit.capacity, now, limit))
+            allowed, tokens, retry_after = take_tokens(refill(tokens, updated, now, limit), amount, limit)
+            self._buckets[key] = (tokens, now, limit)
+            if now >= self._next_prune: self._prune(now)
+        return allowed, retry_after
+
+    def give(self, key, amount, limit):
+        now = time.monotonic()
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated, _ = self._buckets[key]
+                self._buckets[key] = (min(limit.capacity, refill(tokens, updated, now, limit) + amount), now, limit)
+
+    def _prune(self, now):
+        self._next_prune = now + PRUNE_INTERVAL
+        full = [key for key, (tokens, updated, limit) in self._buckets.items() if refill(tokens, updated, now, limit) >= limit.capacity]
+        for key in full: del self._buckets[key]
+
+    def size(self):
+        return len(self._buckets)
+
+
+class SQLiteBackend:
+    """
+    Корзины в отдельном SQLite-файле, общем для воркеров (по умолчанию в /dev/shm).
+    Чтение и списание выполняются в одной транзакции BEGIN IMMEDIATE.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._ops = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._pid != os.getpid(): # Соединение не переживает fork
+            self._pid = os.getpid()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF") # Корзины можно потерять при сбое - это не данные
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, per_seconds REAL NOT NULL) WITHOUT ROWID")
+            self._local.conn = conn
+        return conn
+
+    def _update(self, key, amount, limit, give=False):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = refill(row[0], row[1], now, limit) if row else limit.capacity
+            if give:
+                result = None
+                tokens = min(limit.capacity, tokens + amount)
+            else:
+                allowed, tokens, retry_after = take_tokens(tokens, amount, limit)
+                result = (allowed, retry_after)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated, per_seconds) VALUES (?, ?, ?, ?)",
+                         (key, tokens, now, limit.per_seconds))
+            self._ops += 1
+            if self._ops % 1000 == 0: # Заполнившиеся корзины больше ничего не ограничивают
+                conn.execute("DELETE FROM buckets WHERE updated + per_seconds < ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def take(self, key, amount, limit):
+        return self._update(key, amount, limit)
+
+    def give(self, key, amount, limit):
+        self._update(key, amount, limit, give=True)
+
+    def size(self):
+        return self._conn().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+# --- Ограничитель ---
+class RateLimiter:
+    """Проверяет и списывает маркеры; лимиты досок держит в памяти."""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._board_limits = {} # доска -> {действие: Limit}
+        self._limits_loaded_at = None
+        self._stats = {'allowed': Counter(), 'rejected': Counter(), 'errors': 0}
+
+    def _backend(self):
+        if self.backend is None:
+            with self._lock:
+                if self.backend is None:
+                    self.backend = SQLiteBackend() if BACKEND == 'sqlite' else MemoryBackend()
+        return self.backend
+
+    # --- Лимиты досок ---
+    def _load_limits(self):
+        from . import database_module
+        rows = database_module.execute_query("SELECT board_uri, action, capacity, per_seconds FROM board_rate_limits", fetchall=True)
+        self._limits_loaded_at = time.monotonic() # При ошибке повтор через интервал, а пока - лимиты по умолчанию
+        if rows is None: return
+        limits = {}
+        for row in rows:
+            if row['action'] in ACTIONS and row['capacity'] > 0 and row['per_seconds'] > 0:
+                limits.setdefault(row['board_uri'], {})[row['action']] = Limit(row['capacity'], row['per_seconds'])
+        self._board_limits = limits
+
+    def limits_for(self, board_uri):
+        loaded_at = self._limits_loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > LIMITS_RELOAD_INTERVAL:
+            with self._lock:
+                if self._limits_loaded_at is loaded_at: self._load_limits()
+        return dict(DEFAULT_LIMITS, **self._board_limits.get(board_uri, {}))
+
+    def set_board_limits(self, board_uri, limits):
+        """Записывает лимиты доски {действие: (capacity, per_seconds)}; None вместо пары - вернуть значение по умолчанию."""
+        from . import database_module
+        try:
+            with database_module.db_transaction() as conn:
+                for action, limit in limits.items():
+                    if action not in ACTIONS: raise ValueError(f"Unknown action '{action}'")
+                    if limit is None:
+                        conn.execute("DELETE FROM board_rate_limits WHERE board_uri = ? AND action = ?", (board_uri, action))
+                        continue
+                    capacity, per_seconds = float(limit[0]), float(limit[1])
+                    if capacity <= 0 or per_seconds <= 0: raise ValueError(f"Invalid limit for '{action}'")
+                    conn.execute("INSERT OR REPLACE INTO board_rate_limits (board_uri, action, capacity, per_seconds) VALUES (?, ?, ?, ?)",
+                                 (board_uri, action, capacity, per_seconds))
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Лимиты доски '{board_uri}' не изменены: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"Не удалось сохранить лимиты доски '{board_uri}': {e}", exc_info=True)
+            return False
+        with self._lock: self._load_limits()
+        return True
+
+    # --- Проверка ---
+    def acquire(self, user_ip, board_uri, action, amount=1):
+        """
+        Списывает amount маркеров действия. Возвращает (разрешено, секунд до разрешения).
+        Ошибка хранилища корзин не блокирует постинг.
+        """
+        limit = self.limits_for(board_uri)[action]
+        try:
+            allowed, retry_after = self._backend().take(f"{user_ip}|{board_uri}|{action}", amount, limit)
+        except Exception as e:
+            self._stats['errors'] += 1
+            logger.error(f"Ошибка ограничителя частоты ({action}, {user_ip}): {e}", exc_info=True)
+            return True, 0.0
+        self._stats['allowed' if allowed else 'rejected'][action] += 1
+        return allowed, retry_after
+
+    def release(self, user_ip, board_uri, action, amount=1):
+        """Возвращает маркеры, списанные под действие, которое не состоялось (пост не сохранен)."""
+        try:
+            self._backend().give(f"{user_ip}|{board_uri}|{action}", amount, self.limits_for(board_uri)[action])
+        except Exception as e:
+            self._stats['errors'] += 1
+            logger.error(f"Ошибка ограничителя частоты при возврате ({action}, {user_ip}): {e}", exc_info=True)
+
+    def stats(self):
+        try: buckets = self._backend().size()
+        except Exception: buckets = None
+        return {'backend': self._backend().name, 'buckets': buckets, 'errors': self._stats['errors'],
+                'allowed': dict(self._stats['allowed']), 'rejected': dict(self._stats['rejected'])}
+
+
+rate_limiter = RateLimiter()
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
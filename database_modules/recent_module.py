@@ -0,0 +1,97 @@
+"""
+Последние поднятые треды для главной страницы и панели управления.
+Раньше главная читала все треды сайта (SELECT * FROM posts ORDER BY last_bumped DESC) и брала
+первые шесть, поэтому стоимость самой посещаемой страницы росла с числом тредов. Теперь запрос
+ограничен LIMIT и нужными столбцами (database_module.get_recent_threads) и идет по индексу
+idx_post_last_bumped, а первые CACHE_SIZE тредов хранятся в памяти процесса: новый тред и
+подъем треда обновляют список на месте, удаление постов и досок сбрасывает его.
+
+Изменения, сделанные другими воркерами, подхватываются перезагрузкой раз в RELOAD_INTERVAL
+секунд. PEJCHAN_RECENT_THREADS=0 отключает список - тогда каждый вызов читает базу.
+"""
+
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+try: CACHE_SIZE = max(int(os.environ.get('PEJCHAN_RECENT_THREADS', 50)), 0)
+except ValueError:
+    logger.warning("Неверное значение PEJCHAN_RECENT_THREADS, используется 50.")
+    CACHE_SIZE = 50
+RELOAD_INTERVAL = 30.0 # секунды
+
+
+def _by_bump(row):
+    return (row['last_bumped'] or '', row['post_id'])
+
+
+class RecentThreads:
+    """Список последних поднятых тредов (словари, новые первыми), поддерживаемый событиями постинга."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._rows = None # None - список не загружен или сброшен
+        self._loaded_at = 0.0
+        self._generation = 0 # Меняется при каждом изменении: загрузка, начатая раньше, не сохраняется
+        self._stats = {'hits': 0, 'loads': 0, 'updates': 0, 'invalidations': 0}
+
+    def get(self, limit):
+        """Первые limit тредов по последнему подъему (копии словарей)."""
+        from . import database_module
+        if limit > self.size: # Список отключен или короче запроса
+            rows = database_module.get_recent_threads(limit)
+            return [dict(row) for row in rows] if rows else []
+        now = time.monotonic()
+        with self._lock:
+            rows, generation = self._rows, self._generation
+            if rows is not None and now - self._loaded_at < RELOAD_INTERVAL:
+                self._stats['hits'] += 1
+                return [dict(row) for row in rows[:limit]]
+        loaded = database_module.get_recent_threads(self.size)
+        if loaded is None: return [] # Ошибка залогирована в execute_query
+        rows = [dict(row) for row in loaded]
+        with self._lock:
+            self._stats['loads'] += 1
+            if self._generation == generation:
+                self._rows, self._loaded_at = rows, now
+        return [dict(row) for row in rows[:limit]]
+
+    def update_thread(self, post_id):
+        """
+        Перечитывает тред после создания, подъема или готовности миниатюр и ставит его на место.
+        Остальные треды не меняются, поэтому список остается первыми тредами сайта по last_bumped.
+        """
+        from . import database_module
+        with self._lock:
+            if self._rows is None: return
+        row = database_module.get_recent_thread(post_id)
+        with self._lock:
+            self._generation += 1
+            if self._rows is None: return
+            rows = [item for item in self._rows if item['post_id'] != post_id]
+            if row: rows.append(dict(row))
+            rows.sort(key=_by_bump, reverse=True) # Уведомления о подъемах могут прийти не по порядку
+            self._rows = rows[:self.size]
+            self._stats['updates'] += 1
+
+    def invalidate(self):
+        """Сбрасывает список (удаление тредов и досок); следующий get загрузит его заново."""
+        with self._lock:
+            self._rows = None
+            self._generation += 1
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=self.size, cached=len(self._rows) if self._rows is not None else None)
+
+
+recent_threads = RecentThreads()
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
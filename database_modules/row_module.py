@@ -0,0 +1,112 @@
+"""
+Проекции столбцов и легкие объекты строк для страниц доски, каталога и треда.
+Раньше чтения шли через SELECT * и sqlite3.Row, а boards_bp копировал каждую строку в dict:
+в память попадали все столбцы (в том числе original_content до 20 000 символов там, где он не
+показывается), и у каждой строки появлялся собственный словарь. Теперь каждое представление
+объявляет свой набор столбцов (View), а строки создаются фабрикой курсора сразу как экземпляры
+класса со __slots__ - без sqlite3.Row и без словаря атрибутов.
+
+Строка ведет себя как словарь там, где этого ждут шаблоны, fragment_module и boards_bp
+(row['x'], row.get('x'), 'x' in row, dict(row), присваивание row['x'] = ...), и как объект
+(post.post_id) в Jinja. Поля, которые заполняет подготовка к рендеру, объявлены в RENDER_FIELDS.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Заполняются boards_bp.format_content_for_template_pass_through_html и fragment_module.apply_fragments
+RENDER_FIELDS = ('post_images_list', 'images_list', 'imagesthb_list', 'thumb_sources', 'thumb_states',
+                 'media_meta', 'answered_by', 'date_display', 'files_html')
+
+
+class RowBase:
+    """Общий протокол строк представлений: доступ по ключу и по атрибуту."""
+    __slots__ = ()
+    _fields = () # Столбцы запроса и RENDER_FIELDS, в порядке объявления
+    _field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try: return getattr(self, key)
+            except AttributeError: pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set: raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._field_set and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self._field_set else default
+
+    def keys(self):
+        return [field for field in self._fields if hasattr(self, field)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{key}={self[key]!r}' for key in self.keys())})"
+
+
+class View:
+    """
+    Набор столбцов одного представления и класс его строк.
+    columns - имена столбцов или пары (SQL-выражение, имя); '{t}' в выражении заменяется
+    префиксом таблицы (например, 'p.'), как и у простых столбцов в select().
+    """
+
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = []
+        for column in columns:
+            expression, field = (f"{{t}}{column}", column) if isinstance(column, str) else column
+            if not field.isidentifier() or field in RENDER_FIELDS:
+                raise ValueError(f"Неверное имя столбца представления {name}: {field}")
+            self.columns.append((expression, field))
+        self.fields = tuple(field for _, field in self.columns)
+        self.row_class = _make_row_class(f"{name}Row", self.fields)
+
+    def select(self, prefix=''):
+        """Список столбцов для SELECT (с псевдонимами для выражений)."""
+        return ', '.join(expression.format(t=prefix) if expression == f"{{t}}{field}"
+                         else f"{expression.format(t=prefix)} AS {field}"
+                         for expression, field in self.columns)
+
+    def row_factory(self, cursor, values):
+        """Фабрика строк для cursor.row_factory: значения идут в порядке select()."""
+        return self.row_class(*values)
+
+    def __repr__(self):
+        return f"View({self.name!r}, {self.fields!r})"
+
+
+def _make_row_class(class_name, fields):
+    # __init__ с позиционными аргументами генерируется, как в collections.namedtuple:
+    # присваивания без цикла заметно быстрее setattr по списку имен
+    arguments = ', '.join(fields)
+    body = ''.join(f"    self.{field} = {field}\n" for field in fields)
+    namespace = {}
+    exec(f"def __init__(self, {arguments}):\n{body}", namespace)
+    all_fields = fields + RENDER_FIELDS
+    return type(class_name, (RowBase,), {
+        '__slots__': all_fields,
+        '__init__': namespace['__init__'],
+        '_fields': all_fields,
+        '_field_set': frozenset(all_fields),
+    })
+
+
+def as_item(row):
+    """Строка для заполнения полями рендера: строки представлений изменяются на месте, прочие копируются в dict."""
+    return row if isinstance(row, RowBase) else dict(row)
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
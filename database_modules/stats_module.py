@@ -0,0 +1,115 @@
+"""
+Счетчики досок (треды, закрепленные, ответы, последняя активность).
+Таблица board_stats поддерживается триггерами SQLite при вставке/удалении постов,
+ответов и закреплений, поэтому навигация читает готовые значения одним запросом
+вместо COUNT по всем постам каждой доски.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+BOARD_STATS_TABLE = """
+    CREATE TABLE IF NOT EXISTS board_stats (
+        board_uri TEXT PRIMARY KEY,
+        thread_count INTEGER NOT NULL DEFAULT 0, -- Все треды доски, включая закрепленные
+        pinned_count INTEGER NOT NULL DEFAULT 0,
+        reply_count INTEGER NOT NULL DEFAULT 0,
+        last_activity TEXT, -- MAX(posts.last_bumped), ISO 8601 UTC
+        FOREIGN KEY (board_uri) REFERENCES boards (board_uri) ON DELETE CASCADE
+    )
+"""
+
+BOARD_STATS_TRIGGERS = [
+    # Новая доска получает нулевые счетчики
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_board_stats_board_insert AFTER INSERT ON boards
+    BEGIN
+        INSERT OR IGNORE INTO board_stats (board_uri) VALUES (NEW.board_uri);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_board_stats_post_insert AFTER INSERT ON posts
+    BEGIN
+        INSERT INTO board_stats (board_uri, thread_count, last_activity) VALUES (NEW.board_uri, 1, NEW.last_bumped)
+        ON CONFLICT (board_uri) DO UPDATE SET
+            thread_count = thread_count + 1,
+            last_activity = MAX(IFNULL(last_activity, ''), excluded.last_activity);
+    END
+    """,
+    # BEFORE: после каскадного удаления ответов их тред уже не найти, поэтому вычитаем ответы здесь
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_board_stats_post_delete BEFORE DELETE ON posts
+    BEGIN
+        UPDATE board_stats SET
+            thread_count = MAX(thread_count - 1, 0),
+            reply_count = MAX(reply_count - (SELECT COUNT(*) FROM replies WHERE post_id = OLD.post_id), 0),
+            last_activity = (SELECT MAX(last_bumped) FROM posts WHERE board_uri = OLD.board_uri AND post_id != OLD.post_id)
+        WHERE board_uri = OLD.board_uri;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_board_stats_post_bump AFTER UPDATE OF last_bumped ON posts
+    BEGIN
+        UPDATE board_stats SET last_activity = MAX(IFNULL(last_activity, ''), NEW.last_bumped)
+        WHERE board_uri = NEW.board_uri;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_board_stats_reply_insert AFTER INSERT ON replies
+    BEGIN
+        UPDATE board_stats SET reply_count = reply_count + 1
+        WHERE board_uri = (SELECT board_uri FROM posts WHERE post_id = NEW.post_id);
+    END
+    """,
+    # При каскаде от удаления треда подзапрос ничего не находит - ответы уже вычтены выше
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_board_stats_reply_delete AFTER DELETE ON replies
+    BEGIN
+        UPDATE board_stats SET reply_count = MAX(reply_count - 1, 0)
+        WHERE board_uri = (SELECT board_uri FROM posts WHERE post_id = OLD.post_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_board_stats_pin_insert AFTER INSERT ON pinned
+    BEGIN
+        UPDATE board_stats SET pinned_count = pinned_count + 1 WHERE board_uri = NEW.board_uri;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_board_stats_pin_delete AFTER DELETE ON pinned
+    BEGIN
+        UPDATE board_stats SET pinned_count = MAX(pinned_count - 1, 0) WHERE board_uri = OLD.board_uri;
+    END
+    """,
+]
+
+# Пересчет счетчиков из исходных таблиц (одним запросом на все доски)
+_BACKFILL_SELECT = """
+    SELECT b.board_uri,
+           (SELECT COUNT(*) FROM posts p WHERE p.board_uri = b.board_uri),
+           (SELECT COUNT(*) FROM pinned pn JOIN posts p ON p.post_id = pn.post_id WHERE pn.board_uri = b.board_uri),
+           (SELECT COUNT(*) FROM replies r JOIN posts p ON r.post_id = p.post_id WHERE p.board_uri = b.board_uri),
+           (SELECT MAX(p.last_bumped) FROM posts p WHERE p.board_uri = b.board_uri)
+    FROM boards b
+"""
+
+
+def create_board_stats(conn, rebuild=True):
+    """
+    Создает таблицу и триггеры счетчиков.
+    rebuild=True пересчитывает все строки (database_setup.py), иначе заполняются только отсутствующие.
+    """
+    conn.execute(BOARD_STATS_TABLE)
+    for trigger_sql in BOARD_STATS_TRIGGERS:
+        conn.execute(trigger_sql)
+    verb = "INSERT OR REPLACE" if rebuild else "INSERT OR IGNORE"
+    conn.execute(f"{verb} INTO board_stats (board_uri, thread_count, pinned_count, reply_count, last_activity) {_BACKFILL_SELECT}")
+
+def board_stats_exist(conn):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'board_stats'").fetchone()
+    return row is not None
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
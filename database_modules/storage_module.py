@@ -0,0 +1,154 @@
+"""
+Профиль хранения SQLite для имиджборда.
+Включает WAL, настраивает PRAGMA для каждого соединения, периодически выполняет
+checkpoint, чтобы WAL-файл не рос бесконечно, и переводит существующие базы в WAL.
+
+Режим выбирается переменной окружения PEJCHAN_DB_PROFILE:
+    durable - (по умолчанию) synchronous=FULL, каждая транзакция переживает отключение питания;
+    fast    - synchronous=NORMAL, в WAL база остается целостной, но при отключении
+              питания могут потеряться последние транзакции.
+"""
+
+import os
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE = 'durable'
+
+# Общие для всех профилей настройки
+_BASE_PRAGMAS = {
+    'journal_mode': 'WAL', # Читатели не блокируются пишущим
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000, # мс ожидания блокировки вместо мгновенного "database is locked"
+    'journal_size_limit': 64 * 1024 * 1024, # После checkpoint WAL обрезается до этого размера
+}
+
+STORAGE_PROFILES = {
+    'durable': dict(_BASE_PRAGMAS, synchronous='FULL', cache_size=-20000, mmap_size=64 * 1024 * 1024),
+    'fast': dict(_BASE_PRAGMAS, synchronous='NORMAL', cache_size=-64000, mmap_size=256 * 1024 * 1024),
+}
+
+CHECKPOINT_INTERVAL = float(os.environ.get('PEJCHAN_DB_CHECKPOINT_INTERVAL', 60)) # секунды
+WAL_TRUNCATE_THRESHOLD = int(os.environ.get('PEJCHAN_DB_WAL_LIMIT', 64 * 1024 * 1024)) # байты
+
+
+def get_profile_name():
+    """Имя активного профиля (неизвестные значения заменяются профилем по умолчанию)."""
+    name = os.environ.get('PEJCHAN_DB_PROFILE', DEFAULT_PROFILE).strip().lower()
+    if name not in STORAGE_PROFILES:
+        logger.warning(f"Неизвестный профиль хранения '{name}', используется '{DEFAULT_PROFILE}'.")
+        return DEFAULT_PROFILE
+    return name
+
+def get_profile(name=None):
+    return STORAGE_PROFILES[name or get_profile_name()]
+
+def apply_profile(conn, profile_name=None):
+    """Применяет PRAGMA профиля к соединению. journal_mode меняется только если нет конкурентов."""
+    profile = get_profile(profile_name)
+    for pragma, value in profile.items():
+        if pragma == 'journal_mode':
+            continue
+        conn.execute(f"PRAGMA {pragma} = {value};")
+    try:
+        mode = conn.execute(f"PRAGMA journal_mode = {profile['journal_mode']};").fetchone()[0]
+        if str(mode).upper() != profile['journal_mode']:
+            logger.warning(f"Не удалось переключить журнал в {profile['journal_mode']}, текущий режим: {mode}")
+    except sqlite3.OperationalError as e:
+        # База занята другим процессом в режиме rollback-журнала; переключимся при следующем соединении
+        logger.warning(f"Не удалось включить WAL для соединения: {e}")
+
+def connection_initializer(database_path, profile_name=None):
+    """Возвращает функцию настройки нового соединения для ConnectionManager(on_connect=...)."""
+    def _init(conn):
+        apply_profile(conn, profile_name)
+        start_checkpointer(database_path) # Запускается один раз на процесс (в т.ч. после fork)
+    return _init
+
+
+# --- Фоновый checkpoint ---
+class WalCheckpointer:
+    """Поток, периодически переносящий WAL в основную базу."""
+
+    def __init__(self, database_path, interval=CHECKPOINT_INTERVAL, truncate_threshold=WAL_TRUNCATE_THRESHOLD):
+        self.database_path = database_path
+        self.interval = interval
+        self.truncate_threshold = truncate_threshold
+        self._stop = threading.Event()
+        self._thread = None
+        self.pid = os.getpid()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sqlite-wal-checkpointer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive() and self.pid == os.getpid()
+
+    def wal_size(self):
+        try: return os.path.getsize(self.database_path + '-wal')
+        except OSError: return 0
+
+    def checkpoint(self, conn):
+        """PASSIVE не мешает читателям; TRUNCATE только если WAL вырос сверх порога."""
+        mode = 'TRUNCATE' if self.wal_size() > self.truncate_threshold else 'PASSIVE'
+        busy, log_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode});").fetchone()
+        if busy:
+            logger.debug(f"Checkpoint {mode} не завершен полностью: {checkpointed}/{log_frames} страниц.")
+        return mode, busy, log_frames, checkpointed
+
+    def _run(self):
+        conn = None
+        while not self._stop.wait(self.interval):
+            try:
+                if conn is None:
+                    conn = sqlite3.connect(self.database_path, timeout=5, check_same_thread=False)
+                    conn.execute(f"PRAGMA busy_timeout = {_BASE_PRAGMAS['busy_timeout']};")
+                self.checkpoint(conn)
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка фонового checkpoint WAL: {e}")
+                if conn is not None:
+                    try: conn.close()
+                    except sqlite3.Error: pass
+                    conn = None
+        if conn is not None:
+            conn.close()
+
+_checkpointers = {}
+_checkpointers_lock = threading.Lock()
+
+def start_checkpointer(database_path):
+    """Запускает checkpoint-поток для базы, если в этом процессе он еще не работает."""
+    key = os.path.abspath(database_path)
+    with _checkpointers_lock:
+        checkpointer = _checkpointers.get(key)
+        if checkpointer is not None and checkpointer.is_alive():
+            return checkpointer
+        checkpointer = WalCheckpointer(database_path)
+        checkpointer.start()
+        _checkpointers[key] = checkpointer
+        return checkpointer
+
+
+# --- Миграция существующих баз ---
+def migrate_database(conn, profile_name=None):
+    """
+    Переводит существующую базу (например, instance/imageboard.db) в WAL.
+    Режим WAL сохраняется в файле базы, поэтому миграция нужна один раз.
+    """
+    before = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+    apply_profile(conn, profile_name)
+    after = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+    if str(before).lower() != str(after).lower():
+        logger.info(f"Журнал базы переведен из '{before}' в '{after}'.")
+    return before, after
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
@@ -0,0 +1,230 @@
+"""
+Потоковый прием загружаемых файлов.
+IngestRequest подменяет поток, в который Werkzeug пишет части multipart: UploadSpool
+определяет тип по сигнатуре первых байт (а не по расширению), проверяет лимиты размера
+и разрешения изображения по заголовку, считает sha256 и пишет файл на диск по мере
+поступления данных. Отклоненная часть переводится в режим отбрасывания: оставшиеся
+байты не буферизуются и не пишутся на диск (тело запроса дочитывается - после файла
+могут идти поля формы).
+
+Принятый файл не копируется повторно: posts_bp переносит его в хранилище
+(media_store_module) вместе с уже посчитанным хешем.
+"""
+
+import io
+import os
+import hashlib
+import logging
+import tempfile
+
+from flask import Request
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+STAGING_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'upload_staging')
+SNIFF_BYTES = 16 # Достаточно для всех сигнатур ниже
+HEADER_PROBE_LIMIT = 256 * 1024 # Заголовок изображения (с EXIF) должен уместиться сюда
+MAX_IMAGE_PIXELS = 50_000_000
+MAX_IMAGE_SIDE = 16384
+
+# Тип по сигнатуре: (допустимые расширения, расширение по умолчанию, лимит размера)
+UPLOAD_TYPES = {
+    'jpeg': ({'.jpg', '.jpeg'}, '.jpg', 10 * MB),
+    'png': ({'.png'}, '.png', 10 * MB),
+    'webp': ({'.webp'}, '.webp', 10 * MB),
+    'gif': ({'.gif'}, '.gif', 8 * MB),
+    'mp4': ({'.mp4', '.mov'}, '.mp4', 20 * MB),
+    'mov': ({'.mov', '.mp4'}, '.mov', 20 * MB),
+    'webm': ({'.webm'}, '.webm', 20 * MB),
+    'mp3': ({'.mp3'}, '.mp3', 20 * MB),
+}
+IMAGE_TYPES = {'jpeg', 'png', 'webp', 'gif'}
+
+# Основные бренды ftyp (контейнер ISO BMFF), принимаемые как видео. Тот же контейнер у HEIC/AVIF
+# (изображения), M4A (аудио) и 3GP - их браузер не покажет в <video>, такие файлы отклоняются.
+MP4_BRANDS = frozenset({b'isom', b'iso2', b'iso3', b'iso4', b'iso5', b'iso6', b'mp41', b'mp42', b'avc1', b'dash', b'M4V '})
+MOV_BRANDS = frozenset({b'qt  '})
+
+
+def sniff_type(head):
+    """Тип файла по первым байтам или None."""
+    if head.startswith(b'\xff\xd8\xff'): return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'): return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'): return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP': return 'webp'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        return 'mov' if brand in MOV_BRANDS else 'mp4' if brand in MP4_BRANDS else None
+    if head.startswith(b'\x1a\x45\xdf\xa3'): return 'webm'
+    if head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0): return 'mp3'
+    return None
+
+
+class UploadRejected(Exception):
+    pass
+
+
+class UploadSpool(io.RawIOBase):
+    """Файл части multipart: пишется на диск в STAGING_DIR с хешированием и проверками."""
+
+    def __init__(self, filename=None, content_type=None):
+        super().__init__()
+        self.filename = filename or ''
+        self.content_type = content_type
+        self.kind = None
+        self.ext = None
+        self.dimensions = None # (ширина, высота) для изображений
+        self.size = 0
+        self.rejected = None # Причина отказа (текст для пользователя)
+        self._digest = hashlib.sha256()
+        self._head = bytearray() # Первые байты для сигнатуры и заголовка изображения
+        self._next_probe = 16 * 1024
+        self._finished = False
+        os.makedirs(STAGING_DIR, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix='upload-', dir=STAGING_DIR)
+        self._file = os.fdopen(fd, 'w+b')
+
+    # --- Запись (вызывает парсер multipart) ---
+    def writable(self): return True
+    def readable(self): return True
+    def seekable(self): return True
+
+    def write(self, data):
+        if self.rejected is not None:
+            return len(data) # Режим отбрасывания
+        try:
+            self._inspect(data)
+        except UploadRejected as e:
+            self._reject(str(e))
+            return len(data)
+        self._digest.update(data)
+        self.size += len(data)
+        self._file.write(data)
+        return len(data)
+
+    def _inspect(self, data):
+        if self.kind is None or (self.kind in IMAGE_TYPES and self.dimensions is None):
+            self._head += data[:HEADER_PROBE_LIMIT - len(self._head)]
+        if self.kind is None and len(self._head) >= SNIFF_BYTES:
+            self._identify()
+        if self.kind is not None:
+            if self.size + len(data) > UPLOAD_TYPES[self.kind][2]:
+                raise UploadRejected(f"File is too large (max {UPLOAD_TYPES[self.kind][2] // MB} MB for this type).")
+            if self.kind in IMAGE_TYPES and self.dimensions is None and len(self._head) >= self._next_probe:
+                self._probe_image(final=len(self._head) >= HEADER_PROBE_LIMIT)
+
+    def _identify(self):
+        kind = sniff_type(bytes(self._head[:SNIFF_BYTES]))
+        if kind is None:
+            raise UploadRejected("File type is not allowed.")
+        allowed_exts, default_ext, _ = UPLOAD_TYPES[kind]
+        file_ext = os.path.splitext(self.filename)[1].lower()
+        self.kind = kind
+        self.ext = file_ext if file_ext in allowed_exts else default_ext
+
+    def _probe_image(self, final=False):
+        """Разбирает только заголовок (Image.open не декодирует пиксели) и проверяет разрешение."""
+        self._next_probe = len(self._head) * 2
+        try:
+            with Image.open(io.BytesIO(bytes(self._head))) as img:
+                width, height = img.size
+        except Image.DecompressionBombError:
+            raise UploadRejected("Image resolution is too large.")
+        except Exception:
+            if final: raise UploadRejected("Could not read the image file.")
+            return
+        if width * height > MAX_IMAGE_PIXELS or max(width, height) > MAX_IMAGE_SIDE:
+            raise UploadRejected(f"Image resolution is too large ({width}x{height}).")
+        self.dimensions = (width, height)
+        self._head = bytearray()
+
+    def _reject(self, reason):
+        self.rejected = reason
+        self._head = bytearray()
+        logger.info(f"Загрузка '{self.filename}' отклонена: {reason}")
+        self._discard_file()
+
+    def _finish(self):
+        """Конец части: короткие файлы и недочитанные заголовки проверяются по тому, что есть."""
+        self._finished = True
+        if self.rejected is not None: return
+        try:
+            if self.kind is None:
+                if not self._head: raise UploadRejected("File is empty.")
+                self._identify()
+            if self.kind in IMAGE_TYPES and self.dimensions is None:
+                self._probe_image(final=True)
+        except UploadRejected as e:
+            self._reject(str(e))
+        self._head = bytearray()
+
+    # --- Чтение (FileStorage) ---
+    def seek(self, offset, whence=io.SEEK_SET):
+        if not self._finished: self._finish() # Werkzeug перематывает файл, когда часть дочитана
+        if self._file is None: return 0
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell() if self._file is not None else 0
+
+    def read(self, size=-1):
+        return self._file.read(size) if self._file is not None else b''
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer) if self._file is not None else 0
+
+    def readline(self, size=-1):
+        return self._file.readline(size) if self._file is not None else b''
+
+    def flush(self):
+        if self._file is not None: self._file.flush()
+
+    # --- Результат ---
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def detach_file(self):
+        """Передает файл на диске вызывающему (он переименует или удалит его). Возвращает путь."""
+        if self.rejected is not None or self._file is None:
+            return None
+        self._file.close(); self._file = None
+        path, self.path = self.path, None
+        return path
+
+    def _discard_file(self):
+        if self._file is not None:
+            self._file.close(); self._file = None
+        if self.path:
+            try: os.remove(self.path)
+            except OSError: pass
+            self.path = None
+
+    def close(self):
+        # Запрос закрывает файлы по завершении: непринятый файл удаляется
+        self._discard_file()
+        super().close()
+
+
+class IngestRequest(Request):
+    """Request, принимающий файлы через UploadSpool (app.request_class)."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool(filename, content_type)
+
+
+def spool_of(file_storage):
+    """UploadSpool загруженного файла или None (если запрос обработан стандартным Request)."""
+    stream = getattr(file_storage, 'stream', None)
+    return stream if isinstance(stream, UploadSpool) else None
+
+def rejection(file_storage):
+    """Причина отказа для загруженного файла или None."""
+    spool = spool_of(file_storage)
+    return spool.rejected if spool is not None else None
+
+
+if __name__ == '__main__':
+    print("This module should not be run directly.")
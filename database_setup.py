@@ -21,6 +21,77 @@ except ImportError as e:
         print("Заглушка hash_password вызвана.")
         return None
 
+try:
+    from database_modules.database_module import ensure_post_pinned_flag, ensure_board_preview_replies, ensure_thumb_variants_columns
+    SCHEMA_MIGRATIONS_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать миграции схемы из database_module: {e}")
+    print("Новые столбцы (posts.pinned, boards.preview_replies, thumb_variants) будут добавлены приложением при первом обращении.")
+    SCHEMA_MIGRATIONS_AVAILABLE = False
+
+try:
+    from database_modules.fragment_module import create_fragment_table, purge_stale_variants
+    FRAGMENT_MODULE_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать fragment_module: {e}")
+    FRAGMENT_MODULE_AVAILABLE = False
+
+try:
+    from database_modules.quote_module import create_quote_table
+    QUOTE_MODULE_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать quote_module: {e}")
+    print("Индекс цитат будет создан приложением при первом обращении.")
+    QUOTE_MODULE_AVAILABLE = False
+
+try:
+    from database_modules.media_module import create_media_jobs_table, create_media_meta_table
+    MEDIA_MODULE_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать media_module: {e}")
+    print("Очередь обработки медиа будет создана приложением при первом обращении.")
+    MEDIA_MODULE_AVAILABLE = False
+
+try:
+    from database_modules.media_store_module import create_media_store
+    MEDIA_STORE_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать media_store_module: {e}")
+    print("Хранилище файлов будет создано приложением; существующие файлы не будут отслеживаться.")
+    MEDIA_STORE_AVAILABLE = False
+
+try:
+    from database_modules.media_gc_module import create_media_gc_table
+    MEDIA_GC_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать media_gc_module: {e}")
+    print("Очередь удаления файлов будет создана приложением при первом обращении.")
+    MEDIA_GC_AVAILABLE = False
+
+try:
+    from database_modules.ratelimit_module import create_rate_limits_table
+    RATELIMIT_MODULE_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать ratelimit_module: {e}")
+    print("Таблица лимитов досок будет создана приложением при первом обращении.")
+    RATELIMIT_MODULE_AVAILABLE = False
+
+try:
+    from database_modules.storage_module import migrate_database, get_profile_name
+    STORAGE_MODULE_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать storage_module: {e}")
+    print("База останется в режиме журнала по умолчанию (без WAL).")
+    STORAGE_MODULE_AVAILABLE = False
+
+try:
+    from database_modules.stats_module import create_board_stats
+    STATS_MODULE_AVAILABLE = True
+except ImportError as e:
+    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось импортировать stats_module: {e}")
+    print("Счетчики досок будут созданы приложением при первом обращении.")
+    STATS_MODULE_AVAILABLE = False
+
 # --- Конфигурация БД ---
 DATABASE_DIR = 'instance' # Папка для БД
 DATABASE_PATH = os.path.join(DATABASE_DIR, 'imageboard.db') # Путь к файлу БД
@@ -59,11 +130,14 @@ def init_db():
                 board_desc TEXT,
                 board_owner TEXT NOT NULL,
                 enable_captcha INTEGER DEFAULT 0,
+                preview_replies INTEGER NOT NULL DEFAULT 4, -- Последних ответов под тредом на странице доски
                 FOREIGN KEY (board_owner) REFERENCES accounts (username) ON DELETE CASCADE
             )
         ''')
         # Индекс для быстрого поиска досок по URI
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_board_uri ON boards (board_uri)')
+        if SCHEMA_MIGRATIONS_AVAILABLE and ensure_board_preview_replies(conn):
+            print("Добавлен столбец boards.preview_replies")
 
         # --- Создание таблицы posts ---
         print("Создание таблицы: posts")
@@ -82,6 +156,8 @@ def init_db():
                 locked INTEGER DEFAULT 0,
                 visible INTEGER DEFAULT 1, -- Возможно, не используется, если pinned отдельно
                 last_bumped TEXT NOT NULL, -- Храним как строку ISO 8601 UTC для сортировки
+                pinned INTEGER NOT NULL DEFAULT 0, -- Копия таблицы pinned, поддерживается триггерами
+                thumb_variants TEXT, -- JSON {путь миниатюры: [[формат, ширина], ...]} (media_module)
                 FOREIGN KEY (board_uri) REFERENCES boards (board_uri) ON DELETE CASCADE
             )
         ''')
@@ -103,6 +179,10 @@ def init_db():
         ''')
         # Индекс для быстрого получения закрепленных постов доски
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_pinned_board_uri ON pinned (board_uri)')
+        # Флаг posts.pinned, составной индекс страниц доски и триггеры синхронизации с pinned
+        if SCHEMA_MIGRATIONS_AVAILABLE:
+            if ensure_post_pinned_flag(conn):
+                print("Добавлен столбец posts.pinned (заполнен из таблицы pinned)")
 
         # --- Создание таблицы replies ---
         print("Создание таблицы: replies")
@@ -117,12 +197,15 @@ def init_db():
                 content TEXT,
                 images TEXT, -- Храним как JSON строку списка имен файлов
                 imagesthb TEXT, -- Храним как JSON строку списка имен миниатюр
+                thumb_variants TEXT, -- JSON {путь миниатюры: [[формат, ширина], ...]} (media_module)
                 FOREIGN KEY (post_id) REFERENCES posts (post_id) ON DELETE CASCADE
             )
         ''')
         # Индексы для ускорения запросов к ответам
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_reply_post_id ON replies (post_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_reply_id ON replies (reply_id)')
+        if SCHEMA_MIGRATIONS_AVAILABLE and ensure_thumb_variants_columns(conn):
+            print("Добавлен столбец thumb_variants (posts, replies)")
 
         # --- Создание таблицы timeouts ---
         print("Создание таблицы: timeouts")
@@ -155,6 +238,62 @@ def init_db():
         # Индекс для быстрой проверки бана по IP
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_ban_user_ip ON bans (user_ip)')
 
+        # --- Создание таблицы post_sequence ---
+        print("Создание таблицы: post_sequence")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS post_sequence (
+                name TEXT PRIMARY KEY, -- 'post': общая нумерация постов и ответов
+                value INTEGER NOT NULL -- Последний выданный номер
+            )
+        ''')
+        # Засев из существующих данных (только при первом запуске, значение не уменьшается)
+        cursor.execute('''
+            INSERT OR IGNORE INTO post_sequence (name, value)
+            SELECT 'post', MAX(IFNULL((SELECT MAX(post_id) FROM posts), 0), IFNULL((SELECT MAX(reply_id) FROM replies), 0))
+        ''')
+
+        # --- Счетчики досок (таблица board_stats и триггеры) ---
+        if STATS_MODULE_AVAILABLE:
+            print("Создание таблицы: board_stats (пересчет счетчиков)")
+            create_board_stats(conn) # Повторный запуск пересчитывает счетчики из исходных таблиц
+
+        # --- Кеш отрендеренных фрагментов постов ---
+        if FRAGMENT_MODULE_AVAILABLE:
+            print("Создание таблицы: render_fragments")
+            create_fragment_table(conn)
+            purged = purge_stale_variants(conn)
+            if purged: print(f"Удалено устаревших фрагментов: {purged}")
+
+        # --- Индекс цитат (обратные ссылки >>N) ---
+        if QUOTE_MODULE_AVAILABLE:
+            print("Создание таблицы: post_quotes (пересчет из существующих постов)")
+            quotes = create_quote_table(conn)
+            if quotes: print(f"Записано цитат: {quotes}")
+
+        # --- Очередь обработки загруженных файлов ---
+        if MEDIA_MODULE_AVAILABLE:
+            print("Создание таблицы: media_jobs")
+            create_media_jobs_table(conn)
+
+        # --- Хранилище файлов по содержимому (счетчики ссылок) ---
+        if MEDIA_STORE_AVAILABLE:
+            print("Создание таблиц: media_objects, media_refs (хеширование существующих файлов)")
+            objects = create_media_store(conn, os.path.join(project_root, 'static'), rebuild=True)
+            if objects: print(f"Отслеживается файлов: {objects}")
+            if MEDIA_MODULE_AVAILABLE:
+                print("Создание таблицы: media_meta")
+                create_media_meta_table(conn)
+
+        # --- Очередь фонового удаления файлов ---
+        if MEDIA_GC_AVAILABLE:
+            print("Создание таблицы: media_gc_queue")
+            create_media_gc_table(conn)
+
+        # --- Лимиты частоты постинга по доскам ---
+        if RATELIMIT_MODULE_AVAILABLE:
+            print("Создание таблицы: board_rate_limits")
+            create_rate_limits_table(conn)
+
         # --- Создание администратора по умолчанию (Опционально) ---
         if HASH_PASSWORD_AVAILABLE:
             cursor.execute("SELECT COUNT(*) FROM accounts WHERE role = 'owner'")
@@ -177,6 +316,11 @@ def init_db():
 
         # Фиксируем изменения в БД
         conn.commit()
+
+        # --- Профиль хранения: WAL и PRAGMA (повторный запуск мигрирует существующую базу) ---
+        if STORAGE_MODULE_AVAILABLE:
+            before, after = migrate_database(conn)
+            print(f"Профиль хранения '{get_profile_name()}': журнал '{before}' -> '{after}'.")
         print("База данных успешно инициализирована.")
 
     except sqlite3.Error as e:
@@ -9,6 +9,7 @@ from datetime import timedelta # Для настройки времени жиз
 from blueprints.auth_bp import auth_bp
 from blueprints.boards_bp import boards_bp
 from blueprints.posts_bp import posts_bp
+from database_modules import captcha_module, live_module, media_module, media_gc_module, upload_module
 # Добавьте другие блюпринты, если они есть
 
 # --- Конфигурация логирования ---
@@ -19,6 +20,8 @@ logger = logging.getLogger(__name__)
 
 # --- Создание экземпляра Flask ---
 app = Flask(__name__)
+# Загрузки проверяются, ограничиваются по размеру и хешируются, пока тело запроса читается.
+app.request_class = upload_module.IngestRequest
 
 # --- Конфигурация приложения ---
 # Секретный ключ для сессий (ВАЖНО: измените на свой случайный ключ!)
@@ -42,6 +45,15 @@ socketio_message_queue = os.environ.get('SOCKETIO_MESSAGE_QUEUE', None) # e.g.,
 
 socketio = SocketIO(app, async_mode='gevent', message_queue=socketio_message_queue)
 logger.info(f"SocketIO initialized. Async mode: {socketio.async_mode}, Message queue: {socketio_message_queue or 'Not used'}")
+# Сокеты подписываются на комнату доски или треда; события отправляются только в эти комнаты.
+# Счетчики подписчиков (/api/live_stats) ведет каждый worker для своих соединений.
+live_module.live_rooms.init_app(app, socketio)
+# Миниатюры генерирует пул процессов; клиенты получают 'thumbnail_ready' через SocketIO.
+media_module.media_queue.init_app(app, socketio)
+# Файлы удаленных постов удаляет пачками фоновый сборщик.
+media_gc_module.media_gc.init_app(app)
+# Капчи заранее генерирует фоновый поток; очередь заполняется при старте, а не при первом показе.
+captcha_module.captcha_pool.init_app(app)
 
 
 # --- Регистрация блюпринтов ---
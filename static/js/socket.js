@@ -1,4 +1,17 @@
-var socket = io();
+// Room for this page: board index and catalog subscribe to the board, thread pages to the thread.
+// Other pages receive no live events and do not connect at all.
+function getSubscription() {
+    const path = window.location.pathname;
+    const threadMatch = path.match(/^\/([^\/]+)\/thread\/(\d+)\/?$/);
+    if (threadMatch) return { board: decodeURIComponent(threadMatch[1]), thread: threadMatch[2] };
+    const boardMatch = path.match(/^\/([^\/]+)\/(catalog\/?)?$/);
+    if (boardMatch) return { board: decodeURIComponent(boardMatch[1]) };
+    return null;
+}
+
+const subscription = getSubscription();
+// auth is sent again on every reconnect, so the room is rejoined automatically
+var socket = io({ auth: subscription || {}, autoConnect: subscription !== null });
 
 if (!socket) {
     console.error("Socket object (io) FAILED to initialize!");
@@ -6,6 +19,7 @@ if (!socket) {
 
 const defaultIconPath = '/static/imgs/decoration/icon.png';
 const notificationIconPath = '/static/imgs/decoration/icon_reddot.png';
+const thumbProcessingPath = '/static/imgs/decoration/thumb_processing.svg';
 let missedMessages = 0;
 let originalTitle = document.title;
 
@@ -127,6 +141,45 @@ socket.on('nova_postagem', function(data) {
     }
 });
 
+function showReadyThumbnail(img) {
+    img.src = img.getAttribute('data-thumb-src');
+    img.removeAttribute('data-thumb-src');
+    img.classList.remove('thumb_processing');
+}
+
+socket.on('thumbnail_ready', function(data) {
+    if (!data || !data.thumbnail) return;
+    document.querySelectorAll('img[data-thumb-src]').forEach(img => {
+        if (img.getAttribute('data-thumb-src') === data.thumbnail) {
+            showReadyThumbnail(img);
+        }
+    });
+});
+
+// The event may have fired before this page was loaded: check pending thumbnails once per (re)connect
+function probePendingThumbnails(cacheBust) {
+    const pending = document.querySelectorAll('img[data-thumb-src]');
+    pending.forEach(img => {
+        const probe = new Image();
+        probe.onload = () => { if (img.hasAttribute('data-thumb-src')) showReadyThumbnail(img); };
+        const src = img.getAttribute('data-thumb-src');
+        probe.src = cacheBust ? `${src}?probe=${cacheBust}` : src;
+    });
+    return pending.length;
+}
+socket.on('connect', () => probePendingThumbnails());
+
+// Pages without a room (the front page) get no thumbnail_ready: poll until the thumbnails exist
+const THUMB_POLL_INTERVAL_MS = 5000;
+const THUMB_POLL_MAX_ROUNDS = 60;
+if (subscription === null && probePendingThumbnails()) {
+    let pollRounds = 0;
+    const thumbPoll = setInterval(() => {
+        pollRounds += 1;
+        if (!probePendingThumbnails(pollRounds) || pollRounds >= THUMB_POLL_MAX_ROUNDS) clearInterval(thumbPoll);
+    }, THUMB_POLL_INTERVAL_MS);
+}
+
 function addNewThread(postData) {
     const displayName = postData.name || (postData.post_user === '' || postData.post_user === 'Anonymous' ? 'Anon' : postData.post_user);
     const postDate = postData.date || 'now';
@@ -303,7 +356,12 @@ function generateFilesHTMLFromData(filesData, type) {
         html += `  <div class="${fileInfoClass}">`;
         html += `    <a class="image_url" href="${hrefUrl}" target="_blank" rel="noopener noreferrer">${displayName}</a>`;
         html += `  </div>`;
-        html += `    <img draggable="false" class="${fileElementClass}" src="${thumbnailUrl}" href="${hrefUrl}">`;
+        if (fileInfo.pending) {
+            // Thumbnail is still being generated; 'thumbnail_ready' swaps it in
+            html += `    <img draggable="false" class="${fileElementClass} thumb_processing" src="${thumbProcessingPath}" data-thumb-src="${thumbnailUrl}" href="${hrefUrl}">`;
+        } else {
+            html += `    <img draggable="false" class="${fileElementClass}" src="${thumbnailUrl}" href="${hrefUrl}">`;
+        }
         html += `  </a>`;
         html += `</div>`;
     });